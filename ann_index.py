@@ -0,0 +1,135 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import descriptors
+
+
+# Inverted file (IVF) index over normalised descriptor vectors for
+# approximate nearest neighbour search in libraries far beyond what a dense
+# kernel can hold. The vectors are clustered with spherical k-means and
+# stored grouped by cluster; a query only scans the `nprobe` clusters whose
+# centroids are most similar to it, i.e. O(nprobe * N / n_lists) instead of
+# O(N). The similarities are those of the descriptors ((p . p')^zeta, see
+# descriptors.similarity), not kernel values. The app still loads the dense
+# kernel of a dataset, for consensus and substructure searches and the
+# precomputed top-K lists, so the index saves search time but not memory.
+ANN_PATH = os.environ.get('EXCHEM_ANN_INDEX', 'ann_index.npz')
+NPROBE = int(os.environ.get('EXCHEM_ANN_NPROBE', '8'))
+
+
+def _normalise(vectors):
+    norm = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norm > 0, norm, 1)
+
+
+def _assign(vectors, centroids, chunk=65536):
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk):
+        labels[start:start + chunk] = np.argmax(vectors[start:start + chunk] @ centroids.T, axis=1)
+    return labels
+
+
+def spherical_kmeans(vectors, n_lists, n_iter=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = _assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        empty = ~sums.any(axis=1)
+        # re-seed empty clusters with random vectors
+        sums[empty] = vectors[rng.choice(len(vectors), empty.sum(), replace=False)]
+        centroids = _normalise(sums)
+    return centroids, _assign(vectors, centroids)
+
+
+class IVFIndex:
+    def __init__(self, centroids, offsets, ids, vectors, zeta=descriptors.PARAMS['zeta']):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+        self.vectors = vectors
+        self.zeta = zeta
+
+    @classmethod
+    def build(cls, vectors, ids=None, n_lists=None, n_iter=20, seed=0):
+        vectors = _normalise(np.asarray(vectors, dtype=np.float32))
+        if ids is None:
+            ids = np.arange(len(vectors))
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(len(vectors))))
+        centroids, labels = spherical_kmeans(vectors, n_lists, n_iter, seed)
+        order = np.argsort(labels, kind='stable')
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=n_lists), out=offsets[1:])
+        return cls(centroids.astype(np.float32), offsets,
+                   np.asarray(ids, dtype=np.int32)[order], vectors[order])
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def candidates(self, query, nprobe=NPROBE):
+        # positions in ids / vectors of the vectors in the nprobe clusters
+        # whose centroids are most similar to the query, the only ones ranked
+        query = np.asarray(query, dtype=np.float32)
+        nprobe = min(nprobe, self.n_lists)
+        probe = np.argpartition(self.centroids @ query, -nprobe)[-nprobe:]
+        return np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in probe])
+
+    def search(self, query, k, nprobe=NPROBE):
+        # returns ids and descriptor similarities of the approximate top-k,
+        # sorted by decreasing similarity; fewer than k when the probed
+        # clusters hold fewer vectors
+        query = np.asarray(query, dtype=np.float32)
+        candidates = self.candidates(query, nprobe)
+        scores = self.vectors[candidates] @ query
+        k = min(k, len(candidates))
+        top = np.argpartition(scores, -k)[-k:]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return self.ids[candidates[top]], np.clip(scores[top], 0, None) ** self.zeta
+
+    def save(self, path=ANN_PATH):
+        tmp_path = path + '.%d.tmp.npz' % os.getpid()
+        np.savez(tmp_path, centroids=self.centroids, offsets=self.offsets,
+                 ids=self.ids, vectors=self.vectors, zeta=self.zeta)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=ANN_PATH):
+        with np.load(path) as f:
+            return cls(f['centroids'], f['offsets'], f['ids'], f['vectors'], int(f['zeta']))
+
+
+def load_index(path=ANN_PATH):
+    if not os.path.exists(path):
+        return None
+    return IVFIndex.load(path)
+
+
+if __name__ == '__main__':
+    import datasets
+
+    parser = argparse.ArgumentParser(description='Build the approximate nearest neighbour index')
+    parser.add_argument('--dataset', default=None)
+    parser.add_argument('--lists', type=int, default=None)
+    parser.add_argument('--out', default=None, help="default: the dataset's ann_index")
+    args = parser.parse_args()
+
+    registry = datasets.DatasetRegistry()
+    if args.dataset is not None and args.dataset not in registry.specs:
+        parser.error('unknown dataset %r' % args.dataset)
+    spec = registry.specs[args.dataset or registry.default]
+    descriptor_set = descriptors.load_descriptors(spec.get('descriptors', descriptors.DESCRIPTOR_PATH))
+    if descriptor_set is None:
+        parser.error('descriptors not built, run python descriptors.py build first')
+    # ids are rows of the library table, limited to the kernel's columns
+    library = spec['library']
+    names = pd.read_csv(library['file'])[library['id']].values[:spec['kernel']['library_columns']]
+    out = args.out or spec.get('ann_index', ANN_PATH)
+    index = IVFIndex.build(descriptor_set.rows(names), n_lists=args.lists)
+    index.save(out)
+    print('wrote %s (%d vectors in %d lists)' % (out, len(index.ids), index.n_lists))
@@ -0,0 +1,838 @@
+import argparse
+import gzip
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import psutil
+
+
+## Worker startup / memory
+def wait_ready(url, timeout):
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter() - start
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError('server did not come up within %d s' % timeout)
+
+
+def wait_workers(pid, workers, timeout):
+    start = time.perf_counter()
+    master = psutil.Process(pid)
+    while len(master.children()) < workers:
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError('only %d of %d workers started' % (len(master.children()), workers))
+        time.sleep(0.05)
+
+
+def tree_memory(pid):
+    # RSS double counts pages shared between workers, PSS splits them fairly
+    # and USS is what each additional worker really costs
+    procs = [psutil.Process(pid)] + psutil.Process(pid).children(recursive=True)
+    rss = pss = uss = 0
+    for proc in procs:
+        info = proc.memory_full_info()
+        rss += info.rss
+        pss += getattr(info, 'pss', info.rss)
+        uss += info.uss
+    return {'processes': len(procs), 'rss_mb': rss / 2**20,
+            'pss_mb': pss / 2**20, 'uss_mb': uss / 2**20}
+
+
+def bench_workers(args, env=None):
+    # env: environment of the gunicorn master, os.environ by default
+    results = []
+    for workers in args.workers:
+        worker_env = dict(env or os.environ, EXCHEM_KERNEL_MODE=args.mode,
+                          EXCHEM_KERNEL_BLOCK='1' if args.block else '0', EXCHEM_KERNEL_DTYPE=args.dtype)
+        cmd = ['gunicorn', '-w', str(workers), '-b', '127.0.0.1:%d' % args.port]
+        if args.preload:
+            cmd.append('--preload')
+        cmd.append('exchem:server')
+        proc = subprocess.Popen(cmd, env=worker_env, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        try:
+            startup = wait_ready('http://127.0.0.1:%d/' % args.port, args.timeout)
+            wait_workers(proc.pid, workers, args.timeout)
+            # let the remaining workers finish importing the app
+            time.sleep(args.settle)
+            result = {'workers': workers, 'mode': args.mode, 'block': args.block, 'dtype': args.dtype,
+                      'preload': args.preload, 'startup_s': startup}
+            result.update(tree_memory(proc.pid))
+            results.append(result)
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait()
+    return results
+
+
+## Concurrent callbacks
+def click_data(curve, point, customdata):
+    return {'points': [{'curveNumber': curve, 'pointNumber': point, 'customdata': customdata}]}
+
+
+def all_clicks(exchem, ds):
+    # clickData as sent by the scatter figure for every point
+    clicks = []
+    for curve, trace in enumerate(exchem.dataset_figure(ds.id)['data']):
+        # the library trace is empty in the cached figure
+        for point, customdata in enumerate(trace.get('customdata') or []):
+            clicks.append(click_data(curve, point, customdata))
+    return clicks
+
+
+def bench_concurrency(args):
+    # Fires neighbour searches (first table page) from many threads at once
+    # and checks that every response equals the serially computed one, i.e.
+    # requests are isolated
+    import exchem
+
+    ds = exchem.registry.get()
+    clicks = all_clicks(exchem, ds)
+
+    def first_page(click, no_rows):
+        query = exchem.update_neighbours(click, no_rows)
+        return exchem.table_page_response(ds.id, exchem.dataset_version(ds), query['row'], query['k'],
+                                          query['backend'], query['substructure'], 'max', 0, exchem.page_size,
+                                          [], '')
+
+    expected = {}
+    for n, click in enumerate(clicks):
+        for no_rows in args.rows:
+            expected[n, no_rows] = first_page(click, no_rows)
+
+    rng = random.Random(args.seed)
+    jobs = [(rng.randrange(len(clicks)), rng.choice(args.rows)) for _ in range(args.requests)]
+
+    def run(job):
+        n, no_rows = job
+        return first_page(clicks[n], no_rows) == expected[job]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        ok = list(pool.map(run, jobs))
+    elapsed = time.perf_counter() - start
+    result = {'threads': args.threads, 'requests': args.requests,
+              'mismatches': ok.count(False), 'elapsed_s': elapsed,
+              'requests_per_s': args.requests / elapsed}
+    if result['mismatches']:
+        print('%d responses were not isolated' % result['mismatches'], file=sys.stderr)
+        json.dump(result, sys.stdout, indent=2)
+        sys.exit(1)
+    return result
+
+
+## Interactions
+def dash_request(client, output, inputs, headers=None, changed=None, state=None):
+    # one server callback as posted by the browser; inputs and state are
+    # {(id, property): value} in the callback's order; returns server time,
+    # request / response bytes and the response
+    outputs = [{'id': o.split('.')[0], 'property': o.split('.')[1]} for o in output.strip('.').split('...')]
+    body = json.dumps({
+        'output': output,
+        'outputs': outputs if output.startswith('..') else outputs[0],
+        'inputs': [{'id': i, 'property': p, 'value': v} for (i, p), v in inputs.items()],
+        'changedPropIds': ['%s.%s' % key for key in (changed or inputs)],
+        'state': [{'id': i, 'property': p, 'value': v} for (i, p), v in (state or {}).items()],
+    })
+    start = time.perf_counter()
+    response = client.post('/_dash-update-component', data=body, content_type='application/json',
+                           headers=headers)
+    elapsed = time.perf_counter() - start
+    if response.status_code not in (200, 204):
+        raise RuntimeError('%s: HTTP %d' % (output, response.status_code))
+    return elapsed, len(body), len(response.data), response
+
+
+TABLE_PAGE = '..table.data...table.page_count...table.page_current..'
+
+
+def table_page_inputs(query, page=0, size=50, sort_by=None, filter_query=''):
+    return {('neighbours', 'data'): query, ('table', 'page_current'): page, ('table', 'page_size'): size,
+            ('table', 'sort_by'): sort_by or [], ('table', 'filter_query'): filter_query}
+
+
+def click_requests(client, ds, click, no_rows, headers=None):
+    # callbacks fired by clicking a compound: molecule viewer, neighbour
+    # search and the first page of the table; returns their dash_request
+    # results and the table rows
+    viewer = dash_request(client, '..my-speck.data...inh_text.children..', {
+        ('basic-interactions', 'clickData'): click, ('dataset', 'data'): ds.id}, headers)
+    search = dash_request(client, 'neighbours.data', {
+        ('basic-interactions', 'clickData'): click, ('dropdown', 'value'): no_rows,
+        ('similarity-backend', 'value'): 'kernel', ('dataset', 'data'): ds.id, ('substructure', 'value'): '',
+        ('basic-interactions', 'selectedData'): None, ('aggregate', 'value'): 'max'},
+        headers, state={('neighbours', 'data'): None})
+    query = json.loads(wire_decode(search[3]))['response']['neighbours']['data']
+    page = dash_request(client, TABLE_PAGE, table_page_inputs(query), headers)
+    rows = json.loads(wire_decode(page[3]))['response']['table']['data']
+    return {'molecule': viewer, 'neighbours': search, 'table_page': page}, rows
+
+
+def bench_interactions(args):
+    # Server time and payload of the callbacks a browser fires when clicking
+    # a compound (molecule viewer, neighbour search, table page) and when
+    # selecting another table row (one similar structure), with the response
+    # cache off
+    import response_cache
+    import exchem
+
+    response_cache.cache.enabled = False
+    ds = exchem.registry.get()
+    clicks = all_clicks(exchem, ds)
+    client = exchem.server.test_client()
+    totals = {'click': [], 'select': []}
+    for click in clicks:
+        for no_rows in args.rows:
+            requests, rows = click_requests(client, ds, click, no_rows)
+            totals['click'].append(np.sum([r[:3] for r in requests.values()], axis=0))
+            for selected in range(1, min(args.select, len(rows))):
+                totals['select'].append(dash_request(client, 'sim-speck.data', {
+                    ('similar-structure', 'data'): {'dataset': ds.id, 'name': rows[selected]['Filename']}})[:3])
+    return {
+        interaction: {
+            'interactions': len(values),
+            'server_ms': 1e3 * float(np.mean([v[0] for v in values])),
+            'request_bytes': float(np.mean([v[1] for v in values])),
+            'response_bytes': float(np.mean([v[2] for v in values])),
+        } for interaction, values in totals.items()
+    }
+
+
+def bench_pages(args):
+    # Latency and payload of table pages as K grows: the first page includes
+    # the neighbour search, a new sort order or filter queries the kept
+    # column arrays, further pages only slice the kept view
+    import response_cache
+    import exchem
+
+    response_cache.cache.enabled = False
+    ds = exchem.registry.get()
+    client = exchem.server.test_client()
+    rng = random.Random(args.seed)
+    views = [
+        {},
+        {'sort_by': [{'column_id': 'IE_krr', 'direction': 'desc'}]},
+        {'filter_query': '{IE_krr} > 40'},
+        {'filter_query': '{sim_val} >= 50 && {Filename} contains 1',
+         'sort_by': [{'column_id': 'Filename', 'direction': 'asc'}]},
+    ]
+    results = []
+    for k in args.k:
+        k = min(k, ds.sim.n_commercial)
+        first, views_ms, pages, sizes = [], [], [], []
+        for row in rng.sample(range(len(ds.compound_names)), args.references):
+            exchem.neighbour_table.cache_clear()
+            exchem.neighbour_view.cache_clear()
+            query = {'dataset': ds.id, 'row': row, 'k': k, 'backend': 'kernel'}
+            first.append(dash_request(client, TABLE_PAGE, table_page_inputs(query, size=args.page_size))[0])
+            n_pages = -(-k // args.page_size)
+            for view in views:
+                views_ms.append(dash_request(client, TABLE_PAGE, table_page_inputs(query, 0, args.page_size, **view))[0])
+                for page in [rng.randrange(n_pages) for _ in range(args.pages)]:
+                    elapsed, _, size, _ = dash_request(
+                        client, TABLE_PAGE, table_page_inputs(query, page, args.page_size, **view),
+                        changed=[('table', 'page_current')])
+                    pages.append(elapsed)
+                    sizes.append(size)
+        results.append({
+            'k': k, 'page_size': args.page_size,
+            'search_ms': 1e3 * float(np.mean(first)),
+            'sort_filter_ms': 1e3 * float(np.mean(views_ms)),
+            'page_ms': 1e3 * float(np.mean(pages)),
+            'page_p95_ms': 1e3 * float(np.percentile(pages, 95)),
+            'response_bytes': float(np.mean(sizes)),
+        })
+    return results
+
+
+def wire_decode(response):
+    data = response.data
+    if response.headers.get('Content-Encoding') == 'gzip':
+        return gzip.decompress(data)
+    if response.headers.get('Content-Encoding') == 'br':
+        import brotli
+        return brotli.decompress(data)
+    return data
+
+
+def wire_bytes(response):
+    # transferred and decoded size of a response
+    return len(response.data), len(wire_decode(response))
+
+
+def bench_payload(args):
+    # Bytes of the initial page load (index, layout, dependencies and the
+    # initial callbacks, without the cacheable JS bundles) and per compound
+    # click, as transferred with the given Accept-Encoding and decoded
+    import exchem
+
+    ds = exchem.registry.get()
+    client = exchem.server.test_client()
+    headers = {'Accept-Encoding': args.encoding} if args.encoding else {}
+    click = all_clicks(exchem, ds)[args.point]
+
+    def callbacks(click):
+        requests, rows = click_requests(client, ds, click, args.rows, headers)
+        structure = dash_request(client, 'sim-speck.data', {
+            ('similar-structure', 'data'): {'dataset': ds.id, 'name': rows[0]['Filename']}}, headers)
+        requests['similar_structure'] = structure
+        return {name: request[3] for name, request in requests.items()}
+
+    page = {path: client.get(path, headers=headers) for path in ['/', '/_dash-layout', '/_dash-dependencies']}
+    page['figure'] = dash_request(client, '..basic-interactions.figure...dataset-title.children..',
+                                  {('dataset', 'data'): ds.id}, headers)[3]
+    page.update(callbacks(None))
+    clicked = callbacks(click)
+
+    def report(responses):
+        sizes = {name: wire_bytes(response) for name, response in responses.items()}
+        return {'responses': {name: {'wire_bytes': w, 'bytes': b} for name, (w, b) in sizes.items()},
+                'wire_bytes': sum(w for w, _ in sizes.values()), 'bytes': sum(b for _, b in sizes.values())}
+
+    return {'encoding': args.encoding, 'k': args.rows, 'page_load': report(page), 'click': report(clicked)}
+
+
+## Kernel storage types
+def bench_kernel_dtype(args):
+    # Top-K lists and displayed similarities of every reference from float32
+    # / uint16 reference blocks against the float64 kernel. Swapped neighbours
+    # only count as ties if their exact similarities differ by less than the
+    # storage resolution; anything else fails the check.
+    import kernel_store
+    import neighbour_index
+    import exchem
+
+    spec = exchem.registry.specs[exchem.registry.default]['kernel']
+    layout = {'ref_offset': spec['reference_offset'], 'n_commercial': spec['library_columns']}
+    exact = kernel_store.load_kernel(spec['file'], **layout)
+    rows = range(exact.n_reference)
+    expected = {row: exchem.simbapre_batch(exact, [row], args.k)[0][0] for row in rows}
+
+    results = []
+    for dtype in args.dtype:
+        start = time.perf_counter()
+        kernel = kernel_store.load_kernel(spec['file'], dtype=dtype, **layout)
+        kernel.neighbours = neighbour_index.load_index(kernel)
+        load_s = time.perf_counter() - start
+        start = time.perf_counter()
+        np.asarray(kernel.rows(list(rows))).sum()
+        page_in_s = time.perf_counter() - start
+        resolution = {'float64': 0, 'float32': 1e-7, 'uint16': kernel_store.U16_SCALE}[dtype]
+
+        order, ties, displayed, max_error = 0, 0, 0, 0.0
+        for row in rows:
+            idx = exchem.simbapre(kernel, None, row, args.k)
+            scores = kernel.row(row)[idx]
+            exact_row = exact.row(row)
+            if not np.array_equal(idx, expected[row]):
+                gap = np.abs(exact_row[idx] - exact_row[expected[row]]).max()
+                if gap <= resolution:
+                    ties += 1
+                else:
+                    order += 1
+            displayed += int((exchem.sim_percent(scores) != exchem.sim_percent(exact_row[idx])).sum())
+            max_error = max(max_error, float(np.abs(np.asarray(scores, dtype=np.float64) - exact_row[idx]).max()))
+        results.append({
+            'dtype': dtype, 'k': args.k, 'references': len(rows),
+            'block_mb': kernel.nbytes / 2**20, 'kernel_mb': exact.nbytes / 2**20,
+            'load_s': load_s, 'page_in_ms': 1e3 * page_in_s,
+            'order_mismatches': order, 'tie_swaps': ties, 'displayed_mismatches': displayed,
+            'max_abs_error': max_error,
+        })
+    if any(r['order_mismatches'] or r['displayed_mismatches'] for r in results):
+        json.dump(results, sys.stdout, indent=2)
+        sys.exit('converted kernel changes the top-%d lists or displayed values' % args.k)
+    return results
+
+
+def bench_kernel_factor(args):
+    # Low-rank factors of growing rank against the exact kernel, for every
+    # reference compound: overlap of the top-K lists and error of the
+    # similarities (whole row and top-K), plus size and row query time
+    import kernel_store
+    import exchem
+
+    spec = exchem.registry.specs[exchem.registry.default]['kernel']
+    layout = {'ref_offset': spec['reference_offset'], 'n_commercial': spec['library_columns']}
+    exact = kernel_store.load_kernel(spec['file'], **layout)
+    rows = list(range(exact.n_reference))
+    exact_rows = np.asarray(exact.rows(rows), dtype=np.float64)
+    expected = np.argsort(-exact_rows, axis=1, kind='stable')[:, :args.k]
+
+    def row_ms(kernel):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for row in rows:
+                # max() reads the memory-mapped row of the exact kernel
+                kernel.row(row).max()
+        return 1e3 * (time.perf_counter() - start) / (args.repeat * len(rows))
+
+    results = []
+    for rank in args.rank:
+        start = time.perf_counter()
+        with kernel_store.locked(spec['file']):
+            kernel_store.write_factor(spec['file'], kernel_store.factor_path(spec['file'], rank), rank,
+                                      spec['reference_offset'], method=args.method, landmarks=args.landmarks)
+        build_s = time.perf_counter() - start
+        kernel = kernel_store.load_kernel(spec['file'], rank=rank, **layout)
+        approx = np.asarray(kernel.rows(rows), dtype=np.float64)
+        error = np.abs(approx - exact_rows)
+        per_reference = []
+        for row in rows:
+            found = np.argsort(-approx[row], kind='stable')[:args.k]
+            per_reference.append({
+                'compound': exchem.registry.get().compound_names[row],
+                'overlap': recall(found, expected[row]),
+                'top_k_mean_abs_error': float(np.abs(approx[row, found] - exact_rows[row, found]).mean()),
+                'max_abs_error': float(error[row].max()),
+            })
+        overlaps = np.array([r['overlap'] for r in per_reference])
+        result = {
+            'rank': kernel.rank, 'method': args.method, 'k': args.k, 'references': len(rows),
+            'factor_mb': kernel.nbytes / 2**20, 'kernel_mb': exact.nbytes / 2**20,
+            'block_mb': exact.n_reference * exact.n_commercial * 8 / 2**20, 'build_s': build_s,
+            'row_ms': row_ms(kernel), 'exact_row_ms': row_ms(exact),
+            'mean_overlap': float(overlaps.mean()), 'min_overlap': float(overlaps.min()),
+            'exact_top_k_lists': int((overlaps == 1).sum()),
+            'mean_abs_error': float(error.mean()), 'max_abs_error': float(error.max()),
+            'worst': sorted(per_reference, key=lambda r: r['overlap'])[:5],
+        }
+        if args.per_reference:
+            result['per_reference'] = per_reference
+        results.append(result)
+    return results
+
+
+## Compound lookup
+def bench_lookup(args):
+    import pandas as pd
+    import exchem
+
+    ds = exchem.registry.get()
+    names = ds.compound_names
+    # correctness: tests/test_search.py
+    def regex_find_idx(compound, df):
+        return df[df['compound'].str.match(compound)].index.values.astype(int)[0]
+
+    def timed(func):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for name in names:
+                func(name)
+        return (time.perf_counter() - start) / (args.repeat * len(names))
+
+    df = pd.DataFrame({'compound': names})
+    return {
+        'names': len(names),
+        'regex_match_us': 1e6 * timed(lambda name: regex_find_idx(name, df)),
+        'dict_lookup_us': 1e6 * timed(lambda name: exchem.find_idx(name, ds.compound_rows)),
+    }
+
+
+def bench_consensus(args):
+    # Consensus search over a growing selection of reference compounds: one
+    # blockwise pass over their kernel rows vs. one row per reference, both
+    # must give the same ranking; then the whole selection callback
+    import response_cache
+    import exchem
+
+    response_cache.cache.enabled = False
+    ds = exchem.registry.get()
+    rng = np.random.default_rng(args.seed)
+    client = exchem.server.test_client()
+    results = []
+    for n in args.references:
+        rows = tuple(sorted(rng.choice(len(ds.compound_names), min(n, len(ds.compound_names)), replace=False)))
+        result = {'references': len(rows)}
+        for aggregate in exchem.AGGREGATES:
+            try:
+                weights = exchem.consensus_weights(ds, rows, aggregate)
+            except ValueError:
+                continue
+
+            def per_reference():
+                scores = [np.asarray(ds.sim.row(row), dtype=np.float64) for row in rows]
+                if weights is None:
+                    return np.max(scores, axis=0)
+                return sum(w * score for w, score in zip(weights, scores))
+
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                expected = exchem.top_columns(per_reference(), args.k)
+            loop_ms = 1e3 * (time.perf_counter() - start) / args.repeat
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                found = exchem.search_neighbours(ds, rows, args.k, aggregate=aggregate)
+            if not np.allclose(found[1], expected[1]) or recall(found[0], expected[0]) < 1:
+                raise AssertionError('%s of %d references differs from the per-reference search' % (
+                    aggregate, len(rows)))
+            result[aggregate + '_ms'] = 1e3 * (time.perf_counter() - start) / args.repeat
+            result[aggregate + '_per_reference_ms'] = loop_ms
+        selection = {'points': [{'curveNumber': 1, 'pointNumber': n, 'customdata': int(row)}
+                                for n, row in enumerate(rows)]}
+        search = dash_request(client, 'neighbours.data', {
+            ('basic-interactions', 'clickData'): None, ('dropdown', 'value'): str(args.k),
+            ('similarity-backend', 'value'): 'kernel', ('dataset', 'data'): ds.id, ('substructure', 'value'): '',
+            ('basic-interactions', 'selectedData'): selection, ('aggregate', 'value'): 'mean'},
+            changed=[('basic-interactions', 'selectedData')], state={('neighbours', 'data'): None})
+        query = json.loads(wire_decode(search[3]))['response']['neighbours']['data']
+        page = dash_request(client, TABLE_PAGE, table_page_inputs(query))
+        result['selection_ms'] = 1e3 * (search[0] + page[0])
+        results.append(result)
+    return results
+
+
+## Approximate nearest neighbours
+def recall(found, exact):
+    return len(set(found.tolist()) & set(exact.tolist())) / len(exact)
+
+
+def bench_ann(args):
+    # recall@K of the IVF index against the exact kernel top-K (which also
+    # includes the descriptor vs. SOAP kernel difference) and against a
+    # brute-force scan over the same descriptors (the IVF error alone)
+    import ann_index
+    import exchem
+
+    ds = exchem.registry.get()
+    model = exchem.oos_model(ds)
+    index = ann_index.load_index(ds.spec.get('ann_index', ann_index.ANN_PATH))
+    if model is None or index is None:
+        sys.exit('build descriptors and index first: python descriptors.py build && python ann_index.py')
+    references = model['descriptors'].rows(ds.compound_names)
+    rows = range(len(ds.compound_names))
+    exact_kernel = {row: exchem.simbapre_batch(ds.sim, [row], args.k)[0][0] for row in rows}
+    exact_descriptor = {}
+    start = time.perf_counter()
+    for row in rows:
+        scores = references[row] @ index.vectors.T
+        exact_descriptor[row] = index.ids[np.argsort(-scores, kind='stable')[:args.k]]
+    brute_force_ms = 1e3 * (time.perf_counter() - start) / len(rows)
+
+    results = []
+    for nprobe in args.nprobe:
+        start = time.perf_counter()
+        found = {row: index.search(references[row], args.k, nprobe)[0] for row in rows}
+        latency_ms = 1e3 * (time.perf_counter() - start) / len(rows)
+        results.append({
+            'k': args.k, 'nprobe': nprobe, 'n_lists': index.n_lists, 'latency_ms': latency_ms,
+            'brute_force_ms': brute_force_ms,
+            'recall_vs_kernel': float(np.mean([recall(found[row], exact_kernel[row]) for row in rows])),
+            'recall_vs_descriptors': float(np.mean([recall(found[row], exact_descriptor[row]) for row in rows])),
+        })
+    return results
+
+
+## Suite on synthetic data
+def synthetic_dataset(directory, n, seed=0, dim=16, zeta=2, chunk=8192, square=False):
+    # Reference compounds of inh_data.csv against a library of n compounds
+    # (rows of structures_commercial.csv repeated, so structures exist, with
+    # random predicted IE) and a kernel from clustered random unit vectors,
+    # (x.y + 1)^zeta / 2^zeta in [0, 1]. Written once per (n, seed) next to
+    # a manifest for EXCHEM_DATASETS, which is written last. The kernel is
+    # the reference x library block, or with `square` the full kernel of
+    # library and reference compounds in the layout of K_c3_g1_commercial.npy
+    # (reference rows after the library ones), which a low-rank factor needs.
+    import pandas as pd
+    import datasets
+    import kernel_store
+    import neighbour_index
+
+    name = '%d-%d%s' % (n, seed, '-square' if square else '')
+    manifest_path = os.path.abspath(os.path.join(directory, 'datasets-%s.json' % name))
+    if os.path.exists(manifest_path):
+        return manifest_path
+    os.makedirs(directory, exist_ok=True)
+    with open(datasets.MANIFEST_PATH) as f:
+        manifest = json.load(f)
+    spec = next(d for d in manifest['datasets'] if d['id'] == manifest['default'])
+    rng = np.random.default_rng(seed)
+
+    reference = pd.read_csv(spec['reference']['file'])
+    library = pd.read_csv(spec['library']['file'])
+    library = library.iloc[np.arange(n) % len(library)].reset_index(drop=True)
+    library[spec['library']['property']] = rng.uniform(-100, 100, n).round()
+    library_path = os.path.abspath(os.path.join(directory, 'library-%s.csv' % name))
+    library.to_csv(library_path, index=False)
+
+    centres = rng.standard_normal((64, dim))
+
+    def points(count):
+        x = centres[rng.integers(len(centres), size=count)] + 0.5 * rng.standard_normal((count, dim))
+        return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+    kernel_path = os.path.abspath(os.path.join(directory, 'kernel-%s.npy' % name))
+    refs = points(len(reference))
+    if square:
+        x = np.concatenate([points(n), refs])
+        ref_offset = n
+        kernel = np.lib.format.open_memmap(kernel_path, mode='w+', dtype=np.float64, shape=(len(x), len(x)))
+        for start in range(0, len(x), chunk):
+            kernel[start:start + chunk] = ((x[start:start + chunk] @ x.T + 1) / 2) ** zeta
+    else:
+        # reference rows x library columns, i.e. already the kernel block
+        ref_offset = 0
+        kernel = np.lib.format.open_memmap(kernel_path, mode='w+', dtype=np.float64, shape=(len(reference), n))
+        for start in range(0, n, chunk):
+            kernel[:, start:start + chunk] = ((refs @ points(min(chunk, n - start)).T + 1) / 2) ** zeta
+    kernel.flush()
+    del kernel
+    neighbour_index.load_index(kernel_store.load_kernel(kernel_path, ref_offset=ref_offset, n_commercial=n))
+
+    title = 'Synthetic library (N=%d%s)' % (n, ', full kernel' if square else '')
+    spec = dict(spec, id='synthetic-%d%s' % (n, '-square' if square else ''), title=title,
+                structures=os.path.abspath(spec.get('structures', 'structures')))
+    spec['reference'] = dict(spec['reference'], file=os.path.abspath(spec['reference']['file']))
+    spec['library'] = dict(spec['library'], file=library_path)
+    spec['kernel'] = {'file': kernel_path, 'reference_offset': ref_offset, 'library_columns': n}
+    for key in ('descriptors', 'ann_index'):
+        spec.pop(key, None)
+    tmp_path = manifest_path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'w') as f:
+        json.dump({'default': spec['id'], 'datasets': [spec]}, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    return manifest_path
+
+
+def click_summary(clicks):
+    # mean and p95 of whole clicks plus the mean of every callback, in ms
+    totals = [sum(click.values()) for click in clicks]
+    summary = {'mean': float(np.mean(totals)), 'p95': float(np.percentile(totals, 95))}
+    summary.update({name: float(np.mean([click[name] for click in clicks])) for name in clicks[0]})
+    return summary
+
+
+def bench_clicks(args):
+    # Import, dataset load, cold and warm clicks (response cache empty /
+    # filled) and click throughput from --threads threads with the response
+    # cache off, for the default dataset of EXCHEM_DATASETS, in this process
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.setdefault('EXCHEM_RESPONSE_CACHE', os.path.join(tmp, 'responses.sqlite'))
+        start = time.perf_counter()
+        import exchem
+        import response_cache
+        startup = time.perf_counter() - start
+        start = time.perf_counter()
+        ds = exchem.registry.get()
+        load = time.perf_counter() - start
+
+        clicks = all_clicks(exchem, ds)
+        rng = random.Random(args.seed)
+        sample = rng.sample(clicks, min(args.references, len(clicks)))
+        client = exchem.server.test_client()
+
+        def click_ms(click):
+            requests, _ = click_requests(client, ds, click, args.rows)
+            return {name: 1e3 * request[0] for name, request in requests.items()}
+
+        cold = [click_ms(click) for click in sample]
+        warm = [click_ms(click) for click in sample]
+
+        response_cache.cache.enabled = False
+        jobs = [rng.choice(clicks) for _ in range(args.requests)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.threads) as pool:
+            list(pool.map(lambda click: click_requests(exchem.server.test_client(), ds, click, args.rows), jobs))
+        elapsed = time.perf_counter() - start
+
+        return {
+            'n': ds.sim.n_commercial, 'references': ds.sim.n_reference, 'rows': args.rows,
+            'startup_s': startup, 'load_s': load,
+            'cold_click_ms': click_summary(cold), 'warm_click_ms': click_summary(warm),
+            'threads': args.threads, 'clicks_per_s': args.requests / elapsed,
+            'rss_mb': psutil.Process().memory_info().rss / 2**20,
+        }
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'diff', '--quiet', 'HEAD', '--', '*.py'], capture_output=True).returncode
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def bench_suite(args):
+    # clicks (in a fresh process) and gunicorn memory per worker for
+    # synthetic libraries of every N, as one JSON document to keep per commit
+    import platform
+
+    results = []
+    for n in args.n:
+        manifest = synthetic_dataset(args.dir, n, args.seed)
+        cache_dir = os.path.join(args.dir, 'cache-%d' % n)
+        response_path = os.path.join(cache_dir, 'responses.sqlite')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(response_path + suffix):
+                os.remove(response_path + suffix)
+        env = dict(os.environ, EXCHEM_DATASETS=manifest, EXCHEM_CACHE_DIR=cache_dir,
+                   EXCHEM_RESPONSE_CACHE=response_path, EXCHEM_METRICS='0')
+        env.pop('EXCHEM_PRELOAD_DATASETS', None)
+        cmd = [sys.executable, os.path.abspath(__file__), 'clicks', '--rows', args.rows,
+               '--references', str(args.references), '--requests', str(args.requests),
+               '--threads', str(args.threads), '--seed', str(args.seed)]
+        result = json.loads(subprocess.run(cmd, env=env, capture_output=True, text=True, check=True).stdout)
+        if args.workers:
+            workers = argparse.Namespace(workers=args.workers, mode='mmap', block=False, dtype='float64',
+                                         preload=True, port=args.port, timeout=args.timeout, settle=args.settle)
+            result['workers'] = bench_workers(workers, dict(env, EXCHEM_PRELOAD_DATASETS='default'))
+        results.append(result)
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(), 'numpy': np.__version__,
+        'machine': platform.machine(), 'cpus': os.cpu_count(),
+        'seed': args.seed, 'results': results,
+    }
+
+
+def flatten(result, prefix=''):
+    values = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, list) and all(isinstance(item, dict) for item in value):
+            for i, item in enumerate(value):
+                values.update(flatten(item, '%s%s.%d.' % (prefix, key, i)))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+
+def bench_compare(args):
+    # new / old of every number of two suite runs, per N
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    old_results = {result['n']: flatten(result) for result in old['results']}
+    comparison = {'old': old['commit'], 'new': new['commit'], 'results': []}
+    for result in new['results']:
+        if result['n'] not in old_results:
+            continue
+        before, after = old_results[result['n']], flatten(result)
+        comparison['results'].append({'n': result['n'], 'ratio': {
+            key: after[key] / before[key] for key in after if key in before and before[key]}})
+    return comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ExChem benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('workers', help='gunicorn startup time and memory per worker count')
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    p.add_argument('--mode', choices=['mmap', 'shm', 'memory'], default='mmap')
+    p.add_argument('--block', action='store_true')
+    p.add_argument('--dtype', choices=['float64', 'float32', 'uint16'], default='float64')
+    p.add_argument('--preload', action='store_true')
+    p.add_argument('--port', type=int, default=8765)
+    p.add_argument('--timeout', type=float, default=120)
+    p.add_argument('--settle', type=float, default=10)
+    p.set_defaults(func=bench_workers)
+
+    p = sub.add_parser('concurrency', help='parallel neighbour searches, checks isolation')
+    p.add_argument('--threads', type=int, default=16)
+    p.add_argument('--requests', type=int, default=5000)
+    p.add_argument('--rows', nargs='+', default=['5', '10', '20', '50'])
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_concurrency)
+
+    p = sub.add_parser('interactions', help='server time and payload per click / table row selection')
+    p.add_argument('--rows', nargs='+', default=['10', '50'])
+    p.add_argument('--select', type=int, default=5)
+    p.set_defaults(func=bench_interactions)
+
+    p = sub.add_parser('pages', help='table page latency and payload for growing K')
+    p.add_argument('--k', type=int, nargs='+', default=[10, 100, 1000, 7093])
+    p.add_argument('--page-size', type=int, default=50)
+    p.add_argument('--references', type=int, default=10)
+    p.add_argument('--pages', type=int, default=5)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_pages)
+
+    p = sub.add_parser('payload', help='bytes of the initial page load and per click')
+    p.add_argument('--encoding', default='gzip', help="Accept-Encoding header, '' for none")
+    p.add_argument('--rows', default='10')
+    p.add_argument('--point', type=int, default=0)
+    p.set_defaults(func=bench_payload)
+
+    p = sub.add_parser('kernel-dtype', help='top-K order and displayed values of float32 / uint16 kernels')
+    p.add_argument('--dtype', nargs='+', default=['float32', 'uint16'])
+    p.add_argument('--k', type=int, default=50)
+    p.set_defaults(func=bench_kernel_dtype)
+
+    p = sub.add_parser('kernel-factor', help='top-K overlap and similarity error of low-rank kernel factors')
+    p.add_argument('--rank', type=int, nargs='+', default=[32, 64, 128, 256])
+    p.add_argument('--method', choices=['nystroem', 'eigen'], default='nystroem')
+    p.add_argument('--landmarks', type=int, default=None)
+    p.add_argument('--k', type=int, default=50)
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--per-reference', action='store_true', help='report every reference compound')
+    p.set_defaults(func=bench_kernel_factor)
+
+    p = sub.add_parser('lookup', help='compound name lookup, regex match vs. row index')
+    p.add_argument('--repeat', type=int, default=20)
+    p.set_defaults(func=bench_lookup)
+
+    p = sub.add_parser('consensus', help='search by the similarity to a box / lasso selection of references')
+    p.add_argument('--references', type=int, nargs='+', default=[2, 10, 50, 150])
+    p.add_argument('--k', type=int, default=50)
+    p.add_argument('--repeat', type=int, default=20)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_consensus)
+
+    p = sub.add_parser('ann', help='recall@K vs. latency of the ANN index')
+    p.add_argument('--k', type=int, default=10)
+    p.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    p.set_defaults(func=bench_ann)
+
+    p = sub.add_parser('clicks', help='startup, cold / warm click latency and click throughput')
+    p.add_argument('--rows', default='10')
+    p.add_argument('--references', type=int, default=20)
+    p.add_argument('--requests', type=int, default=200)
+    p.add_argument('--threads', type=int, default=8)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_clicks)
+
+    p = sub.add_parser('suite', help='clicks and worker memory on synthetic libraries of growing N')
+    p.add_argument('--n', type=int, nargs='+', default=[1000, 10000, 100000])
+    p.add_argument('--dir', default=os.path.join('.cache', 'bench'))
+    p.add_argument('--rows', default='10')
+    p.add_argument('--references', type=int, default=20)
+    p.add_argument('--requests', type=int, default=200)
+    p.add_argument('--threads', type=int, default=8)
+    p.add_argument('--workers', type=int, nargs='*', default=[1, 4])
+    p.add_argument('--port', type=int, default=8765)
+    p.add_argument('--timeout', type=float, default=120)
+    p.add_argument('--settle', type=float, default=2)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_suite)
+
+    p = sub.add_parser('compare', help='ratios new / old of two suite results')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.set_defaults(func=bench_compare)
+
+    args = parser.parse_args(argv)
+    json.dump(args.func(args), sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
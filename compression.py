@@ -0,0 +1,79 @@
+import collections
+import gzip
+import os
+import threading
+
+import flask
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Response compression as a Flask after_request hook: brotli if the module is
+# installed and accepted by the client, gzip otherwise. Streamed responses
+# (ndjson) and files are passed through. Component suites (the Dash and
+# plotly.js bundles) are compressed once per URL and served from memory.
+# EXCHEM_COMPRESS=0 leaves compression to a reverse proxy.
+ENABLED = os.environ.get('EXCHEM_COMPRESS', '1') == '1'
+GZIP_LEVEL = int(os.environ.get('EXCHEM_GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('EXCHEM_BROTLI_QUALITY', '5'))
+MIN_SIZE = 512
+COMPRESSIBLE = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+STATIC_PREFIX = '/_dash-component-suites/'
+
+_static = collections.OrderedDict()
+_static_lock = threading.Lock()
+_static_size = 64
+
+
+def _encoding(accept):
+    accepted = {value.split(';')[0].strip() for value in accept.split(',')}
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def _compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def compress_response(response):
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or not (response.mimetype or '').startswith(COMPRESSIBLE)):
+        return response
+    encoding = _encoding(flask.request.headers.get('Accept-Encoding', ''))
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < MIN_SIZE:
+        return response
+
+    if flask.request.path.startswith(STATIC_PREFIX):
+        key = (flask.request.full_path, response.get_etag()[0], encoding)
+        with _static_lock:
+            compressed = _static.get(key)
+        if compressed is None:
+            compressed = _compress(data, encoding)
+            with _static_lock:
+                _static[key] = compressed
+                while len(_static) > _static_size:
+                    _static.popitem(last=False)
+    else:
+        compressed = _compress(data, encoding)
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_app(server):
+    if ENABLED:
+        server.after_request(compress_response)
@@ -0,0 +1,177 @@
+import collections
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import kernel_store
+import krr
+import neighbour_index
+import startup
+
+
+# Structure-property landscapes served by the app, described in
+# datasets.json: reference compounds with sketch-map coordinates and
+# measured property, library of compounds with predicted property, and the
+# kernel with the row/column blocks linking both. Datasets are loaded on
+# first use and the least recently used ones are evicted once the loaded
+# datasets exceed EXCHEM_DATASET_BUDGET_MB (0 = no limit).
+MANIFEST_PATH = os.environ.get('EXCHEM_DATASETS', 'datasets.json')
+BUDGET_MB = float(os.environ.get('EXCHEM_DATASET_BUDGET_MB', '0'))
+# seconds between checks for a newly activated KRR prediction version
+PREDICTIONS_INTERVAL = float(os.environ.get('EXCHEM_PREDICTIONS_INTERVAL', '2'))
+
+
+def row_index(values):
+    # exact name -> first row lookup
+    index = {}
+    for row, value in enumerate(values):
+        index.setdefault(value, row)
+    return index
+
+
+class Dataset:
+    def __init__(self, spec):
+        self.spec = spec
+        self.id = spec['id']
+        self.title = spec['title']
+        self.structures = spec.get('structures', 'structures')
+        # lazily built per-dataset artefacts (figure, descriptor models, ...)
+        self.cache = {}
+        self.lock = threading.RLock()
+
+        ref = spec['reference']
+        with startup.phase('%s: reference table' % self.id):
+            data = pd.read_csv(ref['file'])
+        data[ref['property']] = data[ref['property']].round(decimals=0)
+        self.data = data
+        self.untested = data[data[ref['label']].isin(ref['untested_labels'])]
+        self.tested = data[data[ref['label']].isin(ref['tested_labels'])]
+        self.train = data[data[ref['label']].isin(ref['train_labels'])]
+        self.compound_names = data[ref['name']].values
+        self.compound_rows = row_index(self.compound_names)
+        self.properties = data[ref['property']].values
+        self.default_row = self.compound_rows[ref['default']]
+
+        lib = spec['library']
+        with startup.phase('%s: library table' % self.id):
+            struc = pd.read_csv(lib['file'])
+        struc[lib['property']] = struc[lib['property']].round(decimals=0)
+        # read-only column arrays for assembling table rows, under the
+        # column ids of the neighbour table
+        self.struc_columns = {
+            'Filename': struc[lib['id']].values,
+            'Identifier': struc[lib['smiles']].values,
+            'IE_krr': struc[lib['property']].values,
+        }
+        self.cas_rows = row_index(self.struc_columns['Filename'])
+        self.library_property = self.struc_columns['IE_krr']
+        # active krr.py prediction version (None: the library file column)
+        # and its file
+        self.predictions = None
+        self.predictions_path = None
+        self.predictions_checked = None
+        self.refresh_predictions()
+
+        kernel = spec['kernel']
+        with startup.phase('%s: kernel' % self.id):
+            self.sim = kernel_store.load_kernel(
+                kernel['file'], ref_offset=kernel['reference_offset'],
+                n_commercial=kernel['library_columns'], **kernel_store.options_from_env())
+        with startup.phase('%s: neighbour index' % self.id):
+            self.sim.neighbours = neighbour_index.load_index(self.sim)
+
+    def refresh_predictions(self):
+        # swaps the library property column when another version has been
+        # activated; the columns dict is replaced, never modified, so
+        # requests holding the old one finish with consistent data
+        now = time.monotonic()
+        if self.predictions_checked is not None and now - self.predictions_checked < PREDICTIONS_INTERVAL:
+            return
+        self.predictions_checked = now
+        current = krr.current_version(krr.prediction_dir(self.spec))
+        version = current[0] if current is not None else None
+        if version == self.predictions:
+            return
+        values = self.library_property
+        if current is not None:
+            try:
+                predictions, _ = krr.load_predictions(current[1])
+            except (OSError, ValueError, KeyError):
+                return
+            values = values.copy()
+            values[:len(predictions)] = np.round(predictions, decimals=0)
+        with self.lock:
+            self.struc_columns = dict(self.struc_columns, IE_krr=values)
+            self.predictions = version
+            self.predictions_path = current[1] if current is not None else None
+            # response cache keys cover the prediction file
+            self.cache.pop('version', None)
+
+    def column(self, key):
+        # reference column by its manifest key, e.g. 'x', 'y' or 'property'
+        return self.data[self.spec['reference'][key]]
+
+    @property
+    def nbytes(self):
+        frames = self.data.memory_usage(deep=True).sum()
+        columns = sum(values.nbytes for values in self.struc_columns.values())
+        neighbours = self.sim.neighbours.idx.nbytes + self.sim.neighbours.scores.nbytes
+        return int(frames + columns + neighbours + self.sim.nbytes)
+
+
+class DatasetRegistry:
+    def __init__(self, path=MANIFEST_PATH, budget_mb=BUDGET_MB):
+        with open(path) as f:
+            manifest = json.load(f)
+        self.specs = collections.OrderedDict((spec['id'], spec) for spec in manifest['datasets'])
+        self.default = manifest.get('default', next(iter(self.specs)))
+        self.budget = budget_mb * 2**20
+        self.loaded = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.loading = collections.defaultdict(threading.Lock)
+
+    def titles(self):
+        return [(dataset_id, spec['title']) for dataset_id, spec in self.specs.items()]
+
+    def get(self, dataset_id=None):
+        dataset_id = dataset_id or self.default
+        if dataset_id not in self.specs:
+            raise KeyError('Unknown dataset: %s' % dataset_id)
+        with self.lock:
+            dataset = self.loaded.get(dataset_id)
+            if dataset is not None:
+                self.loaded.move_to_end(dataset_id)
+            loading = self.loading[dataset_id]
+        if dataset is not None:
+            dataset.refresh_predictions()
+            return dataset
+        # load outside the registry lock, other datasets stay available
+        with loading:
+            with self.lock:
+                if dataset_id in self.loaded:
+                    return self.loaded[dataset_id]
+            dataset = Dataset(self.specs[dataset_id])
+            with self.lock:
+                self.loaded[dataset_id] = dataset
+                self._evict(keep=dataset_id)
+        return dataset
+
+    def _evict(self, keep):
+        # drop least recently used datasets until the budget is met;
+        # requests still holding a reference finish with it undisturbed
+        if not self.budget:
+            return
+        while sum(d.nbytes for d in self.loaded.values()) > self.budget and len(self.loaded) > 1:
+            oldest = next(iter(self.loaded))
+            if oldest == keep:
+                self.loaded.move_to_end(oldest)
+                continue
+            del self.loaded[oldest]
+
+    def memory(self):
+        with self.lock:
+            return {dataset_id: d.nbytes for dataset_id, d in self.loaded.items()}
@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import structure_store
+
+
+# SOAP-style structure descriptors for out-of-sample similarity queries.
+# For every atom the neighbour density within the cutoff is expanded in
+# Gaussian radial functions; the rotationally invariant power spectrum
+#   p[a, b, n, m, l] = sum_jk g_n(r_ij) g_m(r_ik) P_l(cos theta_jik)
+# (j of species a, k of species b) is averaged over all atoms, normalised,
+# and compared with the polynomial kernel (p . p')^zeta. One new structure
+# is therefore scored against the library with a single matrix-vector
+# product instead of recomputing the full kernel.
+SPECIES = ['H', 'C', 'N', 'O', 'S', 'P']
+PARAMS = {'cutoff': 3.0, 'sigma': 0.5, 'n_max': 4, 'l_max': 2, 'zeta': 2, 'species': SPECIES}
+
+DESCRIPTOR_PATH = os.environ.get('EXCHEM_DESCRIPTORS', 'descriptors.npy')
+
+
+def _legendre(x, l_max):
+    p = [np.ones_like(x), x]
+    for l in range(1, l_max):
+        p.append(((2 * l + 1) * x * p[l] - l * p[l - 1]) / (l + 1))
+    return p[:l_max + 1]
+
+
+def soap_descriptor(atoms, params=PARAMS):
+    species = params['species']
+    cutoff, n_max, l_max = params['cutoff'], params['n_max'], params['l_max']
+    n_species = len(species)
+
+    pos = np.array([[atom['x'], atom['y'], atom['z']] for atom in atoms])
+    onehot = np.zeros((len(atoms), n_species))
+    for i, atom in enumerate(atoms):
+        if atom['symbol'] in species:
+            onehot[i, species.index(atom['symbol'])] = 1
+
+    diff = pos[None, :, :] - pos[:, None, :]
+    dist = np.linalg.norm(diff, axis=2)
+    inside = (dist < cutoff) & (dist > 0)
+    # radial basis with smooth cosine cutoff, g[i, j, n]
+    centres = np.linspace(0.5, cutoff, n_max)
+    g = np.exp(-(dist[:, :, None] - centres) ** 2 / (2 * params['sigma'] ** 2))
+    g *= (inside * 0.5 * (np.cos(np.pi * np.minimum(dist, cutoff) / cutoff) + 1))[:, :, None]
+
+    unit = diff / np.where(dist > 0, dist, 1)[:, :, None]
+    cos = np.clip(np.einsum('ijx,ikx->ijk', unit, unit), -1, 1)
+
+    p = np.zeros((l_max + 1, n_species, n_species, n_max, n_max))
+    for l, legendre in enumerate(_legendre(cos, l_max)):
+        x = np.einsum('ijk,ijn,ja->ikan', legendre, g, onehot)
+        p[l] = np.einsum('ikan,ikm,kb->abnm', x, g, onehot)
+    upper = np.triu_indices(n_species)
+    p = p[:, upper[0], upper[1]].ravel() / len(atoms)
+    norm = np.linalg.norm(p)
+    return (p / norm if norm > 0 else p).astype(np.float32)
+
+
+def similarity(query, descriptors, zeta=PARAMS['zeta']):
+    return np.clip(descriptors @ query, 0, None) ** zeta
+
+
+## Persisted descriptors of structures/ (float32 matrix + JSON sidecar
+## with names and parameters)
+def _sidecar(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def _describe(name):
+    return soap_descriptor(structure_store.read_structure(name))
+
+
+def build_descriptors(names, path=DESCRIPTOR_PATH, jobs=None):
+    with ProcessPoolExecutor(jobs) as pool:
+        matrix = np.stack(list(pool.map(_describe, names, chunksize=64)))
+    tmp_path = path + '.%d.tmp.npy' % os.getpid()
+    np.save(tmp_path, matrix)
+    with open(tmp_path + '.json', 'w') as f:
+        json.dump({'names': list(names), 'params': PARAMS}, f)
+    os.replace(tmp_path + '.json', _sidecar(path))
+    os.replace(tmp_path, path)
+    return matrix
+
+
+class DescriptorSet:
+    def __init__(self, path=DESCRIPTOR_PATH):
+        with open(_sidecar(path)) as f:
+            meta = json.load(f)
+        if meta['params'] != PARAMS:
+            raise ValueError('%s was built with different parameters, rebuild it' % path)
+        self.matrix = np.load(path, mmap_mode='r')
+        self.names = {name: i for i, name in enumerate(meta['names'])}
+
+    def rows(self, names):
+        return np.asarray(self.matrix[[self.names[str(name)] for name in names]])
+
+
+def load_descriptors(path=DESCRIPTOR_PATH):
+    if not os.path.exists(path) or not os.path.exists(_sidecar(path)):
+        return None
+    return DescriptorSet(path)
+
+
+## Query input
+def atoms_from_smiles(smiles):
+    # 3D embedding needs RDKit, which is not required by the web app itself
+    try:
+        from rdkit import Chem
+        from rdkit.Chem import AllChem
+    except ImportError:
+        raise ValueError('SMILES input requires RDKit, upload an XYZ structure instead')
+    # smiles/*.smi files hold "<SMILES>\t<target path>"
+    mol = Chem.MolFromSmiles(smiles.split()[0]) if smiles.strip() else None
+    if mol is None:
+        raise ValueError('Invalid SMILES: %r' % smiles)
+    mol = Chem.AddHs(mol)
+    if AllChem.EmbedMolecule(mol, randomSeed=0xf00d) != 0:
+        raise ValueError('Could not generate a 3D structure for %r' % smiles)
+    AllChem.MMFFOptimizeMolecule(mol)
+    conf = mol.GetConformer()
+    return [
+        {'symbol': atom.GetSymbol(), 'x': pos.x, 'y': pos.y, 'z': pos.z}
+        for atom, pos in ((atom, conf.GetAtomPosition(atom.GetIdx())) for atom in mol.GetAtoms())
+    ]
+
+
+## Kernel ridge regression on the descriptor kernel
+class KRRModel:
+    def __init__(self, train_descriptors, targets, regularisation=1e-2, zeta=PARAMS['zeta']):
+        self.train = np.asarray(train_descriptors, dtype=np.float64)
+        self.zeta = zeta
+        self.mean = float(np.mean(targets))
+        kernel = np.clip(self.train @ self.train.T, 0, None) ** zeta
+        kernel[np.diag_indices_from(kernel)] += regularisation
+        self.weights = np.linalg.solve(kernel, np.asarray(targets) - self.mean)
+
+    def predict(self, descriptors):
+        kernel = np.clip(np.atleast_2d(descriptors) @ self.train.T, 0, None) ** self.zeta
+        return kernel @ self.weights + self.mean
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Descriptors for out-of-sample similarity queries')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('build', help='compute the descriptors of all structures')
+    p.add_argument('--out', default=DESCRIPTOR_PATH)
+    p.add_argument('--jobs', type=int, default=None)
+    args = parser.parse_args()
+
+    names = sorted(f[:-len('.xyz')] for f in os.listdir(structure_store.STRUCTURE_DIR) if f.endswith('.xyz'))
+    matrix = build_descriptors(names, args.out, args.jobs)
+    print('wrote %s (%d structures x %d features)' % (args.out, *matrix.shape))
@@ -0,0 +1,46 @@
+import hashlib
+import json
+import os
+import threading
+
+
+# Precomputed JSON artefacts (the scatter figures) shared by all
+# workers and restarts through files in EXCHEM_CACHE_DIR. The key must cover
+# everything the artefact is built from; a changed key simply yields a new
+# file, stale ones can be deleted at any time.
+CACHE_DIR = os.environ.get('EXCHEM_CACHE_DIR', '.cache')
+
+_memory = {}
+_lock = threading.Lock()
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def cached_json(name, key, build):
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    path = os.path.join(CACHE_DIR, '%s-%s.json' % (name, digest))
+    with _lock:
+        if path in _memory:
+            return _memory[path]
+    try:
+        with open(path) as f:
+            value = json.load(f)
+    except (OSError, ValueError):
+        value = json.loads(json.dumps(build(), cls=_encoder()))
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+    with _lock:
+        _memory[path] = value
+    return value
+
+
+def _encoder():
+    # plotly's encoder handles numpy arrays and plotly objects
+    import plotly.utils
+    return plotly.utils.PlotlyJSONEncoder
@@ -1,240 +1,491 @@
+import startup
 import plotly.graph_objects as go
 import numpy as np
-import pandas as pd 
 import dash
 from dash import dcc
 import dash_bio as dashbio
 from dash import html
-from dash_bio.utils import xyz_reader
-from dash.dependencies import Input, Output, State
+from dash import ctx
+from dash import Patch
+from dash.dependencies import Input, Output, State, ALL
+from dash.exceptions import PreventUpdate
 from dash import dash_table
-from dash.dash_table.Format import Format, Scheme
+from dash.dash_table.Format import Format
 import dash_bootstrap_components as dbc
+import flask
+import functools
+import json
+import os
+
+import ann_index
+import compression
+import datasets
+import descriptors
+import disk_cache
+import fingerprints
+import library_map
+import metrics
+import response_cache
+import structure_store
+import table_query
+
+startup.mark('imports', startup.started)
 
 
 def simbapre(kernel, df, index, no):
-    #idx = index + 7211
-    idx = index + 7094
-    kernel_mod = kernel[:,:7093]
-    max_idx = np.argpartition(kernel_mod[7094 + index], -no)[-no:]
-    return max_idx
-
-def find_idx(compound,df):
-    idx = df[df['compound'].str.match(compound)].index.values.astype(int)[0]
-    return idx
-
-def data_bars(df, column):
-    n_bins = 100
-    bounds = [i * (1.0 / n_bins) for i in range(n_bins + 1)]
-    col_max = 100
-    col_min = -100
-    ranges = [
-        ((col_max - col_min) * i) + col_min
-        for i in bounds
-    ]
-    styles = []
-    for i in range(1, len(bounds)):
-        min_bound = ranges[i - 1]
-        max_bound = ranges[i]
-        min_bound_percentage = bounds[i - 1] * 100
-        max_bound_percentage = bounds[i] * 100
-        
-        style = {
-            'if': {
-                'filter_query': (
-                    '{{{column}}} >= {min_bound}' +
-                    (' && {{{column}}} < {max_bound}' if (i < len(bounds) - 1) else '')
-                ).format(column=column, min_bound=min_bound, max_bound=max_bound),
-                'column_id': column
-            },
-            'paddingBottom': 2,
-            'paddingTop': 2
-            }
-        if max_bound >= 40:    
-            background = (
-                """
-                    linear-gradient(90deg,
-                    white 0%,
-                    white 50%,
-                    #3D9970 50%,
-                    #3D9970 {max_bound_percentage}%,
-                    white {max_bound_percentage}%,
-                    white 100%)
-                """.format(
-                    max_bound_percentage=max_bound_percentage,
-                    color_above='#3D9970'
-                )
-            )
-        elif ((max_bound < 40) and (max_bound >= 0)) :    
-            background = (
-                """
-                    linear-gradient(90deg,
-                    white 0%,
-                    white 50%,                    
-                    #e9d700 50%,
-                    #e9d700 {max_bound_percentage}%,
-                    white {max_bound_percentage}%,
-                    white 100%)
-                """.format(
-                    max_bound_percentage=max_bound_percentage,
-                    color_above='#e9d700'
-                )
-            )
+    # kernel is a kernel_store.KernelStore; the top-K lists are precomputed
+    # in kernel.neighbours, larger K falls back to a search over the row
+    if kernel.neighbours is not None and no <= kernel.neighbours.k:
+        max_idx, _ = kernel.neighbours.top(index, no)
+        return max_idx
+    return simbapre_batch(kernel, [index], no)[0][0]
+
+def simbapre_batch(kernel, indices, no):
+    # top-no commercial neighbours of several references in one pass over
+    # their kernel rows, sorted by decreasing similarity
+    rows = np.asarray(kernel.rows(indices))
+    max_idx = np.argpartition(rows, -no, axis=1)[:, -no:]
+    scores = np.take_along_axis(rows, max_idx, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(max_idx, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+def simbapre_consensus(kernel, indices, weights=None, block=64):
+    # similarity of every commercial compound to a set of references in one
+    # pass over their kernel rows, `block` rows at a time: the maximum, or
+    # with weights (summing to 1) the weighted mean
+    indices = np.asarray(indices)
+    scores = None
+    for start in range(0, len(indices), block):
+        rows = np.asarray(kernel.rows(indices[start:start + block]))
+        if weights is None:
+            part = rows.max(axis=0)
+            scores = part if scores is None else np.maximum(scores, part, out=scores)
         else:
-            background = (
-                """
-                    linear-gradient(90deg,
-                    white 0%,
-                    white {min_bound_percentage}%,                    
-                    #FF4136 {min_bound_percentage}%,
-                    #FF4136 50%,
-                    white 50%,
-                    white 100%)
-                """.format(
-                    min_bound_percentage=min_bound_percentage,
-                    color_above='#FF4136'
-                )
-            )
-        style['background'] = background
-        styles.append(style)
-        
+            part = weights[start:start + block] @ rows
+            scores = part if scores is None else np.add(scores, part, out=scores)
+    return scores
 
-    return styles
+def top_columns(scores, no):
+    # indices of the no highest scores, sorted by decreasing score
+    no = min(no, len(scores))
+    top = np.argpartition(-scores, no - 1)[:no] if no else np.array([], dtype=np.int64)
+    top = top[np.argsort(-scores[top], kind='stable')]
+    return top, scores[top]
 
+def sim_percent(scores):
+    # percent with 3 significant digits, rounded again to drop float noise
+    # (59.099999999999994) from the payload
+    return (100 * np.asarray(scores, dtype=np.float64).round(decimals=3)).round(decimals=1)
+
+@metrics.timed('records')
+def neighbour_records(max_idx, scores, columns):
+    # Request-local table rows: gathers only the selected neighbours from the
+    # column arrays, shared state is never written
+    return [
+        {'Filename': filename, 'Identifier': identifier, 'IE_krr': ie_krr, 'sim_val': sim}
+        for filename, identifier, ie_krr, sim in zip(
+            columns['Filename'][max_idx].tolist(),
+            columns['Identifier'][max_idx].tolist(),
+            columns['IE_krr'][max_idx].tolist(),
+            sim_percent(scores).tolist())
+    ]
 
+def find_idx(compound, index):
+    return index[compound]
+
+@metrics.timed('resolve_point')
+def point_row(point):
+    # scatter points carry their inh_data.csv row in customdata, either as
+    # scalar (untested) or as first entry of [row, IE] (tested); library
+    # compounds ([CAS, SMILES, IE]) and hexagons (none) have no row
+    customdata = point.get('customdata')
+    if isinstance(customdata, list):
+        customdata = customdata[0]
+    if customdata is None or isinstance(customdata, str):
+        return None
+    return int(customdata)
 
 # Declarations
-data = pd.read_csv('inh_data.csv')
-data['H2evo.220ppm'] = data['H2evo.220ppm'].round(decimals=0)
+with startup.phase('dataset manifest'):
+    registry = datasets.DatasetRegistry()
+similarity_backend = os.environ.get('EXCHEM_SIMILARITY', 'kernel')
+# 'all' is the whole library of the dataset
+top_n_options = [5, 10, 20, 50, 100, 500, 1000, 'all']
+page_size = 50
+
+
+## Out-of-sample queries, descriptors and KRR model are loaded on first use
+def oos_model(ds):
+    with ds.lock:
+        if 'oos' not in ds.cache:
+            descriptor_set = descriptors.load_descriptors(ds.spec.get('descriptors', descriptors.DESCRIPTOR_PATH))
+            if descriptor_set is None:
+                return None
+            ds.cache['oos'] = {
+                'descriptors': descriptor_set,
+                'commercial': np.array([
+                    descriptor_set.names[name] for name in ds.struc_columns['Filename'][:ds.sim.n_commercial]]),
+                'krr': descriptors.KRRModel(
+                    descriptor_set.rows(ds.compound_names[ds.train.index]), ds.column('property')[ds.train.index].values),
+            }
+        return ds.cache['oos']
+
+## Approximate nearest neighbour backend over the descriptors
+def ann_model(ds):
+    with ds.lock:
+        if 'ann' not in ds.cache:
+            model = oos_model(ds)
+            index = ann_index.load_index(ds.spec.get('ann_index', ann_index.ANN_PATH))
+            if model is None or index is None:
+                return None
+            ds.cache['ann'] = {
+                'index': index,
+                'references': model['descriptors'].rows(ds.compound_names),
+            }
+        return ds.cache['ann']
+
+## Structural fingerprints of the library, for substructure filters
+def fingerprint_index(ds):
+    with ds.lock:
+        if 'fingerprints' not in ds.cache:
+            ds.cache['fingerprints'] = fingerprints.load_index(ds.spec['library']['file'],
+                                                               ds.struc_columns['Identifier'])
+        return ds.cache['fingerprints']
+
+def substructure_candidates(ds, substructure):
+    # library columns passing the filter, None without a filter
+    if not substructure:
+        return None
+    return fingerprints.candidates(fingerprint_index(ds), substructure, ds.sim.n_commercial)
 
-train = data[data['label'].str.match("train")]
-test = data[data['label'].str.match("test")]
-new_test = data[data['label'].str.match("new_test")]
+## Consensus of several references selected on the map
+AGGREGATES = {'max': 'Max', 'mean': 'Mean', 'ie': 'IE-weighted'}
 
-untested = data[data['label'].str.match("untested")]
-tested = data[data['label'].str.match('|'.join(["train","test","new_test"]))]
+def selected_rows(selectedData):
+    # reference rows of a box / lasso selection, library compounds and
+    # hexagons are skipped
+    rows = (point_row(point) for point in (selectedData or {}).get('points') or [])
+    return sorted({row for row in rows if row is not None})
 
+def consensus_weights(ds, rows, aggregate):
+    # weights of the references in the consensus similarity, None for the
+    # maximum; IE-weighted uses the measured property, negative or missing
+    # values count 0
+    if aggregate == 'max':
+        return None
+    if aggregate == 'mean':
+        return np.full(len(rows), 1 / len(rows))
+    if aggregate != 'ie':
+        raise ValueError('Unknown aggregate: %s' % aggregate)
+    weights = np.nan_to_num(np.clip(ds.properties[list(rows)].astype(np.float64), 0, None))
+    if not weights.sum():
+        raise ValueError('No selected compound with a positive %s' % ds.spec['reference']['property'])
+    return weights / weights.sum()
 
-## Similarity-based discovery of inhibitors
-struc = pd.read_csv('structures_commercial.csv')
-struc['IE_krr'] = struc['IE_krr'].round(decimals=0)
+@metrics.timed('search')
+def search_neighbours(ds, row, no, backend='kernel', substructure='', aggregate='max'):
+    # top-no commercial neighbours of reference `row` and their similarities,
+    # from the exact kernel or, if built, the approximate descriptor index.
+    # A tuple of rows ranks by their similarity aggregated with `aggregate`.
+    # Consensus searches and searches with a substructure filter (only the
+    # kernel columns of the matching compounds) are always exact.
+    candidates = substructure_candidates(ds, substructure)
+    if isinstance(row, tuple):
+        scores = simbapre_consensus(ds.sim, row, consensus_weights(ds, row, aggregate))
+    elif candidates is not None:
+        scores = ds.sim.row(row)
+    else:
+        if backend == 'ann':
+            model = ann_model(ds)
+            if model is not None:
+                return model['index'].search(model['references'][row], no)
+        max_idx = simbapre(ds.sim, ds.data, row, no)
+        return max_idx, ds.sim.row(row)[max_idx]
+    if candidates is None:
+        return top_columns(scores, no)
+    top, top_scores = top_columns(scores[candidates], no)
+    return candidates[top], top_scores
 
-sim = np.load('K_c3_g1_commercial.npy')
+def molecule_text(ds, row):
+    identifier = ds.compound_names[row]
+    if row in ds.tested.index:
+        return [str(identifier) + ', ' + str(int(ds.properties[row])) + '%']
+    return [str(identifier)]
 
 
+### Response cache
+# Callback outputs are memoised in response_cache (shared by all workers),
+# keyed by the resolved compound row and K rather than the raw clickData,
+# plus the signatures of the files they are computed from. These include
+# the kernel store actually loaded (ds.sim.path): a float32 / uint16 block
+# or a low-rank factor ranks differently than the kernel file, and workers
+# started with other EXCHEM_KERNEL_* settings share the same cache.
+def dataset_version(ds):
+    with ds.lock:
+        if 'version' not in ds.cache:
+            spec = ds.spec
+            files = [spec['reference']['file'], spec['library']['file'], spec['kernel']['file'], ds.sim.path,
+                     spec.get('descriptors', descriptors.DESCRIPTOR_PATH),
+                     spec.get('ann_index', ann_index.ANN_PATH), ds.structures, structure_store.PACK_PATH,
+                     ds.predictions_path]
+            ds.cache['version'] = [disk_cache.file_signature(f) for f in files if f and os.path.exists(f)]
+        return ds.cache['version']
 
-## Properties
-ie = tested['H2evo.220ppm']
-mol = xyz_reader.read_xyz(datapath_or_datastring='structures/tris.xyz', is_datafile=True)
+@response_cache.cache.memoize('molecule')
+def molecule_response(dataset_id, version, row):
+    ds = registry.get(dataset_id)
+    mol = structure_store.read_structure(ds.compound_names[row], ds.structures)
+    return mol, molecule_text(ds, row)
 
-sel_idx = find_idx('tris',data)
-max_idx = simbapre(sim, data, sel_idx, 5)
-struc['sim_val'] = 100 * sim[7094 + sel_idx].round(decimals=3)
+def parse_top_n(ds, no_rows):
+    if no_rows == 'all':
+        return ds.sim.n_commercial
+    return min(int(no_rows), ds.sim.n_commercial)
+
+@functools.lru_cache(maxsize=64)
+def neighbour_table(dataset_id, predictions, row, no, backend, substructure, aggregate):
+    # top-no neighbours in order of similarity and the table columns for
+    # filtering and sorting them, kept for paging without a new search
+    ds = registry.get(dataset_id)
+    max_idx, scores = search_neighbours(ds, row, no, backend, substructure, aggregate)
+    columns = {
+        'Filename': ds.struc_columns['Filename'][max_idx],
+        'Identifier': ds.struc_columns['Identifier'][max_idx],
+        'IE_krr': ds.struc_columns['IE_krr'][max_idx],
+        'sim_val': sim_percent(scores),
+    }
+    return max_idx, scores, columns
+
+@functools.lru_cache(maxsize=64)
+def neighbour_view(dataset_id, predictions, row, no, backend, substructure, aggregate, sort_key, filter_query):
+    # table rows in display order for one sort order and filter
+    _, _, columns = neighbour_table(dataset_id, predictions, row, no, backend, substructure, aggregate)
+    with metrics.timer('table_query'):
+        return table_query.view(columns, filter_query, json.loads(sort_key))
+
+@response_cache.cache.memoize('table-page')
+def table_page_response(dataset_id, version, row, no, backend, substructure, aggregate, page, size, sort_by,
+                        filter_query):
+    # the lru caches are keyed by the prediction version of IE_krr
+    ds = registry.get(dataset_id)
+    max_idx, scores, _ = neighbour_table(dataset_id, ds.predictions, row, no, backend, substructure, aggregate)
+    view = neighbour_view(dataset_id, ds.predictions, row, no, backend, substructure, aggregate,
+                          json.dumps(sort_by), filter_query)
+    rows, page_count, page = table_query.page(view, page, size)
+    records = neighbour_records(max_idx[rows], scores[rows], ds.struc_columns)
+    return records, page_count, page
+
+def warm_response_cache(dataset_id=None, backend=None):
+    # precomputes structure and first neighbour table page of every
+    # reference compound for every K offered in the dropdown
+    ds = registry.get(dataset_id)
+    version = dataset_version(ds)
+    count = 0
+    for row in range(len(ds.compound_names)):
+        molecule_response(ds.id, version, row)
+        count += 1
+        for no in top_n_options:
+            table_page_response(ds.id, version, row, parse_top_n(ds, no), backend or similarity_backend, '',
+                                'max', 0, page_size, [], '')
+            count += 1
+    return count
 
-sim_struc = struc['Filename'].iloc[max_idx[0]]
-mol_sim = xyz_reader.read_xyz(datapath_or_datastring='structures/' + str(sim_struc) + '.xyz', is_datafile=True)
 
 ### Scatter plots
-fig = go.FigureWidget()
-fig.add_trace(go.Scattergl(
-    x = untested['CV1'],
-    y = untested['CV2'],
-    customdata=untested['compound'],
-    hovertemplate = '<b>%{customdata}</b>',
-    mode='markers',
-    marker_symbol = 'cross',
-    marker=dict(
-        color='lightgray',
-        line_width=0,
-        size=15
-    ),
-    name= 'Untested',
-    unselected=dict(
-        marker=dict(opacity=0.5)
-    ),
-    selected=dict(
+# bump when build_figure changes, invalidates the disk cache
+FIGURE_VERSION = 3
+
+def dataset_figure(dataset_id):
+    # figure JSON cached on disk, keyed by the manifest entry and the
+    # reference file, so it is served without loading the dataset itself
+    spec = registry.specs[dataset_id or registry.default]
+    key = [FIGURE_VERSION, spec, disk_cache.file_signature(spec['reference']['file'])]
+    def build():
+        with startup.phase('figure %s' % spec['id']):
+            return build_figure(registry.get(spec['id']))
+    return disk_cache.cached_json('figure', key, build)
+
+## Library compounds on the map, points or hexagons depending on the viewport
+def library_positions(ds):
+    with ds.lock:
+        if 'map' not in ds.cache:
+            positions = np.column_stack((ds.column('x').values, ds.column('y').values)).astype(np.float64)
+            xy = library_map.load_map(ds.spec, ds.sim, positions)
+            ds.cache['map'] = library_map.GridIndex(xy)
+        return ds.cache['map']
+
+def figure_viewport(figure, relayout):
+    # x0, x1, y0, y1 shown after a relayout event, None if the event did
+    # not change the axes (e.g. a selection)
+    layout = figure['layout']
+    x0, x1 = layout['xaxis']['range']
+    y0, y1 = layout['yaxis']['range']
+    if not relayout:
+        return x0, x1, y0, y1
+    if 'xaxis.range[0]' in relayout or 'yaxis.range[0]' in relayout:
+        return (relayout.get('xaxis.range[0]', x0), relayout.get('xaxis.range[1]', x1),
+                relayout.get('yaxis.range[0]', y0), relayout.get('yaxis.range[1]', y1))
+    if 'xaxis.autorange' in relayout or 'yaxis.autorange' in relayout or 'autosize' in relayout:
+        return x0, x1, y0, y1
+    return None
+
+@metrics.timed('library_map')
+def library_trace(ds, figure, x0, x1, y0, y1):
+    # properties of the library trace: the compounds in the viewport, or
+    # hexagons coloured by their mean predicted IE once there are more
+    # than library_map.MAX_POINTS of them
+    grid = library_positions(ds)
+    x0, x1 = sorted((x0, x1))
+    y0, y1 = sorted((y0, y1))
+    found = grid.query(x0, x1, y0, y1)
+    ie = ds.struc_columns['IE_krr'][found].astype(np.float64)
+    tested = ds.properties[ds.tested.index]
+    marker = {'colorscale': 'BrBG', 'cmin': float(np.nanmin(tested)), 'cmax': float(np.nanmax(tested)),
+              'line': {'width': 0}, 'opacity': 0.6}
+    if len(found) <= library_map.MAX_POINTS:
+        return {
+            'x': grid.xy[found, 0].round(4), 'y': grid.xy[found, 1].round(4),
+            'customdata': list(zip(ds.struc_columns['Filename'][found].tolist(),
+                                   ds.struc_columns['Identifier'][found].tolist(), ie.tolist())),
+            'text': None,
+            'hovertemplate': '<b>%{customdata[0]}</b><br>%{customdata[1]}<br>%{customdata[2]:.0f} % predicted'
+                             '<extra></extra>',
+            'marker': dict(marker, color=ie, size=6, symbol='circle'),
+        }
+    layout = figure['layout']
+    width = layout['width'] - layout['margin']['l'] - layout['margin']['r']
+    height = layout['height'] - layout['margin']['t'] - layout['margin']['b']
+    hx, hy, counts, means = library_map.hexbin(grid.xy[found, 0], grid.xy[found, 1], ie,
+                                               x0, x1, y0, y1, width, height)
+    return {
+        'x': hx.round(4), 'y': hy.round(4),
+        'customdata': None,
+        'text': counts,
+        'hovertemplate': '%{text} compounds<br>mean %{marker.color:.0f} % predicted<extra></extra>',
+        'marker': dict(marker, color=means.round(1), size=library_map.HEX_SIZE + 2, symbol='hexagon'),
+    }
+
+def build_figure(ds):
+    untested, tested = ds.untested, ds.tested
+    ie = tested[ds.spec['reference']['property']]
+    x, y = ds.spec['reference']['x'], ds.spec['reference']['y']
+
+    fig = go.Figure()
+    # library compounds, drawn below the references; filled for the
+    # viewport by update_figure
+    fig.add_trace(go.Scattergl(
+        x=[],
+        y=[],
+        mode='markers',
+        name='Commercial (predicted)',
+        marker=dict(color='lightgray')
+    ))
+    fig.add_trace(go.Scattergl(
+        x = untested[x].round(4),
+        y = untested[y].round(4),
+        customdata=untested.index.values,
+        text=ds.compound_names[untested.index],
+        hovertemplate = '<b>%{text}</b>',
+        mode='markers',
+        marker_symbol = 'cross',
         marker=dict(
-            size=25
+            color='lightgray',
+            line_width=0,
+            size=15
+        ),
+        name= 'Untested',
+        unselected=dict(
+            marker=dict(opacity=0.5)
+        ),
+        selected=dict(
+            marker=dict(
+                size=25
+            )
         )
-    )
-))
-
-fig.add_trace(go.Scattergl(
-    x = tested['CV1'],
-    y = tested['CV2'],
-    customdata=np.vstack((tested['compound'].values, tested['H2evo.220ppm'].values)).transpose(),
-    hovertemplate = '<b>%{customdata[0]}</b><br>%{customdata[1]:.0f} %',
-    mode='markers',
-    marker=dict(
-        color=ie,
-        colorscale='BrBG',
-        line_width=0,
-        size=15,
-        colorbar=dict(
-            title='IE / %',
-            outlinecolor='black',
-            outlinewidth=1,
-            len=0.4,
-            dtick=25,
-            x=-0.02,
-            yanchor='top',
-            y=0.97,
-            thickness=20)
-    ),
-    name= 'Tested',
-    unselected=dict(
-        marker=dict(opacity=0.5)
-    ),
-    selected=dict(
+    ))
+
+    fig.add_trace(go.Scattergl(
+        x = tested[x].round(4),
+        y = tested[y].round(4),
+        customdata=np.column_stack((tested.index.values, ie.values)),
+        text=ds.compound_names[tested.index],
+        hovertemplate = '<b>%{text}</b><br>%{customdata[1]:.0f} %',
+        mode='markers',
         marker=dict(
-            size=25
+            color=ie,
+            colorscale='BrBG',
+            line_width=0,
+            size=15,
+            colorbar=dict(
+                title=ds.spec['reference'].get('property_title', ''),
+                outlinecolor='black',
+                outlinewidth=1,
+                len=0.4,
+                dtick=25,
+                x=-0.02,
+                yanchor='top',
+                y=0.97,
+                thickness=20)
+        ),
+        name= 'Tested',
+        unselected=dict(
+            marker=dict(opacity=0.5)
+        ),
+        selected=dict(
+            marker=dict(
+                size=25
+            )
         )
+    ))
+
+    fig.update_xaxes(range=[min(tested[x])-0.05, max(tested[x])+0.05])
+    fig.update_yaxes(range=[min(tested[y])-0.05, max(tested[y])+0.05])
+
+    # Figure Layout
+    fig.update_layout(
+        autosize=False,
+        width=900,
+        height=700,
+        xaxis = {
+            'showgrid':False,
+            'zeroline':False,
+            'visible': False
+            },
+        yaxis = {
+            'showgrid':False,
+            'zeroline':False,
+            'visible': False
+            },
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)',
+        margin=dict(
+            l=20,
+            r=0,
+            b=0,
+            t=0,
+            pad=4
+        ),
+        legend=dict(
+        yanchor="top",
+        y=0.9,
+        xanchor="left",
+        x=0.1
+        ),
+        hoverlabel=dict(
+            bgcolor="white", 
+            font_size=14, 
+            font_family="Arial",
+            align='left'
+        ),
+        clickmode='event+select',
+        # keeps zoom and legend state when the library trace is updated
+        uirevision=ds.id,
+        # the default template adds ~7 kB to the figure, only its font
+        # colour and hover label alignment are visible here
+        template='none',
+        font_color='#2a3f5f'
     )
-))
-
-fig.update_xaxes(range=[min(tested['CV1'])-0.05, max(tested['CV1'])+0.05])
-fig.update_yaxes(range=[min(tested['CV2'])-0.05, max(tested['CV2'])+0.05])
-
-
-  
-
-### Figure Layout
-fig.update_layout(
-    autosize=False,
-    width=900,
-    height=700,
-    xaxis = {
-        'showgrid':False,
-        'zeroline':False,
-        'visible': False
-        },
-    yaxis = {
-        'showgrid':False,
-        'zeroline':False,
-        'visible': False
-        },
-    paper_bgcolor='rgba(0,0,0,0)',
-    plot_bgcolor='rgba(0,0,0,0)',
-    margin=dict(
-        l=20,
-        r=0,
-        b=0,
-        t=0,
-        pad=4
-    ),
-    legend=dict(
-    yanchor="top",
-    y=0.9,
-    xanchor="left",
-    x=0.1
-    ),
-    hoverlabel=dict(
-        bgcolor="white", 
-        font_size=14, 
-        font_family="Arial"
-    ),
-    clickmode='event+select'
-)
+    return fig
 
 speck_view_main={
     'resolution': 269,
@@ -342,7 +593,9 @@ extra = dbc.Container(fluid=True,children=[dbc.Row(
             dbc.DropdownMenu(
             children=[
                 #dbc.DropdownMenuItem("Examples", header=True),
-                dbc.DropdownMenuItem("Magnesium Dissolution Modulators", href="#"),
+            ] + [
+                dbc.DropdownMenuItem(title, id={'type': 'dataset-item', 'index': dataset_id}, href="#")
+                for dataset_id, title in registry.titles()
             ],
             nav=True,
             in_navbar=True,
@@ -417,29 +670,43 @@ footer = dbc.Navbar(
 )
 
 
+def dataset_title(title):
+    return '##### **Dataset** | ' + title
+
+
 ### App properties
 app = dash.Dash(external_stylesheets=[dbc.themes.BOOTSTRAP,'https://use.fontawesome.com/releases/v5.8.1/css/all.css'])
 
 server = app.server
+compression.init_app(server)
 
 app.title = 'ExChem'
 
 app.layout = html.Div([
     
+    dcc.Store(id='dataset', data=registry.default),
+    # neighbour search ({'dataset': id, 'row': reference row, 'k': K,
+    # 'backend': ...}) and the structure selected in the table
+    # ({'dataset': id, 'name': CAS number})
+    dcc.Store(id='neighbours'),
+    dcc.Store(id='similar-structure'),
     html.Div([
         navbar
     ]),
     html.Div([
         
         html.Div([
-            dcc.Markdown('''
-                         ##### **Dataset** | Magnesium Dissolution Modulators
-                         ''', style={'padding-bottom': '1%'}),
+            dcc.Markdown(
+                dataset_title(registry.specs[registry.default]['title']),
+                id='dataset-title', style={'padding-bottom': '1%'}),
             dcc.Graph(
                 id='basic-interactions',
-                figure=fig,
+                figure={},
                 config={
-                    'displayModeBar': False
+                    'displaylogo': False,
+                    # box and lasso select several reference compounds
+                    'modeBarButtons': [['zoom2d', 'pan2d', 'select2d', 'lasso2d', 'resetScale2d']],
+                    'scrollZoom': True
                 }
             ),
             html.A(href="https://www.hereon.de",children=[
@@ -463,7 +730,7 @@ app.layout = html.Div([
                 html.Div([
                     dashbio.Speck(
                         id='my-speck',
-                        data=mol,
+                        data=[],
                         view=speck_view_main,
                         style={'width' : '269px',
                                'height' : '269px'}
@@ -484,7 +751,7 @@ app.layout = html.Div([
                 html.Div([ 
                     dashbio.Speck(
                         id='sim-speck',
-                        data=mol,
+                        data=[],
                         view=speck_view_sim,
                         style={'width' : '269px',
                                'height' : '269px'}
@@ -507,12 +774,7 @@ app.layout = html.Div([
                     dbc.Col([
                         dcc.Dropdown(
                             id='dropdown',
-                            options=[
-                                {'label': '5', 'value': '5'},
-                                {'label': '10', 'value': '10'},
-                                {'label': '20', 'value': '20'},
-                                {'label': '50', 'value': '50'}
-                            ],
+                            options=[{'label': str(n).capitalize(), 'value': str(n)} for n in top_n_options],
                             value='10',
                             clearable=False
                         )],width={"size": "100px", "offset": "10px"}
@@ -520,8 +782,54 @@ app.layout = html.Div([
                     dbc.Col([
                         'similar structures'
                     ],width={"size": "auto", "offset": "10px"}),
+                    dbc.Col([
+                        dcc.RadioItems(
+                            id='similarity-backend',
+                            options=[
+                                {'label': 'Exact kernel', 'value': 'kernel'},
+                                {'label': 'Approximate (ANN)', 'value': 'ann'}
+                            ],
+                            value=similarity_backend,
+                            inline=True,
+                            inputStyle={'margin-left': '20px', 'margin-right': '5px'}
+                        )],width='auto'
+                    ),
                 ],align='center',
                 className="g-0"
+                ),
+                dbc.Row([
+                    dbc.Col([
+                        html.Div(
+                            dcc.Input(
+                                id='substructure',
+                                type='text',
+                                value='',
+                                debounce=True,
+                                placeholder='Substructure filter, e.g. carboxylic_acid pyridine !S',
+                                style={'width': '400px'}
+                            ),
+                            title='Features: ' + ' '.join(fingerprints.FEATURES) +
+                                  '. Prefix ! or "no" to exclude one.'
+                        )],width='auto'
+                    ),
+                    dbc.Col([
+                        html.Div(
+                            dcc.RadioItems(
+                                id='aggregate',
+                                options=[{'label': label, 'value': value} for value, label in AGGREGATES.items()],
+                                value='max',
+                                inline=True,
+                                inputStyle={'margin-left': '20px', 'margin-right': '5px'}
+                            ),
+                            title='Similarity to several reference compounds selected with the box or lasso'
+                        )],width='auto'
+                    ),
+                    dbc.Col([
+                        html.Small(id='substructure-status', style={'padding-left': '10px'})
+                    ],width='auto'),
+                ],align='center',
+                className="g-0",
+                style={'padding-top': '5px'}
                 )
                 ],style={'padding-bottom' : '10px'}),
                 dash_table.DataTable(
@@ -529,10 +837,10 @@ app.layout = html.Div([
                     columns=[
                         {"name": 'CAS Number', "id": 'Filename'},
                         {"name": 'Similarity / %', "id": 'sim_val', 'type':'numeric', 'format':Format(precision=3)},
-                        {"name": 'Predicted IE / %', "id": 'IE_krr'}
+                        {"name": 'Predicted IE / %', "id": 'IE_krr', 'type':'numeric'}
                         ],
                     #selected_rows = max_idx,
-                    data=struc.iloc[max_idx].to_dict("records"),
+                    data=[],
                     selected_rows=[0],
                     style_cell_conditional=[
                         {'if': {'column_id': 'Filename'},
@@ -561,17 +869,24 @@ app.layout = html.Div([
                     ],
                     fixed_rows={'headers': True},
                     row_selectable='single',
-                    sort_action='native',
+                    # rows are queried page by page on the server, see
+                    # update_table_page
+                    sort_action='custom',
+                    sort_by=[],
+                    filter_action='custom',
+                    filter_query='',
+                    page_action='custom',
+                    page_current=0,
+                    page_size=page_size,
                     style_table={
                     'height': '350px', 
                     'width': '700px',
                     'overflowY': 'auto'
                     },
                     css=[{'selector': '.row', 'rule': 'margin: 0'}],
-                    style_data_conditional=(
-                        data_bars(struc, 'IE_krr')
-                    )
-                )
+                    style_data_conditional=[]
+                ),
+                html.Small(id='table-status')
             ],style={'vertical-align' : 'top'})
         ],
         #style={'width': '49%', 'display': 'inline-block', 'vertical-align' : 'top', 'padding-left' : '3%'})
@@ -584,70 +899,297 @@ app.layout = html.Div([
 
 
 ### Callback functions
+@app.callback(
+    [Output('dataset', 'data'), Output('basic-interactions', 'clickData'),
+     Output('basic-interactions', 'selectedData')],
+    [Input({'type': 'dataset-item', 'index': ALL}, 'n_clicks')],
+    prevent_initial_call=True
+)
+def select_dataset(n_clicks):
+    # a click or box / lasso selection from the previous dataset's figure
+    # must not be resolved against the rows of the new one
+    if not any(n_clicks):
+        raise PreventUpdate
+    return ctx.triggered_id['index'], None, None
+
+@app.callback(
+    [Output('basic-interactions', 'figure'), Output('dataset-title', 'children')],
+    [Input('dataset', 'data'),
+     Input('basic-interactions', 'relayoutData')]
+)
+def update_figure(dataset_id, relayout=None):
+    # a new dataset sends the whole figure, zooming and panning only the
+    # library trace of the visible region
+    spec = registry.specs[dataset_id or registry.default]
+    figure = dataset_figure(dataset_id)
+    ds = registry.get(spec['id'])
+    if ctx.triggered_id == 'basic-interactions':
+        viewport = figure_viewport(figure, relayout)
+        if viewport is None:
+            raise PreventUpdate
+        patch = Patch()
+        for key, value in library_trace(ds, figure, *viewport).items():
+            patch['data'][0][key] = value
+        return patch, dash.no_update
+    # the cached figure is shared, only the copy gets the library trace
+    data = list(figure['data'])
+    data[0] = dict(data[0], **library_trace(ds, figure, *figure_viewport(figure, None)))
+    return dict(figure, data=data), dataset_title(spec['title'])
+
 @app.callback(
     [Output('my-speck', 'data'), Output('inh_text', 'children')],
-    [Input('basic-interactions', 'clickData')]
+    [Input('basic-interactions', 'clickData'),
+     Input('dataset', 'data')]
 )
-def update_molecule_viewer(clickData):
+def update_molecule_viewer(clickData, dataset_id=None):
+    ds = registry.get(dataset_id)
     if clickData is None:
-        mol = xyz_reader.read_xyz(datapath_or_datastring='structures/tris.xyz', is_datafile=True)
-        mol_text = ['tris, -72%']
-        return mol, mol_text
-    point_id = clickData['points'][0]['pointNumber']
-    curveNumber = clickData['points'][0]['curveNumber']
-    if curveNumber == 0:
-        identifier = untested['compound'].iloc[point_id]
-        mol_text = [str(identifier)]
-    if curveNumber == 1:
-        identifier = tested['compound'].iloc[point_id]
-        ie_val = tested['H2evo.220ppm'].iloc[point_id]
-        mol_text = [str(identifier) + ', ' + str(int(ie_val)) + '%']
-    mol = xyz_reader.read_xyz(datapath_or_datastring='structures/' + str(identifier) + '.xyz', is_datafile=True)
-    return mol, mol_text
+        row = ds.default_row
+    else:
+        row = point_row(clickData['points'][0])
+        if row is None:
+            raise PreventUpdate
+    return molecule_response(ds.id, dataset_version(ds), row)
 
 
 
 
+# Clicking a compound or changing K writes the search to the 'neighbours'
+# store; the table then requests one page of it at a time, filtered and
+# sorted on the server. Selecting a table row is resolved client-side and
+# only fetches that one structure. Several reference compounds selected
+# with the box or lasso are searched together by their aggregated
+# similarity ('rows' and 'aggregate' in the store).
 @app.callback(
-    [Output('table', 'data'), Output('sim-speck', 'data'), Output('sim_text', 'children')],
+    Output('neighbours', 'data'),
     [Input('basic-interactions', 'clickData'),
-     Input('table', 'selected_rows'),
-     Input('dropdown', 'value')]
+     Input('dropdown', 'value'),
+     Input('similarity-backend', 'value'),
+     Input('dataset', 'data'),
+     Input('substructure', 'value'),
+     Input('basic-interactions', 'selectedData'),
+     Input('aggregate', 'value')],
+    [State('neighbours', 'data')]
 )
-def update_table(clickData, selected_rows, no_rows):
-    if clickData is None:
-        sel_idx = find_idx('tris',data)
-        max_idx = simbapre(sim, data, sel_idx, int(no_rows))
-        
-        struc['sim_val'] = 100 * sim[7094 + sel_idx].round(decimals=3)
-        table_rows = struc.iloc[max_idx].to_dict("records")
+def update_neighbours(clickData, no_rows, backend='kernel', dataset_id=None, substructure='', selectedData=None,
+                      aggregate='max', previous=None):
+    ds = registry.get(dataset_id)
+    # clicks also select their point (clickmode event+select)
+    rows = selected_rows(selectedData)
+    if not rows:
+        row = None if clickData is None else point_row(clickData['points'][0])
+        rows = [] if row is None else [row]
+    if not rows:
+        # a library compound or hexagon was clicked last, the search stays
+        # with the previous references
+        if previous and previous.get('dataset') == ds.id:
+            rows = previous.get('rows') or [previous['row']]
+        else:
+            rows = [ds.default_row]
+    neighbours = {'dataset': ds.id, 'row': rows[0], 'k': parse_top_n(ds, no_rows), 'backend': backend,
+                  'substructure': ' '.join((substructure or '').split())}
+    # the consensus, the number of matching compounds or why the filter is
+    # ignored, shown below the filter input
+    status = []
+    if len(rows) > 1:
+        aggregate = aggregate if aggregate in AGGREGATES else 'max'
         try:
-            sim_struc = struc['Filename'].iloc[max_idx[selected_rows[0]]]
-        except:
-            selected_rows=[0]
-            sim_struc = struc['Filename'].iloc[max_idx[selected_rows[0]]]
-        mol_sim = xyz_reader.read_xyz(datapath_or_datastring='structures/' + str(sim_struc) + '.xyz', is_datafile=True)
-        sim_text = [struc['Identifier'].iloc[max_idx[selected_rows[0]]]]
-        return table_rows, mol_sim, sim_text
-    point_id = clickData['points'][0]['pointNumber']
-    curveNumber = clickData['points'][0]['curveNumber']
-    if curveNumber == 0:
-        identifier = untested['compound'].iloc[point_id]
-    if curveNumber == 1:
-        identifier = tested['compound'].iloc[point_id]
-    sel_idx = find_idx(identifier, data)
-    
-    struc['sim_val'] = 100 * sim[7094 + sel_idx].round(decimals=3)
-    max_idx = simbapre(sim, data, sel_idx, int(no_rows))
-    table_rows = struc.iloc[max_idx].to_dict("records")
+            consensus_weights(ds, rows, aggregate)
+        except ValueError as error:
+            status.append(str(error))
+            aggregate = 'mean'
+        status.append('%s similarity to %d references' % (AGGREGATES[aggregate], len(rows)))
+        neighbours.update(rows=rows, aggregate=aggregate)
+    try:
+        candidates = substructure_candidates(ds, neighbours['substructure'])
+    except ValueError as error:
+        neighbours['substructure'] = ''
+        status.append('%s, filter ignored' % error)
+    else:
+        if candidates is not None:
+            status.append('%d of %d compounds match' % (len(candidates), ds.sim.n_commercial))
+            skipped = fingerprints.unparsed(fingerprint_index(ds), ds.sim.n_commercial)
+            if skipped:
+                status.append('%d without parseable SMILES never match' % skipped)
+    if backend == 'ann':
+        status.append(ann_status(ds, neighbours))
+    if status:
+        neighbours['status'] = '; '.join(status)
+    return neighbours
+
+def ann_status(ds, neighbours):
+    # the approximate search is only used for a single reference without a
+    # filter and with a built index; anything else is searched in the kernel
+    # under backend 'kernel', so that it is cached as the exact search it is
+    if neighbours.get('rows') or neighbours['substructure']:
+        neighbours['backend'] = 'kernel'
+        return 'consensus and filtered searches are exact'
     try:
-        sim_struc = struc['Filename'].iloc[max_idx[selected_rows[0]]]
-    except:
-        selected_rows=[0]
-        sim_struc = struc['Filename'].iloc[max_idx[selected_rows[0]]]
-    mol_sim = xyz_reader.read_xyz(datapath_or_datastring='structures/' + str(sim_struc) + '.xyz', is_datafile=True)
-    sim_text = [struc['Identifier'].iloc[max_idx[selected_rows[0]]]]
-    return table_rows, mol_sim, sim_text
+        model = ann_model(ds)
+    except ValueError as error:
+        model = None
+        reason = str(error)
+    else:
+        reason = 'no approximate index built (python ann_index.py)'
+    if model is None:
+        neighbours['backend'] = 'kernel'
+        return '%s, exact kernel search' % reason
+    neighbours['similarity'] = 'descriptor'
+    scanned = len(model['index'].candidates(model['references'][neighbours['row']]))
+    if neighbours['k'] > scanned:
+        return 'approximate: only the %d compounds of the %d nearest clusters are ranked' % (
+            scanned, min(ann_index.NPROBE, model['index'].n_lists))
+    return 'approximate search, descriptor similarities'
+
+@app.callback(
+    [Output('table', 'data'), Output('table', 'page_count'), Output('table', 'page_current')],
+    [Input('neighbours', 'data'),
+     Input('table', 'page_current'),
+     Input('table', 'page_size'),
+     Input('table', 'sort_by'),
+     Input('table', 'filter_query')]
+)
+def update_table_page(neighbours, page_current, size, sort_by, filter_query):
+    if not neighbours:
+        raise PreventUpdate
+    # a new search, sort order or filter starts again at the first page
+    if ctx.triggered_id != 'table' or 'table.page_current' not in ctx.triggered_prop_ids:
+        page_current = 0
+    ds = registry.get(neighbours['dataset'])
+    no = min(int(neighbours['k']), ds.sim.n_commercial)
+    if neighbours.get('rows'):
+        row, aggregate = tuple(int(row) for row in neighbours['rows']), neighbours.get('aggregate', 'max')
+    else:
+        row, aggregate = int(neighbours['row']), 'max'
+    records, page_count, page = table_page_response(
+        ds.id, dataset_version(ds), row, no, neighbours['backend'], neighbours.get('substructure', ''), aggregate,
+        int(page_current or 0), int(size), sort_by or [], filter_query or '')
+    # the next clicks usually go to the top rows of the page
+    structure_store.prefetch((record['Filename'] for record in records), ds.structures)
+    return records, page_count, page
+
+# numeric columns of the table, a filter value that is no number is ignored
+NUMERIC_COLUMNS = ('sim_val', 'IE_krr')
+
+@app.callback(
+    Output('table-status', 'children'),
+    [Input('table', 'filter_query')]
+)
+def update_table_status(filter_query):
+    invalid = table_query.invalid_terms(filter_query, NUMERIC_COLUMNS)
+    return 'Not a number, filter ignored: %s' % ', '.join(invalid) if invalid else ''
+
+# Predicted IE bars: one style per distinct value in the table instead of
+# shipping a rule for each of the 100 bins with the layout. Bins are 2 % wide
+# from -100 to 100, the bar is drawn from the centre to the bin's bound.
+app.clientside_callback(
+    """
+    function(rows) {
+        var styles = [];
+        var seen = {};
+        rows.forEach(function(row) {
+            var value = row.IE_krr;
+            if (value === null || value < -100 || seen[value]) {
+                return;
+            }
+            seen[value] = true;
+            var bin = Math.min(Math.floor((value + 100) / 2) + 1, 100);
+            var bound = 2 * bin - 100;
+            var background;
+            if (bound >= 40) {
+                background = 'linear-gradient(90deg, white 0%, white 50%, #3D9970 50%, #3D9970 ' +
+                    bin + '%, white ' + bin + '%, white 100%)';
+            } else if (bound >= 0) {
+                background = 'linear-gradient(90deg, white 0%, white 50%, #e9d700 50%, #e9d700 ' +
+                    bin + '%, white ' + bin + '%, white 100%)';
+            } else {
+                background = 'linear-gradient(90deg, white 0%, white ' + (bin - 1) + '%, #FF4136 ' +
+                    (bin - 1) + '%, #FF4136 50%, white 50%, white 100%)';
+            }
+            styles.push({
+                'if': {'filter_query': '{IE_krr} = ' + value, 'column_id': 'IE_krr'},
+                'paddingBottom': 2,
+                'paddingTop': 2,
+                'background': background
+            });
+        });
+        return styles;
+    }
+    """,
+    Output('table', 'style_data_conditional'),
+    [Input('table', 'data')]
+)
+
+app.clientside_callback(
+    """
+    function(neighbours) {
+        return (neighbours && neighbours.status) || '';
+    }
+    """,
+    Output('substructure-status', 'children'),
+    [Input('neighbours', 'data')]
+)
+
+# approximate searches rank by descriptor similarity, another scale than
+# the kernel values of the exact search
+app.clientside_callback(
+    """
+    function(neighbours, columns) {
+        var name = neighbours && neighbours.similarity === 'descriptor' ?
+            'Descriptor similarity / %' : 'Similarity / %';
+        if (columns.every(function(column) { return column.id !== 'sim_val' || column.name === name; })) {
+            return window.dash_clientside.no_update;
+        }
+        return columns.map(function(column) {
+            return column.id === 'sim_val' ? Object.assign({}, column, {name: name}) : column;
+        });
+    }
+    """,
+    Output('table', 'columns'),
+    [Input('neighbours', 'data')],
+    [State('table', 'columns')]
+)
+
+app.clientside_callback(
+    """
+    function(rows, selected_rows, clickData, neighbours) {
+        var triggered = window.dash_clientside.callback_context.triggered.map(function(t) {
+            return t.prop_id;
+        });
+        // a library compound clicked on the map is shown directly
+        if (triggered.indexOf('basic-interactions.clickData') >= 0) {
+            var point = clickData && clickData.points[0];
+            if (neighbours && point && Array.isArray(point.customdata) && typeof point.customdata[0] === 'string') {
+                return [{dataset: neighbours.dataset, name: point.customdata[0]}, [point.customdata[1]]];
+            }
+            return [window.dash_clientside.no_update, window.dash_clientside.no_update];
+        }
+        if (!neighbours || !rows || !rows.length) {
+            return [window.dash_clientside.no_update, window.dash_clientside.no_update];
+        }
+        var selected = (selected_rows && selected_rows.length) ? selected_rows[0] : 0;
+        var row = rows[selected] || rows[0];
+        return [{dataset: neighbours.dataset, name: row.Filename}, [row.Identifier]];
+    }
+    """,
+    [Output('similar-structure', 'data'), Output('sim_text', 'children')],
+    [Input('table', 'data'), Input('table', 'selected_rows'), Input('basic-interactions', 'clickData')],
+    [State('neighbours', 'data')]
+)
+
+@app.callback(
+    Output('sim-speck', 'data'),
+    [Input('similar-structure', 'data')]
+)
+def update_similar_structure(selected):
+    # the store is written by the browser, only library compounds are served
+    if not selected or selected.get('dataset') not in registry.specs:
+        raise PreventUpdate
+    ds = registry.get(selected['dataset'])
+    name = selected.get('name')
+    if not isinstance(name, str) or name not in ds.cas_rows:
+        raise PreventUpdate
+    return structure_store.read_structure(name, ds.structures)
 
 @app.callback(
     Output("modal-centered", "is_open"),
@@ -669,6 +1211,176 @@ def toggle_navbar_collapse(n, is_open):
         return not is_open
     return is_open
 
+### API
+def parse_references(ds, refs):
+    # reference compounds by name or by row of the reference table
+    rows = []
+    for ref in refs:
+        if isinstance(ref, int) and not isinstance(ref, bool) and 0 <= ref < len(ds.compound_names):
+            rows.append(ref)
+        elif isinstance(ref, str) and ref in ds.compound_rows:
+            rows.append(ds.compound_rows[ref])
+        else:
+            raise ValueError('Unknown reference compound: %r' % (ref,))
+    return rows
+
+def parse_k(ds, request):
+    # a whole number or 'all', floats and booleans are not truncated
+    no = request.get('k', 10)
+    if no == 'all':
+        return ds.sim.n_commercial
+    if not isinstance(no, int) or isinstance(no, bool) or not 1 <= no <= ds.sim.n_commercial:
+        raise ValueError('k must be a whole number between 1 and %d, or "all"' % ds.sim.n_commercial)
+    return no
+
+def request_dataset(request):
+    dataset_id = request.get('dataset')
+    if dataset_id is not None and not isinstance(dataset_id, str):
+        raise ValueError('dataset must be a string')
+    if dataset_id is not None and dataset_id not in registry.specs:
+        raise ValueError('Unknown dataset: %s' % dataset_id)
+    return registry.get(dataset_id)
+
+def neighbour_json(ds, idx, scores):
+    columns = ds.struc_columns
+    return [
+        {'CAS': cas, 'SMILES': smiles, 'similarity': similarity, 'IE_krr': ie_krr}
+        for cas, smiles, similarity, ie_krr in zip(
+            columns['Filename'][idx].tolist(),
+            columns['Identifier'][idx].tolist(),
+            np.asarray(scores).tolist(),
+            columns['IE_krr'][idx].tolist())
+    ]
+
+def similar_results(ds, rows, no, chunk=16):
+    # one result per reference, computed chunk-wise so that streamed
+    # responses never hold more than `chunk` kernel rows
+    for start in range(0, len(rows), chunk):
+        block = rows[start:start + chunk]
+        max_idx, scores = simbapre_batch(ds.sim, block, no)
+        for row, idx, score in zip(block, max_idx, scores):
+            yield {
+                'compound': ds.compound_names[row],
+                'row': row,
+                'neighbours': neighbour_json(ds, idx, score)
+            }
+
+def score_structure(ds, atoms, no):
+    model = oos_model(ds)
+    query = descriptors.soap_descriptor(atoms)
+    scores = descriptors.similarity(query, model['descriptors'].matrix)[model['commercial']]
+    max_idx = np.argpartition(scores, -no)[-no:]
+    max_idx = max_idx[np.argsort(-scores[max_idx], kind='stable')]
+    return {
+        'IE_krr': float(model['krr'].predict(query)[0]),
+        'neighbours': neighbour_json(ds, max_idx, scores[max_idx])
+    }
+
+def request_object():
+    # the JSON object posted to an API endpoint, {} without a body
+    request = flask.request.get_json(silent=True)
+    if request is None:
+        return {}
+    if not isinstance(request, dict):
+        raise ValueError('Expected a JSON object')
+    return request
+
+@server.route('/api/score', methods=['POST'])
+def api_score():
+    # {"xyz": "<contents of an .xyz file>"} or {"smiles": "OCC(N)(CO)CO"},
+    # "k": 10, optionally "dataset": "<id from datasets.json>"
+    try:
+        request = request_object()
+        ds = request_dataset(request)
+        no = parse_k(ds, request)
+        for key in ('xyz', 'smiles'):
+            if key in request and not isinstance(request[key], str):
+                raise ValueError('%s must be a string' % key)
+        if 'xyz' in request:
+            atoms = structure_store.parse_xyz(request['xyz'])
+        elif 'smiles' in request:
+            atoms = descriptors.atoms_from_smiles(request['smiles'])
+        else:
+            raise ValueError('Either xyz or smiles is required')
+        if not atoms:
+            raise ValueError('No atoms found in structure')
+    except ValueError as error:
+        return flask.jsonify({'error': str(error)}), 400
+    try:
+        model = oos_model(ds)
+    except ValueError as error:
+        # descriptors built with other parameters than descriptors.PARAMS
+        return flask.jsonify({'error': str(error)}), 503
+    if model is None:
+        return flask.jsonify({'error': 'descriptors not built, run python descriptors.py build'}), 503
+    return flask.jsonify(score_structure(ds, atoms, no))
+
+@server.route('/api/cache', methods=['GET'])
+def api_cache():
+    # hit rate of the response cache in this worker, entries on this machine
+    return flask.jsonify(response_cache.cache.stats())
+
+@server.route('/api/similar', methods=['POST'])
+def api_similar():
+    # {"compounds": ["tris", 12, ...], "k": 10, "format": "json" | "ndjson"},
+    # optionally "dataset": "<id from datasets.json>"
+    try:
+        request = request_object()
+        compounds = request.get('compounds', [])
+        if not isinstance(compounds, list):
+            raise ValueError('compounds must be a list')
+        ds = request_dataset(request)
+        rows = parse_references(ds, compounds)
+        no = parse_k(ds, request)
+    except ValueError as error:
+        return flask.jsonify({'error': str(error)}), 400
+
+    if request.get('format') == 'ndjson':
+        lines = (json.dumps(result) + '\n' for result in similar_results(ds, rows, no))
+        return flask.Response(flask.stream_with_context(lines), mimetype='application/x-ndjson')
+    return flask.jsonify({'k': no, 'results': list(similar_results(ds, rows, no))})
+
+## Metrics, EXCHEM_METRICS=1 serves them at /metrics
+def cache_samples(hits, misses, **labels):
+    return [(dict(labels, result='hit'), hits), (dict(labels, result='miss'), misses)]
+
+def cache_lookups():
+    structures = structure_store.read_structure.cache_info()
+    responses = response_cache.cache.stats()
+    samples = cache_samples(responses['hits'], responses['misses'], cache='response')
+    samples += cache_samples(structures.hits, structures.misses, cache='structure')
+    for name, func in [('neighbour_table', neighbour_table), ('neighbour_view', neighbour_view)]:
+        info = func.cache_info()
+        samples += cache_samples(info.hits, info.misses, cache=name)
+    return samples
+
+def kernel_memory():
+    with registry.lock:
+        loaded = list(registry.loaded.values())
+    return [({'dataset': ds.id, 'mode': ds.sim.mode, 'dtype': ds.sim.array.dtype.name}, ds.sim.nbytes)
+            for ds in loaded]
+
+metrics.register(metrics.Collector('exchem_cache_lookups_total', 'Cache lookups by result', cache_lookups,
+                                   type='counter'))
+metrics.register(metrics.Collector('exchem_structure_prefetch_total', 'Structures read ahead or dropped',
+                                   lambda: [({'result': 'read'}, structure_store.prefetcher.prefetched),
+                                            ({'result': 'dropped'}, structure_store.prefetcher.dropped)],
+                                   type='counter'))
+metrics.register(metrics.Collector('exchem_kernel_bytes', 'Kernel array of a loaded dataset', kernel_memory))
+metrics.register(metrics.Collector('exchem_dataset_bytes', 'Loaded dataset including its kernel',
+                                   lambda: [({'dataset': k}, v) for k, v in registry.memory().items()]))
+metrics.init_app(app)
+
+# With `gunicorn --preload` the master imports the app once and workers are
+# forked from it; EXCHEM_PRELOAD_DATASETS=<id>,... (or 'default') also loads
+# datasets before forking so that workers share them from the start
+for dataset_id in filter(None, os.environ.get('EXCHEM_PRELOAD_DATASETS', '').split(',')):
+    dataset_id = registry.default if dataset_id == 'default' else dataset_id
+    registry.get(dataset_id)
+    dataset_figure(dataset_id)
+
+startup.mark('ready', startup.started)
+
 ### run server
 #if __name__ == '__main__':
 #   app.run_server(debug=True, use_reloader=True)  # Turn off reloader if inside Jupyter
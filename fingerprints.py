@@ -0,0 +1,364 @@
+import argparse
+import os
+import re
+import time
+
+import numpy as np
+
+import kernel_store
+
+
+# Structural fingerprints of the library compounds as packed bits (uint64
+# words per compound): one bit per element and per functional group,
+# derived from the SMILES of the library with a small SMILES parser (RDKit
+# is not a dependency of the app). A filter such as "carboxylic_acid !S" is
+# two bit masks, required and excluded features, so screening the whole
+# library is one AND and compare per word. Stored next to the library file
+# as <name>.fp.npz with the size and mtime of the file it was built from.
+ELEMENTS = ['B', 'C', 'N', 'O', 'F', 'Si', 'P', 'S', 'Cl', 'Br', 'I', 'Se', 'As',
+            'Li', 'Na', 'K', 'Mg', 'Ca', 'Ba', 'Al', 'Zn', 'Cu', 'Fe', 'Sn']
+GROUPS = ['parsed', 'metal', 'charged', 'mixture', 'ring', 'aromatic', 'heterocycle', 'benzene', 'pyridine',
+          'azole', 'carboxylic_acid', 'ester', 'amide', 'carbonyl', 'hydroxyl', 'phenol', 'ether', 'amine',
+          'ammonium', 'nitrile', 'nitro', 'halide', 'thiol', 'thioether', 'thiocarbonyl', 'sulfonic_acid',
+          'sulfonamide', 'phosphonic_acid', 'alkene', 'alkyne']
+FEATURES = GROUPS + ELEMENTS
+BITS = {name: i for i, name in enumerate(FEATURES)}
+WORDS = -(-len(FEATURES) // 64)
+ALIASES = {'cooh': 'carboxylic_acid', 'acid': 'carboxylic_acid', 'carboxyl': 'carboxylic_acid',
+           'oh': 'hydroxyl', 'sh': 'thiol', 'nh2': 'amine', 'cn': 'nitrile', 'no2': 'nitro',
+           'so3h': 'sulfonic_acid', 'po3h2': 'phosphonic_acid', 'halogen': 'halide'}
+_lower_names = {name.lower(): name for name in FEATURES}
+
+METALS = {'Li', 'Na', 'K', 'Rb', 'Cs', 'Be', 'Mg', 'Ca', 'Sr', 'Ba', 'Al', 'Zn', 'Cu', 'Fe', 'Sn', 'Co',
+          'Ni', 'Mn', 'Cr', 'Ag', 'Au', 'Pb', 'Hg', 'Cd', 'Ti', 'Zr', 'Mo', 'W', 'V', 'Bi', 'Sb'}
+HALOGENS = {'F', 'Cl', 'Br', 'I'}
+# lowest standard valences of the organic subset, for implicit hydrogens
+VALENCES = {'B': (3,), 'C': (4,), 'N': (3, 5), 'O': (2,), 'P': (3, 5), 'S': (2, 4, 6),
+            'F': (1,), 'Cl': (1,), 'Br': (1,), 'I': (1,)}
+
+
+## SMILES parsing into atoms and bonds
+_token = re.compile(r'\[(?P<bracket>[^\]]+)\]|(?P<organic>Cl|Br|[BCNOPSFI]|[bcnops])'
+                    r'|(?P<bond>[-=#$:/\\.])|(?P<branch>[()])|(?P<ring>%\d\d|\d)')
+_bracket = re.compile(r'^(?P<isotope>\d*)(?P<symbol>[A-Z][a-z]?|se|as|[bcnops])(?P<chiral>@*)'
+                      r'(?P<h>H\d*)?(?P<charge>[+-]+\d*)?(?::\d+)?$')
+_bond_orders = {'-': 1, '=': 2, '#': 3, '$': 4, ':': 1.5, '/': 1, '\\': 1}
+
+
+class Atom:
+    def __init__(self, symbol, aromatic, charge=0, hydrogens=None):
+        self.symbol = symbol
+        self.aromatic = aromatic
+        self.charge = charge
+        # explicit hydrogens of bracket atoms, None: implicit
+        self.explicit_h = hydrogens
+        self.bonds = []
+
+    def valence(self):
+        return sum(order for _, order in self.bonds)
+
+    @property
+    def hydrogens(self):
+        if self.explicit_h is not None:
+            return self.explicit_h
+        # aromatic bonds count 1.5, so an aromatic CH has used 3
+        used = self.valence()
+        for valence in VALENCES.get(self.symbol, (0,)):
+            if valence >= used:
+                return int(valence - used)
+        return 0
+
+
+def _charge(text):
+    if not text:
+        return 0
+    sign = 1 if text[0] == '+' else -1
+    digits = text.lstrip('+-')
+    return sign * (int(digits) if digits else len(text))
+
+
+def parse_smiles(smiles):
+    # atoms and ring closure bonds; raises ValueError for anything that is
+    # not SMILES (some library entries are names)
+    atoms, closures = [], []
+    stack, rings = [], {}
+    previous, bond = None, None
+    position = 0
+    while position < len(smiles):
+        match = _token.match(smiles, position)
+        if match is None:
+            raise ValueError('not SMILES at %d: %s' % (position, smiles))
+        position = match.end()
+        if match.group('bracket'):
+            parts = _bracket.match(match.group('bracket'))
+            if parts is None:
+                raise ValueError('bad bracket atom: %s' % match.group(0))
+            symbol = parts.group('symbol')
+            h = parts.group('h')
+            atom = Atom(symbol.capitalize(), symbol.islower(), _charge(parts.group('charge')),
+                        int(h[1:] or 1) if h else 0)
+        elif match.group('organic'):
+            symbol = match.group('organic')
+            atom = Atom(symbol.capitalize(), symbol.islower())
+        elif match.group('bond'):
+            bond = match.group('bond')
+            if bond == '.':
+                previous, bond = None, None
+            continue
+        elif match.group('branch') == '(':
+            stack.append(previous)
+            continue
+        elif match.group('branch') == ')':
+            if not stack:
+                raise ValueError('unbalanced branch: %s' % smiles)
+            previous, bond = stack.pop(), None
+            continue
+        else:
+            ring = match.group('ring')
+            if previous is None:
+                raise ValueError('ring bond without atom: %s' % smiles)
+            if ring in rings:
+                other, other_bond = rings.pop(ring)
+                _bond(atoms, other, previous, bond or other_bond)
+                closures.append((other, previous))
+            else:
+                rings[ring] = (previous, bond)
+            bond = None
+            continue
+        atoms.append(atom)
+        if previous is not None:
+            _bond(atoms, previous, len(atoms) - 1, bond)
+        previous, bond = len(atoms) - 1, None
+    if rings or stack or not atoms:
+        raise ValueError('incomplete SMILES: %s' % smiles)
+    return atoms, closures
+
+
+def _bond(atoms, a, b, symbol):
+    if symbol is None:
+        order = 1.5 if atoms[a].aromatic and atoms[b].aromatic else 1
+    else:
+        order = _bond_orders[symbol]
+    atoms[a].bonds.append((b, order))
+    atoms[b].bonds.append((a, order))
+
+
+def rings(atoms, closures):
+    # one ring per ring closure: the shortest path between its atoms without
+    # the closing bond, i.e. the smallest rings of fused systems
+    found = []
+    for start, end in closures:
+        previous = {start: None}
+        frontier = [start]
+        while frontier and end not in previous:
+            following = []
+            for atom in frontier:
+                for other, _ in atoms[atom].bonds:
+                    if other in previous or (atom == start and other == end):
+                        continue
+                    previous[other] = atom
+                    following.append(other)
+            frontier = following
+        if end in previous:
+            ring, atom = [], end
+            while atom is not None:
+                ring.append(atom)
+                atom = previous[atom]
+            found.append(ring)
+    return found
+
+
+## Features
+def features(smiles):
+    try:
+        atoms, closures = parse_smiles(smiles)
+    except ValueError:
+        return set()
+    found = {'parsed'}
+    if '.' in smiles:
+        found.add('mixture')
+    for atom in atoms:
+        if atom.symbol in BITS:
+            found.add(atom.symbol)
+        if atom.symbol in METALS:
+            found.add('metal')
+        if atom.charge:
+            found.add('charged')
+        if atom.aromatic:
+            found.add('aromatic')
+    for ring in rings(atoms, closures):
+        found.add('ring')
+        symbols = [atoms[i].symbol for i in ring]
+        aromatic = all(atoms[i].aromatic for i in ring)
+        if any(symbol != 'C' for symbol in symbols):
+            found.add('heterocycle')
+        if aromatic and len(ring) == 6 and set(symbols) == {'C'}:
+            found.add('benzene')
+        if aromatic and len(ring) == 6 and 'N' in symbols:
+            found.add('pyridine')
+        if aromatic and len(ring) == 5 and 'N' in symbols:
+            found.add('azole')
+
+    for atom in atoms:
+        neighbours = [(atoms[i], order) for i, order in atom.bonds]
+        double_o = [a for a, order in neighbours if a.symbol == 'O' and order == 2]
+        # O single bonded: [(atom, its hydrogens + negative charge)]
+        single_o = [a for a, order in neighbours if a.symbol == 'O' and order == 1]
+        acidic_o = [a for a in single_o if a.hydrogens or a.charge < 0]
+        if atom.symbol == 'C' and not atom.aromatic:
+            if double_o:
+                found.add('carbonyl')
+                if acidic_o:
+                    found.add('carboxylic_acid')
+                elif any(len(a.bonds) == 2 for a in single_o):
+                    found.add('ester')
+                if any(a.symbol == 'N' and order == 1 for a, order in neighbours):
+                    found.add('amide')
+            if any(a.symbol == 'S' and order == 2 for a, order in neighbours):
+                found.add('thiocarbonyl')
+            if any(a.symbol == 'N' and order == 3 for a, order in neighbours):
+                found.add('nitrile')
+            if any(a.symbol == 'C' and order == 2 for a, order in neighbours):
+                found.add('alkene')
+            if any(a.symbol == 'C' and order == 3 for a, order in neighbours):
+                found.add('alkyne')
+        if atom.symbol == 'C' and any(a.symbol in HALOGENS for a, _ in neighbours):
+            found.add('halide')
+        if atom.symbol == 'O' and not atom.aromatic and atom.valence() == 1 and atom.hydrogens:
+            carbon = neighbours[0][0]
+            if carbon.symbol == 'C' and not any(a.symbol == 'O' and order == 2
+                                                for a, order in ((atoms[i], o) for i, o in carbon.bonds)):
+                found.add('phenol' if carbon.aromatic else 'hydroxyl')
+        if atom.symbol == 'O' and not atom.aromatic and len(neighbours) == 2 and not atom.hydrogens:
+            if all(a.symbol == 'C' and order == 1 and not any(
+                    atoms[i].symbol == 'O' and o == 2 for i, o in a.bonds) for a, order in neighbours):
+                found.add('ether')
+        if atom.symbol == 'N' and not atom.aromatic:
+            if len(double_o) + len([a for a in single_o if a.charge < 0]) >= 2:
+                found.add('nitro')
+            elif all(order == 1 for _, order in neighbours) and not any(
+                    a.symbol in ('C', 'S') and any(atoms[i].symbol == 'O' and o == 2 for i, o in a.bonds)
+                    for a, _ in neighbours):
+                found.add('ammonium' if atom.charge > 0 and atom.hydrogens == 0 else 'amine')
+        if atom.symbol == 'S':
+            if len(double_o) >= 2:
+                if acidic_o:
+                    found.add('sulfonic_acid')
+                if any(a.symbol == 'N' for a, _ in neighbours):
+                    found.add('sulfonamide')
+            elif not atom.aromatic and atom.valence() <= 2:
+                carbons = [a for a, order in neighbours if a.symbol == 'C' and order == 1]
+                if carbons and atom.hydrogens:
+                    found.add('thiol')
+                elif len(carbons) == 2:
+                    found.add('thioether')
+        if atom.symbol == 'P' and double_o and acidic_o:
+            found.add('phosphonic_acid')
+    return found
+
+
+def fingerprint(smiles):
+    words = np.zeros(WORDS, dtype=np.uint64)
+    for name in features(smiles):
+        words[BITS[name] // 64] |= np.uint64(1) << np.uint64(BITS[name] % 64)
+    return words
+
+
+def build_index(identifiers):
+    return np.array([fingerprint(str(smiles)) for smiles in identifiers], dtype=np.uint64).reshape(-1, WORDS)
+
+
+def index_path(library_path):
+    root, _ = os.path.splitext(library_path)
+    return root + '.fp.npz'
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return np.array([stat.st_size, stat.st_mtime_ns, len(FEATURES)], dtype=np.int64)
+
+
+def load_index(library_path, identifiers):
+    # (re)built when missing, when the library file changed or when the
+    # feature list did
+    path = index_path(library_path)
+    with kernel_store.locked(library_path):
+        if os.path.exists(path):
+            with np.load(path) as f:
+                if np.array_equal(f['signature'], _signature(library_path)):
+                    return f['bits']
+        bits = build_index(identifiers)
+        tmp_path = path + '.%d.tmp.npz' % os.getpid()
+        np.savez(tmp_path, bits=bits, signature=_signature(library_path))
+        os.replace(tmp_path, path)
+    return bits
+
+
+## Queries
+def parse_query(text):
+    # whitespace or comma separated features, '!' or 'no ' excludes one:
+    # "carboxylic_acid pyridine !S"; returns (required, excluded) words
+    required = np.zeros(WORDS, dtype=np.uint64)
+    excluded = np.zeros(WORDS, dtype=np.uint64)
+    terms = re.sub(r'\bno\s+', '!', (text or '').strip(), flags=re.IGNORECASE)
+    for term in filter(None, re.split(r'[\s,]+', terms)):
+        target = required
+        if term.startswith('!'):
+            target, term = excluded, term[1:]
+        name = term if term in BITS else _lower_names.get(term.lower(), ALIASES.get(term.lower()))
+        if name is None:
+            raise ValueError('Unknown feature: %s' % term)
+        target[BITS[name] // 64] |= np.uint64(1) << np.uint64(BITS[name] % 64)
+    if required.any() or excluded.any():
+        # unparsed entries have no features to check against
+        required[BITS['parsed'] // 64] |= np.uint64(1) << np.uint64(BITS['parsed'] % 64)
+    return required, excluded
+
+
+def screen(bits, required, excluded):
+    # boolean mask of the compounds with all required and none of the
+    # excluded features
+    return ((bits & required) == required).all(axis=1) & ((bits & excluded) == 0).all(axis=1)
+
+
+def unparsed(bits, n=None):
+    # number of compounds whose SMILES could not be parsed, never matched by
+    # a filter
+    word, bit = BITS['parsed'] // 64, np.uint64(1) << np.uint64(BITS['parsed'] % 64)
+    return int(((bits[:n, word] & bit) == 0).sum())
+
+
+def candidates(bits, query, n=None):
+    # library columns matching `query`, None for no filter
+    required, excluded = parse_query(query)
+    if not (required.any() or excluded.any()):
+        return None
+    return np.flatnonzero(screen(bits[:n], required, excluded))
+
+
+if __name__ == '__main__':
+    import datasets
+
+    parser = argparse.ArgumentParser(description='Structural fingerprints of the library')
+    parser.add_argument('query', nargs='?', default='', help='e.g. "carboxylic_acid !S"')
+    parser.add_argument('--dataset', default=None)
+    parser.add_argument('--list', action='store_true', help='print the features')
+    args = parser.parse_args()
+
+    if args.list:
+        print(' '.join(FEATURES))
+        print('aliases: ' + ' '.join('%s=%s' % item for item in ALIASES.items()))
+    else:
+        ds = datasets.DatasetRegistry().get(args.dataset)
+        bits = load_index(ds.spec['library']['file'], ds.struc_columns['Identifier'])
+        try:
+            start = time.perf_counter()
+            found = candidates(bits, args.query)
+            elapsed = time.perf_counter() - start
+        except ValueError as error:
+            parser.error(str(error))
+        count = len(bits) if found is None else len(found)
+        print('%d of %d compounds in %.3f ms, %d without parseable SMILES' % (
+            count, len(bits), 1e3 * elapsed, unparsed(bits)))
+        for i in (found if found is not None else range(len(bits)))[:20]:
+            print('  %s  %s' % (ds.struc_columns['Filename'][i], ds.struc_columns['Identifier'][i]))
@@ -0,0 +1,286 @@
+import argparse
+import csv
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import descriptors
+import fingerprints
+import kernel_store
+import structure_store
+
+
+# Structure ingest: smiles/*.smi (or any .smi catalogue) lines
+# "<SMILES>\t<structure dir>/<name>.xyz" to 3D structures, generated with
+# RDKit (descriptors.atoms_from_smiles) on a process pool. Every entry is
+# validated first: two fields, a target inside the structure directory,
+# SMILES the fingerprint parser accepts, and one SMILES per target
+# (identical duplicates are dropped, conflicting ones rejected).
+#
+# <structure dir>.ingest.json records the hash of the SMILES and generator
+# of every structure written, entries with an unchanged hash are skipped.
+# Structure files that exist without a record (hand-made or from before the
+# ingest) are adopted rather than regenerated, unless --force. The record is
+# saved after every batch, so an interrupted run resumes where it stopped.
+# New compounds are then appended to the library table and the structures
+# repacked, both written to a temporary file and moved in place.
+#
+# New library rows go before the reference rows at the end of the table and
+# have no kernel columns yet: they are listed and shown, but only searched
+# once the kernel is recomputed in the table's row order and its
+# reference_offset and library_columns raised by the number added. smiles/
+# holds the reference compounds, which are regenerated but never added.
+# bump when descriptors.atoms_from_smiles changes, regenerates everything
+GENERATOR = 'rdkit-etkdg-mmff-1'
+BATCH = 1000
+_name = re.compile(r'^[^\s/\\.][^\s/\\]*$')
+
+
+def manifest_path(directory):
+    # next to, not inside, the structure directory: writing into it would
+    # make packs without file signatures look stale (structure_store.load_pack)
+    return os.path.normpath(directory) + '.ingest.json'
+
+
+def entry_hash(smiles):
+    return hashlib.sha1(('%s\t%s' % (GENERATOR, smiles)).encode()).hexdigest()
+
+
+def smi_files(sources):
+    # .smi files given directly or found in the given directories
+    files = []
+    for source in sources:
+        if os.path.isdir(source):
+            files += [os.path.join(source, name) for name in sorted(os.listdir(source)) if name.endswith('.smi')]
+        else:
+            files.append(source)
+    return files
+
+
+def read_entries(files, directory):
+    # {name: (smiles, target)} of the valid entries and [(location, problem)]
+    # of the others
+    entries, origins, problems = {}, {}, []
+    for path in files:
+        with open(path, encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                location = '%s:%d' % (path, number)
+                if not line.strip() or line.startswith('#'):
+                    continue
+                fields = line.split()
+                if len(fields) != 2:
+                    problems.append((location, 'expected "<SMILES> <target>.xyz"'))
+                    continue
+                smiles, target = fields
+                name, ext = os.path.splitext(os.path.basename(target))
+                if ext != '.xyz' or os.path.normpath(os.path.dirname(target)) != os.path.normpath(directory):
+                    problems.append((location, '%s is not an .xyz file in %s/' % (target, directory)))
+                    continue
+                if not _name.match(name):
+                    problems.append((location, 'invalid compound name %r' % name))
+                    continue
+                try:
+                    fingerprints.parse_smiles(smiles)
+                except ValueError as error:
+                    problems.append((location, str(error)))
+                    continue
+                if name in entries:
+                    if entries[name][0] != smiles:
+                        problems.append((location, '%s already has SMILES %s from %s' % (
+                            name, entries[name][0], origins[name])))
+                    else:
+                        problems.append((location, 'duplicate of %s, skipped' % origins[name]))
+                    continue
+                entries[name] = (smiles, os.path.join(directory, name + '.xyz'))
+                origins[name] = location
+    return entries, problems
+
+
+def xyz_text(atoms):
+    # the layout of the existing structure files
+    lines = ['%d' % len(atoms), '   ']
+    lines += ['%-2s%16.5f%15.5f%15.5f' % (atom['symbol'], atom['x'], atom['y'], atom['z']) for atom in atoms]
+    return '\n'.join(lines) + '\n'
+
+
+def generate(entry):
+    # runs in a pool process: (name, smiles, target) -> (name, error or None)
+    name, smiles, target = entry
+    try:
+        atoms = descriptors.atoms_from_smiles(smiles)
+    except ValueError as error:
+        return name, str(error)
+    tmp_path = target + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(xyz_text(atoms))
+    os.replace(tmp_path, target)
+    return name, None
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(path, manifest):
+    tmp_path = path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, separators=(',', ':'), sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def plan(entries, manifest, force=False):
+    # names to generate; records structures that exist without a record
+    # (adopted) and returns (pending, skipped, adopted)
+    pending, skipped, adopted = [], 0, 0
+    for name, (smiles, target) in sorted(entries.items()):
+        digest = entry_hash(smiles)
+        exists = os.path.exists(target)
+        if exists and manifest.get(name) == digest and not force:
+            skipped += 1
+        elif exists and name not in manifest and not force:
+            manifest[name] = digest
+            adopted += 1
+        else:
+            pending.append(name)
+    return pending, skipped, adopted
+
+
+def run(entries, manifest, path, pending, jobs=None, batch=BATCH):
+    # generates the pending structures batch by batch, the manifest is saved
+    # after each; returns {name: error} of the failed entries
+    failed = {}
+    done = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(jobs) as pool:
+        for first in range(0, len(pending), batch):
+            names = pending[first:first + batch]
+            work = [(name,) + entries[name] for name in names]
+            chunk = max(1, len(work) // (4 * (jobs or os.cpu_count() or 1)))
+            for name, error in pool.map(generate, work, chunksize=chunk):
+                if error is None:
+                    manifest[name] = entry_hash(entries[name][0])
+                else:
+                    manifest.pop(name, None)
+                    failed[name] = error
+            save_manifest(path, manifest)
+            done += len(names)
+            print('%d / %d structures, %.1f / s' % (done, len(pending), done / (time.perf_counter() - start)),
+                  file=sys.stderr)
+    return failed
+
+
+def reference_names(spec):
+    reference = spec['reference']
+    with open(reference['file'], newline='', encoding='utf-8') as f:
+        return {row[reference['name']] for row in csv.DictReader(f)}
+
+
+def append_library(spec, entries, names):
+    # inserts the compounds not yet in the library table with their SMILES
+    # at the end of its library rows, without rewriting the existing ones:
+    # the table lists the reference compounds last, in the order of the
+    # kernel rows from reference_offset, and a kernel recomputed in the
+    # table's row order only has library columns for rows before them.
+    # Reference compounds are never added. Returns (number added, number of
+    # reference rows after them).
+    library = spec['library']
+    path = library['file']
+    references = reference_names(spec)
+    with kernel_store.locked(path):
+        with open(path, newline='', encoding='utf-8') as f:
+            text = f.read()
+        # the rows and the line each of them ends on
+        reader = csv.reader(io.StringIO(text))
+        rows, ends = [], []
+        for row in reader:
+            if row:
+                rows.append(row)
+                ends.append(reader.line_num)
+        header = rows[0]
+        column = header.index(library['id'])
+        body = rows[1:]
+        known = {row[column] for row in body}
+        new = [name for name in names if name not in known and name not in references]
+        position = len(body)
+        while position and body[position - 1][column] in references:
+            position -= 1
+        if not new:
+            return 0, len(body) - position
+        lines = io.StringIO(text).readlines()
+        if not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        for name in new:
+            values = {library['id']: name, library['smiles']: entries[name][0]}
+            writer.writerow([values.get(column, 'nan') for column in header])
+        # the existing lines are kept verbatim
+        split = ends[position]
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+            f.writelines(lines[:split])
+            f.write(out.getvalue())
+            f.writelines(lines[split:])
+        os.replace(tmp_path, path)
+    return len(new), len(body) - position
+
+
+if __name__ == '__main__':
+    import datasets
+
+    parser = argparse.ArgumentParser(description='Generate missing or changed structures from .smi files')
+    parser.add_argument('sources', nargs='*', default=['smiles'], help='.smi files or directories of them')
+    parser.add_argument('--dataset', default=None)
+    parser.add_argument('--jobs', type=int, default=None, help='processes (default: all cores)')
+    parser.add_argument('--batch', type=int, default=BATCH, help='structures between manifest saves')
+    parser.add_argument('--force', action='store_true', help='regenerate existing structures too')
+    parser.add_argument('--check', action='store_true', help='only validate and report what would be done')
+    parser.add_argument('--no-library', action='store_true', help='do not add new compounds to the library table')
+    parser.add_argument('--pack', default=structure_store.PACK_PATH, help="packed store to rewrite, '' for none")
+    args = parser.parse_args()
+
+    registry = datasets.DatasetRegistry()
+    spec = registry.specs[args.dataset or registry.default]
+    directory = spec.get('structures', 'structures')
+    entries, problems = read_entries(smi_files(args.sources), directory)
+    for location, problem in problems:
+        print('%s: %s' % (location, problem), file=sys.stderr)
+    path = manifest_path(directory)
+    manifest = load_manifest(path)
+    pending, skipped, adopted = plan(entries, manifest, args.force)
+    print('%d entries: %d unchanged, %d adopted, %d to generate, %d problems' % (
+        len(entries), skipped, adopted, len(pending), len(problems)), file=sys.stderr)
+    if args.check:
+        sys.exit(0)
+    if adopted:
+        save_manifest(path, manifest)
+    failed = {}
+    if pending:
+        try:
+            import rdkit  # noqa: F401
+        except ImportError:
+            parser.error('generating structures requires RDKit')
+        os.makedirs(directory, exist_ok=True)
+        failed = run(entries, manifest, path, pending, args.jobs, args.batch)
+        for name, error in sorted(failed.items()):
+            print('%s: %s' % (name, error), file=sys.stderr)
+    written = [name for name in sorted(entries) if name not in failed]
+    if not args.no_library:
+        added, after = append_library(spec, entries, written)
+        print('%d compounds added to %s' % (added, spec['library']['file']), file=sys.stderr)
+        if added:
+            print('inserted before its %d reference rows; searched once the kernel is recomputed in this row order '
+                  'with reference_offset and library_columns raised by %d' % (after, added), file=sys.stderr)
+    if args.pack and (len(pending) > len(failed) or not os.path.exists(args.pack)):
+        structure_store.write_pack(structure_store.iter_structure_dir(directory), args.pack, directory=directory)
+        print('wrote %s' % args.pack, file=sys.stderr)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,360 @@
+import argparse
+import fcntl
+import hashlib
+import os
+
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+
+# Default layout, that of K_c3_g1_commercial.npy: rows 7094+ are the
+# reference compounds of inh_data.csv, columns [:7093] the commercial
+# compounds. Other kernels declare theirs in datasets.json.
+REF_OFFSET = 7094
+N_COMMERCIAL = 7093
+
+
+# Storage types of the reference block. uint16 is fixed point aligned with
+# the 3 decimals the similarities are displayed with: every displayed step
+# of 0.001 is split into 64 sub-steps, the value is stored as
+#   q = 64 * round(v, 3) * 1000 + sub-step within that display step
+# and decoded to (q - 31.5) / 64000, the centre of its sub-step. round(., 3)
+# of a decoded value therefore always gives the original displayed value,
+# and the order of similarities is kept down to 1/64000.
+DTYPES = {'float64': '', 'float32': '.f32', 'uint16': '.u16'}
+U16_STEPS = 64
+U16_SCALE = 1 / (1000 * U16_STEPS)
+U16_OFFSET = -(U16_STEPS / 2 - 0.5) * U16_SCALE
+
+
+class KernelStore:
+    # Read-only view on the reference x commercial part of the kernel.
+    # `array` is either the full kernel or only the reference block; rows of
+    # a uint16 block are decoded to float32 with scale and offset.
+    def __init__(self, array, row_offset, n_commercial, path=None, mode=None, scale=None, offset=0.0):
+        self.array = array
+        self.row_offset = row_offset
+        self.n_commercial = n_commercial
+        self.path = path
+        self.mode = mode
+        self.scale = scale
+        self.offset = offset
+        # optional neighbour_index.NeighbourIndex with precomputed top-K lists
+        self.neighbours = None
+        # full precision kernel a float32 / uint16 block was converted from,
+        # memory-mapped but only read to build the neighbour index
+        self.source = None
+
+    @property
+    def n_reference(self):
+        return self.array.shape[0] - self.row_offset
+
+    def _decode(self, values):
+        if self.scale is None:
+            return values
+        return values.astype(np.float32) * np.float32(self.scale) + np.float32(self.offset)
+
+    def row(self, index):
+        return self._decode(self.array[self.row_offset + index, :self.n_commercial])
+
+    def rows(self, indices):
+        return self._decode(self.array[self.row_offset + np.asarray(indices), :self.n_commercial])
+
+    def columns(self, indices, start, stop):
+        # rows `indices`, library columns start:stop
+        return self._decode(self.array[self.row_offset + np.asarray(indices), start:min(stop, self.n_commercial)])
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
+
+class FactorStore(KernelStore):
+    # Low-rank kernel K ~ F F^T: `array` is the float32 factor F with `rank`
+    # values per kernel row, a row of similarities is one product of its
+    # factor row with the library part of F, O(n_commercial * rank)
+    def __init__(self, array, row_offset, n_commercial, path=None, mode=None):
+        super().__init__(array, row_offset, n_commercial, path=path, mode=mode)
+        self.library = array[:n_commercial]
+
+    @property
+    def rank(self):
+        return self.array.shape[1]
+
+    def row(self, index):
+        return self.library @ self.array[self.row_offset + index]
+
+    def rows(self, indices):
+        return self.array[self.row_offset + np.asarray(indices)] @ self.library.T
+
+    def columns(self, indices, start, stop):
+        return self.array[self.row_offset + np.asarray(indices)] @ self.library[start:stop].T
+
+
+def block_path(path, dtype='float64'):
+    root, ext = os.path.splitext(path)
+    return root + '.block' + DTYPES[dtype] + ext
+
+
+def storage_dtype(path, dtype):
+    # 'float64' stands for the block in the kernel's own type: converting to
+    # the type the kernel already has (float32 for K_c3_g1_commercial.npy)
+    # would only write a copy of that block
+    if dtype != 'float64' and os.path.exists(path) and np.load(path, mmap_mode='r').dtype == np.dtype(dtype):
+        return 'float64'
+    return dtype
+
+
+def encode(values, dtype):
+    # float64 kernel values -> stored block values
+    values = np.asarray(values, dtype=np.float64)
+    if dtype == 'float64':
+        return values
+    if dtype == 'float32':
+        # nudge the few float32 values that would round to another displayed
+        # value towards the original by one ulp
+        encoded = values.astype(np.float32)
+        displayed = values.round(decimals=3)
+        for _ in range(4):
+            wrong = encoded.astype(np.float64).round(decimals=3) != displayed
+            if not wrong.any():
+                break
+            towards = np.where(encoded[wrong] > values[wrong], -np.inf, np.inf).astype(np.float32)
+            encoded[wrong] = np.nextafter(encoded[wrong], towards)
+        return encoded
+    if dtype == 'uint16':
+        scaled = np.clip(values, 0, 1) * 1000
+        displayed = np.rint(scaled)
+        sub = np.clip(np.floor((scaled - displayed + 0.5) * U16_STEPS), 0, U16_STEPS - 1)
+        return (displayed * U16_STEPS + sub).astype(np.uint16)
+    raise ValueError('Unknown kernel dtype: %s' % dtype)
+
+
+def write_block(path, out_path, ref_offset=REF_OFFSET, n_commercial=N_COMMERCIAL, dtype='float64', chunk=1024):
+    # Cut the reference x commercial block out of the full kernel without
+    # loading the full matrix, converted to `dtype` chunk by chunk; written
+    # to a temporary file and moved in place so concurrently starting
+    # workers never see a half-written block
+    full = np.load(path, mmap_mode='r')
+    tmp_path = out_path + '.%d.tmp' % os.getpid()
+    block = np.lib.format.open_memmap(
+        tmp_path, mode='w+', dtype=full.dtype if dtype == 'float64' else dtype,
+        shape=(full.shape[0] - ref_offset, n_commercial))
+    for start in range(0, block.shape[0], chunk):
+        block[start:start + chunk] = encode(full[ref_offset + start:ref_offset + start + chunk, :n_commercial], dtype)
+    block.flush()
+    del block
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+## Low-rank factor, computed once from the full (square) kernel
+def factor_path(path, rank):
+    root, ext = os.path.splitext(path)
+    return '%s.factor%d%s' % (root, rank, ext)
+
+
+def landmark_columns(n, ref_offset, count, seed=0):
+    # the reference compounds, whose rows the app queries, and random
+    # library columns up to `count`
+    references = np.arange(ref_offset, n)
+    others = np.setdiff1d(np.arange(n), references)
+    extra = max(count - len(references), 0)
+    chosen = np.random.default_rng(seed).choice(others, min(extra, len(others)), replace=False)
+    return np.sort(np.concatenate([references, chosen]))
+
+
+def factorise(full, rank, ref_offset=REF_OFFSET, method='nystroem', landmarks=None, seed=0, chunk=1024):
+    # N x rank float32 F with F F^T ~ full, two methods:
+    #   nystroem - K[:, L] W^-1/2 truncated to the top `rank` eigenvalues of
+    #              W = K[L, L], L = landmark_columns (default `rank` of
+    #              them); the rows of landmarks are reproduced exactly when
+    #              rank >= |L|, so with rank >= the number of references the
+    #              rows the app queries are exact
+    #   eigen    - truncated eigendecomposition of the whole kernel, the best
+    #              rank-r approximation overall but not of the reference
+    #              rows, needs N x N floats in memory
+    n = full.shape[0]
+    if full.shape[1] != n:
+        raise ValueError('a factor needs the full square kernel, not a %d x %d block' % full.shape)
+    if method == 'eigen':
+        import scipy.linalg
+        values, vectors = scipy.linalg.eigh(np.asarray(full, dtype=np.float64),
+                                            subset_by_index=[max(n - rank, 0), n - 1])
+    elif method == 'nystroem':
+        columns = landmark_columns(n, ref_offset, landmarks or rank, seed)
+        c = np.empty((n, len(columns)))
+        for start in range(0, n, chunk):
+            c[start:start + chunk] = full[start:start + chunk][:, columns]
+        values, vectors = np.linalg.eigh(c[columns])
+        values, vectors = values[-rank:], vectors[:, -rank:]
+        keep = values > values.max() * 1e-10
+        vectors = c @ (vectors[:, keep] / values[keep])
+        values = values[keep]
+    else:
+        raise ValueError('Unknown factorisation: %s' % method)
+    keep = values > 0
+    return (vectors[:, keep] * np.sqrt(values[keep])).astype(np.float32)
+
+
+def write_factor(path, out_path, rank, ref_offset=REF_OFFSET, **options):
+    factor = factorise(np.load(path, mmap_mode='r'), rank, ref_offset, **options)
+    tmp_path = out_path + '.%d.tmp.npy' % os.getpid()
+    np.save(tmp_path, factor)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def _is_stale(path, derived_path):
+    return (not os.path.exists(derived_path)
+            or os.path.getmtime(derived_path) < os.path.getmtime(path))
+
+
+def locked(path):
+    lock = open(path + '.lock', 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    return lock
+
+
+_segments = []
+
+
+def shared_name(path):
+    # segment name of this version of the kernel file
+    stat = os.stat(path)
+    key = '%s:%d:%d' % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    return 'exchem_' + hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def _load_shared(path):
+    # One copy of the kernel per machine: the first process (the gunicorn
+    # master when running with --preload) copies the file into a named
+    # shared memory segment, everyone else attaches to it. The segment
+    # outlives every process: multiprocessing's resource tracker would
+    # unlink it when the process that created or attached it exits (a
+    # recycled worker, a master without --preload), so it is unregistered.
+    # It is removed with `python kernel_store.py --unlink-shm` or a reboot;
+    # a changed kernel file gets a new segment.
+    name = shared_name(path)
+    src = np.load(path, mmap_mode='r')
+    with locked(path):
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=src.nbytes)
+            np.ndarray(src.shape, dtype=src.dtype, buffer=shm.buf)[:] = src
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    # keep the segment mapped for the lifetime of the process
+    _segments.append(shm)
+    array = np.ndarray(src.shape, dtype=src.dtype, buffer=shm.buf)
+    array.flags.writeable = False
+    return array
+
+
+def unlink_shared(path):
+    # removes the segment of this version of the kernel file; processes
+    # that attached it keep their mapping. Returns whether it existed.
+    try:
+        shm = shared_memory.SharedMemory(name=shared_name(path))
+    except FileNotFoundError:
+        return False
+    shm.close()
+    # also unregisters it from the resource tracker
+    shm.unlink()
+    return True
+
+
+def load_kernel(path='K_c3_g1_commercial.npy', mode='mmap', block=False,
+                ref_offset=REF_OFFSET, n_commercial=N_COMMERCIAL, dtype='float64', rank=0):
+    # mode: 'mmap'   - read-only memory map, pages are shared via the page cache
+    #       'shm'    - named shared memory segment, created once per machine
+    #       'memory' - private in-memory copy per process (previous behaviour)
+    # block: only keep reference rows x commercial columns, cached next to
+    #        the kernel as <name>.block.npy and rebuilt when the kernel changes
+    # dtype: 'float32' or 'uint16' store the block (implies block) as
+    #        <name>.block.f32.npy / <name>.block.u16.npy, the type the
+    #        kernel already has uses <name>.block.npy
+    # rank:  > 0 serves all similarities from the rank-r factor
+    #        <name>.factor<r>.npy (Nystroem, see factorise), built when
+    #        missing or older than the kernel; the kernel itself is not
+    #        needed once the factor exists
+    if dtype not in DTYPES:
+        raise ValueError('Unknown kernel dtype: %s' % dtype)
+    if storage_dtype(path, dtype) != dtype:
+        dtype, block = 'float64', True
+    row_offset = ref_offset
+    source_path = path
+    if rank:
+        out_path = factor_path(path, rank)
+        if os.path.exists(path):
+            with locked(path):
+                if _is_stale(path, out_path):
+                    write_factor(path, out_path, rank, ref_offset)
+        path = out_path
+    elif block or dtype != 'float64':
+        out_path = block_path(path, dtype)
+        with locked(path):
+            if _is_stale(path, out_path):
+                write_block(path, out_path, ref_offset, n_commercial, dtype)
+        path = out_path
+        row_offset = 0
+
+    if mode == 'mmap':
+        array = np.load(path, mmap_mode='r')
+    elif mode == 'shm':
+        array = _load_shared(path)
+    elif mode == 'memory':
+        array = np.load(path)
+    else:
+        raise ValueError('Unknown kernel mode: %s' % mode)
+    if rank:
+        return FactorStore(array, row_offset, n_commercial, path=path, mode=mode)
+    if dtype == 'float64':
+        return KernelStore(array, row_offset, n_commercial, path=path, mode=mode)
+    if dtype == 'uint16':
+        kernel = KernelStore(array, row_offset, n_commercial, path=path, mode=mode,
+                             scale=U16_SCALE, offset=U16_OFFSET)
+    else:
+        kernel = KernelStore(array, row_offset, n_commercial, path=path, mode=mode)
+    kernel.source = KernelStore(np.load(source_path, mmap_mode='r'), ref_offset, n_commercial,
+                                path=source_path, mode='mmap')
+    return kernel
+
+
+def options_from_env():
+    return {'mode': os.environ.get('EXCHEM_KERNEL_MODE', 'mmap'),
+            'block': os.environ.get('EXCHEM_KERNEL_BLOCK', '0') == '1',
+            'dtype': os.environ.get('EXCHEM_KERNEL_DTYPE', 'float64'),
+            'rank': int(os.environ.get('EXCHEM_KERNEL_RANK', '0'))}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the kernel to a reference block of another dtype, '
+                                                 'or to a low-rank factor with --rank')
+    parser.add_argument('kernel', nargs='?', default='K_c3_g1_commercial.npy')
+    parser.add_argument('--dtype', choices=sorted(DTYPES), default='float32')
+    parser.add_argument('--ref-offset', type=int, default=REF_OFFSET)
+    parser.add_argument('--n-commercial', type=int, default=N_COMMERCIAL)
+    parser.add_argument('--rank', type=int, default=0)
+    parser.add_argument('--method', choices=['nystroem', 'eigen'], default='nystroem')
+    parser.add_argument('--landmarks', type=int, default=None, help='Nystroem landmark columns (default rank)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--unlink-shm', action='store_true',
+                        help='remove the shared memory segments of the kernel and its blocks instead')
+    args = parser.parse_args()
+
+    if args.unlink_shm:
+        for path in [args.kernel] + [block_path(args.kernel, dtype) for dtype in DTYPES]:
+            if os.path.exists(path) and unlink_shared(path):
+                print('removed the shared memory segment of %s' % path)
+        parser.exit()
+    with locked(args.kernel):
+        if args.rank:
+            out_path = write_factor(args.kernel, factor_path(args.kernel, args.rank), args.rank, args.ref_offset,
+                                    method=args.method, landmarks=args.landmarks, seed=args.seed)
+        else:
+            dtype = storage_dtype(args.kernel, args.dtype)
+            out_path = write_block(args.kernel, block_path(args.kernel, dtype), args.ref_offset,
+                                   args.n_commercial, dtype)
+    print('wrote %s (%.1f MB, kernel %.1f MB)' % (
+        out_path, os.path.getsize(out_path) / 2**20, os.path.getsize(args.kernel) / 2**20))
@@ -0,0 +1,206 @@
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+# Kernel ridge regression of the reference property on the precomputed
+# kernel, predicting the library column (IE_krr) again when the measured
+# data or the hyperparameters change. The model is fitted on the reference x
+# reference block of the full kernel, the predictions are one matrix-vector
+# product w @ K[train rows, library columns], reduced over chunks of
+# memory-mapped kernel rows by a thread pool.
+#
+# Predictions are written as versions IE_krr.v<N>.npz into the dataset's
+# prediction directory (library.predictions in datasets.json, default
+# <library file>.predictions/); current.json names the active version.
+# Loaded datasets check current.json and swap their library column without
+# a restart (datasets.Dataset.refresh_predictions).
+REGULARISATION = 1e-2
+CURRENT = 'current.json'
+_version_file = re.compile(r'^IE_krr\.v(\d+)\.npz$')
+
+
+def prediction_dir(spec):
+    library = spec['library']
+    return library.get('predictions', os.path.splitext(library['file'])[0] + '.predictions')
+
+
+def full_kernel(spec):
+    # reference rows start at reference_offset, and in a square kernel the
+    # reference columns too (kernel.reference_columns if they differ)
+    kernel = spec['kernel']
+    array = np.load(kernel['file'], mmap_mode='r')
+    row_offset = kernel['reference_offset']
+    column_offset = kernel.get('reference_columns', row_offset)
+    return array, row_offset, column_offset
+
+
+def training_rows(ds, labels=None):
+    # reference rows with the given labels (default: all tested) and a
+    # measured property
+    ref = ds.spec['reference']
+    labels = labels or ref['tested_labels']
+    data = ds.data
+    rows = data.index[data[ref['label']].isin(labels) & data[ref['property']].notna()].values
+    return rows, ds.properties[rows].astype(np.float64)
+
+
+def fit(ds, labels=None, regularisation=REGULARISATION):
+    array, row_offset, column_offset = full_kernel(ds.spec)
+    rows, targets = training_rows(ds, labels)
+    if not len(rows):
+        raise ValueError('No reference compounds with labels %s' % (labels,))
+    # without kernel.reference_columns only a square kernel has them: the
+    # columns of a reference x library block are all library compounds
+    square = array.shape[0] == array.shape[1] or 'reference_columns' in ds.spec['kernel']
+    if not square or array.shape[1] < column_offset + len(ds.data):
+        raise ValueError('%s has no reference x reference block, the model needs the full kernel'
+                         % ds.spec['kernel']['file'])
+    kernel = np.asarray(array[row_offset + rows][:, column_offset + rows], dtype=np.float64)
+    kernel[np.diag_indices_from(kernel)] += regularisation
+    mean = float(targets.mean())
+    inverse = np.linalg.inv(kernel)
+    weights = inverse @ (targets - mean)
+    # closed form leave-one-out residuals of KRR
+    loo = weights / np.diag(inverse)
+    return {'rows': rows, 'targets': targets, 'weights': weights, 'mean': mean,
+            'regularisation': regularisation, 'loo_rmse': float(np.sqrt(np.mean(loo ** 2)))}
+
+
+def predict_chunk(array, rows, weights, n_commercial):
+    return weights @ np.asarray(array[rows, :n_commercial], dtype=np.float64)
+
+
+def predict(ds, model, chunk=256, jobs=None):
+    # chunk x library floats in memory per thread
+    array, row_offset, _ = full_kernel(ds.spec)
+    n_commercial = ds.spec['kernel']['library_columns']
+    rows = row_offset + model['rows']
+    chunks = [slice(start, start + chunk) for start in range(0, len(rows), chunk)]
+    predictions = np.full(n_commercial, model['mean'])
+    # numpy releases the GIL for the products, threads share the kernel
+    with ThreadPoolExecutor(jobs or os.cpu_count()) as pool:
+        for partial in pool.map(
+                lambda c: predict_chunk(array, rows[c], model['weights'][c], n_commercial), chunks):
+            predictions += partial
+    return predictions
+
+
+def versions(directory):
+    # {number: file name} of the written versions
+    if not os.path.isdir(directory):
+        return {}
+    found = {}
+    for name in os.listdir(directory):
+        match = _version_file.match(name)
+        if match:
+            found[int(match.group(1))] = name
+    return found
+
+
+def current_version(directory):
+    # (version, path) of the active predictions, None for the library file
+    try:
+        with open(os.path.join(directory, CURRENT)) as f:
+            version = json.load(f)['version']
+    except (OSError, ValueError, KeyError):
+        return None
+    return version, os.path.join(directory, 'IE_krr.%s.npz' % version)
+
+
+def _write_atomic(path, write):
+    tmp_path = path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def activate(directory, version):
+    # version 'v<N>' of the directory, or None for the library file column
+    if version is None:
+        if os.path.exists(os.path.join(directory, CURRENT)):
+            os.remove(os.path.join(directory, CURRENT))
+        return
+    if not os.path.exists(os.path.join(directory, 'IE_krr.%s.npz' % version)):
+        raise ValueError('Unknown prediction version: %s' % version)
+    _write_atomic(os.path.join(directory, CURRENT), lambda f: f.write(json.dumps({'version': version}).encode()))
+
+
+def write_version(ds, model, predictions, labels=None):
+    # next free version number; the file is complete before it can be
+    # activated
+    directory = prediction_dir(ds.spec)
+    os.makedirs(directory, exist_ok=True)
+    version = 'v%d' % (max(versions(directory), default=0) + 1)
+    info = {'version': version, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'labels': labels or ds.spec['reference']['tested_labels'],
+            'regularisation': model['regularisation'], 'loo_rmse': model['loo_rmse'],
+            'kernel': ds.spec['kernel']['file']}
+    path = os.path.join(directory, 'IE_krr.%s.npz' % version)
+    _write_atomic(path, lambda f: np.savez(
+        f, IE_krr=predictions, rows=model['rows'], weights=model['weights'], info=json.dumps(info)))
+    return version, path
+
+
+def load_predictions(path):
+    with np.load(path) as f:
+        return f['IE_krr'], json.loads(str(f['info']))
+
+
+if __name__ == '__main__':
+    import datasets
+
+    parser = argparse.ArgumentParser(description='KRR predictions of the library property')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('fit', help='fit on the reference compounds and write a new prediction version')
+    p.add_argument('--labels', nargs='+', default=None, help='reference labels to fit on (default: tested)')
+    p.add_argument('--regularisation', type=float, default=REGULARISATION)
+    p.add_argument('--chunk', type=int, default=256, help='kernel rows per chunk')
+    p.add_argument('--jobs', type=int, default=None)
+    p.add_argument('--no-activate', action='store_true', help='write the version without serving it')
+    p = sub.add_parser('list', help='written versions, * marks the active one')
+    p = sub.add_parser('activate', help="serve a version, 'library' for the library file column")
+    p.add_argument('version')
+    for p in sub.choices.values():
+        p.add_argument('--dataset', default=None)
+    args = parser.parse_args()
+
+    registry = datasets.DatasetRegistry()
+    spec = registry.specs[args.dataset or registry.default]
+    directory = prediction_dir(spec)
+    if args.command == 'fit':
+        ds = registry.get(spec['id'])
+        try:
+            model = fit(ds, args.labels, args.regularisation)
+        except ValueError as error:
+            parser.error(str(error))
+        start = time.perf_counter()
+        predictions = predict(ds, model, args.chunk, args.jobs)
+        elapsed = time.perf_counter() - start
+        version, path = write_version(ds, model, predictions, args.labels)
+        if not args.no_activate:
+            activate(directory, version)
+        library = ds.struc_columns['IE_krr'][:len(predictions)].astype(np.float64)
+        print('wrote %s: %d references, LOO RMSE %.1f, %d predictions in %.2f s, RMS change %.1f%s' % (
+            path, len(model['rows']), model['loo_rmse'], len(predictions), elapsed,
+            np.sqrt(np.nanmean((predictions - library) ** 2)), '' if args.no_activate else ', active'),
+            file=sys.stderr)
+    elif args.command == 'list':
+        current = current_version(directory)
+        for number, name in sorted(versions(directory).items()):
+            _, info = load_predictions(os.path.join(directory, name))
+            print('%s v%d  %s  labels=%s  regularisation=%g  LOO RMSE %.1f' % (
+                '*' if current and current[0] == 'v%d' % number else ' ', number, info['created'],
+                ','.join(info['labels']), info['regularisation'], info['loo_rmse']))
+        print('%s library  %s' % (' ' if current else '*', spec['library']['file']))
+    else:
+        try:
+            activate(directory, None if args.version == 'library' else args.version)
+        except ValueError as error:
+            parser.error(str(error))
@@ -0,0 +1,155 @@
+import argparse
+import math
+import os
+
+import numpy as np
+
+import kernel_store
+
+
+# The library compounds on the sketch-map of the references. Sketch-map
+# itself is not part of the app, so library compounds are placed out of
+# sample by kernel interpolation: the weighted mean position of their K most
+# similar references, weights similarity^POWER. Positions are computed once
+# and stored next to the library file as <name>.map.npz together with the
+# signatures of the kernel and reference files.
+#
+# For drawing, a uniform grid index returns the compounds inside a viewport
+# without scanning the library; zoomed out, they are aggregated into
+# hexagonal bins of a fixed size on screen, so both the payload and the
+# callback time are bounded whatever the size of the library.
+NEIGHBOURS = int(os.environ.get('EXCHEM_MAP_NEIGHBOURS', '8'))
+POWER = float(os.environ.get('EXCHEM_MAP_POWER', '8'))
+MAX_POINTS = int(os.environ.get('EXCHEM_MAP_POINTS', '2000'))
+# hexagon width in pixels
+HEX_SIZE = 14
+
+
+def interpolate(similarities, positions, k=NEIGHBOURS, power=POWER):
+    # similarities: references x compounds, positions: references x 2
+    k = min(k, len(similarities))
+    top = np.argpartition(-similarities, k - 1, axis=0)[:k]
+    weights = np.clip(np.take_along_axis(similarities, top, axis=0), 0, None) ** power
+    weights /= np.maximum(weights.sum(axis=0), 1e-300)
+    return np.einsum('kn,knd->nd', weights, positions[top])
+
+
+def project(kernel, positions, k=NEIGHBOURS, power=POWER, chunk=4096):
+    # kernel: kernel_store.KernelStore with the references as rows
+    # references x library similarities are read once, the interpolation
+    # temporaries are bounded by the chunk of library columns
+    xy = np.empty((kernel.n_commercial, 2), dtype=np.float32)
+    similarities = np.asarray(kernel.rows(np.arange(kernel.n_reference)))
+    for start in range(0, kernel.n_commercial, chunk):
+        block = similarities[:, start:start + chunk].astype(np.float64)
+        xy[start:start + block.shape[1]] = interpolate(block, positions, k, power)
+    return xy
+
+
+def leave_one_out(reference_kernel, positions, k=NEIGHBOURS, power=POWER):
+    # distance of every reference from its sketch-map position when it is
+    # placed from the others, to validate the interpolation
+    similarities = np.array(reference_kernel, dtype=np.float64)
+    np.fill_diagonal(similarities, -np.inf)
+    return np.linalg.norm(interpolate(similarities, positions, k, power) - positions, axis=1)
+
+
+def map_path(library_path):
+    root, _ = os.path.splitext(library_path)
+    return root + '.map.npz'
+
+
+def _signature(paths, k, power):
+    values = []
+    for path in paths:
+        stat = os.stat(path)
+        values += [stat.st_size, stat.st_mtime_ns]
+    return np.array(values + [k, power], dtype=np.float64)
+
+
+def load_map(spec, kernel, positions, k=NEIGHBOURS, power=POWER):
+    # positions of the library compounds, (re)built when missing or when
+    # the kernel or reference file changed
+    path = map_path(spec['library']['file'])
+    signature = _signature([spec['kernel']['file'], spec['reference']['file']], k, power)
+    with kernel_store.locked(spec['library']['file']):
+        if os.path.exists(path):
+            with np.load(path) as f:
+                if np.array_equal(f['signature'], signature):
+                    return f['xy']
+        xy = project(kernel.source or kernel, positions, k, power)
+        tmp_path = path + '.%d.tmp.npz' % os.getpid()
+        np.savez(tmp_path, xy=xy, signature=signature)
+        os.replace(tmp_path, path)
+    return xy
+
+
+class GridIndex:
+    # compounds sorted by the cell of a size x size grid over their bounds,
+    # a viewport reads one contiguous slice per grid column
+    def __init__(self, xy, size=128):
+        self.xy = xy
+        self.size = size
+        self.low = xy.min(axis=0) if len(xy) else np.zeros(2)
+        self.cell = np.maximum((xy.max(axis=0) - self.low) / size, 1e-12) if len(xy) else np.ones(2)
+        cells = self._cells(xy)
+        ids = cells[:, 0] * size + cells[:, 1]
+        self.order = np.argsort(ids, kind='stable')
+        self.starts = np.searchsorted(ids[self.order], np.arange(size * size + 1))
+
+    def _cells(self, xy):
+        return np.clip(((xy - self.low) / self.cell).astype(np.int64), 0, self.size - 1)
+
+    def query(self, x0, x1, y0, y1):
+        (cx0, cy0), (cx1, cy1) = self._cells(np.array([[x0, y0], [x1, y1]]))
+        slices = [self.order[self.starts[cx * self.size + cy0]:self.starts[cx * self.size + cy1 + 1]]
+                  for cx in range(cx0, cx1 + 1)]
+        found = np.concatenate(slices) if slices else np.array([], dtype=np.int64)
+        x, y = self.xy[found, 0], self.xy[found, 1]
+        return np.sort(found[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)])
+
+
+def hexbin(x, y, values, x0, x1, y0, y1, width, height, size=HEX_SIZE):
+    # hexagon centres (data units), counts and mean value per non-empty
+    # hexagon, binned in screen pixels so hexagons are regular on screen;
+    # two rectangular lattices, each point goes to the nearer centre
+    px = (x - x0) * width / (x1 - x0)
+    py = (y - y0) * height / (y1 - y0)
+    sx, sy = size, size * math.sqrt(3)
+    ix1, iy1 = np.rint(px / sx), np.rint(py / sy)
+    ix2, iy2 = np.floor(px / sx), np.floor(py / sy)
+    d1 = (px - ix1 * sx) ** 2 + (py - iy1 * sy) ** 2
+    d2 = (px - (ix2 + 0.5) * sx) ** 2 + (py - (iy2 + 0.5) * sy) ** 2
+    second = d2 < d1
+    cx = np.where(second, ix2 + 0.5, ix1) * sx
+    cy = np.where(second, iy2 + 0.5, iy1) * sy
+    centres, inverse, counts = np.unique(np.column_stack((cx, cy)), axis=0, return_inverse=True,
+                                         return_counts=True)
+    means = np.bincount(inverse.ravel(), weights=values, minlength=len(centres)) / counts
+    return (x0 + centres[:, 0] * (x1 - x0) / width, y0 + centres[:, 1] * (y1 - y0) / height,
+            counts, means)
+
+
+if __name__ == '__main__':
+    import datasets
+    import krr
+
+    parser = argparse.ArgumentParser(description='Place the library compounds on the sketch-map, the app '
+                                                 'uses EXCHEM_MAP_NEIGHBOURS and EXCHEM_MAP_POWER')
+    parser.add_argument('--dataset', default=None)
+    parser.add_argument('--k', type=int, default=NEIGHBOURS)
+    parser.add_argument('--power', type=float, default=POWER)
+    args = parser.parse_args()
+
+    ds = datasets.DatasetRegistry().get(args.dataset)
+    positions = np.column_stack((ds.column('x').values, ds.column('y').values)).astype(np.float64)
+    xy = load_map(ds.spec, ds.sim, positions, args.k, args.power)
+    print('placed %d compounds, %s' % (len(xy), map_path(ds.spec['library']['file'])))
+    array, row_offset, column_offset = krr.full_kernel(ds.spec)
+    n_ref = len(positions)
+    if array.shape[1] >= column_offset + n_ref:
+        errors = leave_one_out(array[row_offset:row_offset + n_ref, column_offset:column_offset + n_ref],
+                               positions, args.k, args.power)
+        extent = np.linalg.norm(positions.max(axis=0) - positions.min(axis=0))
+        print('leave-one-out error of the references: median %.3f, 90%% %.3f (map diagonal %.3f)' % (
+            np.median(errors), np.percentile(errors, 90), extent))
@@ -0,0 +1,210 @@
+import bisect
+import contextlib
+import functools
+import os
+import threading
+import time
+
+import flask
+import psutil
+
+
+# Prometheus metrics in the text exposition format, enabled with
+# EXCHEM_METRICS=1 and served at /metrics. When disabled, timed() returns the
+# function unchanged, timer() a shared no-op context and nothing is hooked
+# into Flask or Dash. Values are per process: with several gunicorn workers
+# each scrape reports the worker that answered it (label `pid`).
+ENABLED = os.environ.get('EXCHEM_METRICS', '0') == '1'
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in labels)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name, self.help = name, help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name, self.help = name, help
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # per bucket counts (last one +Inf), sum
+                counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append((self.name + '_bucket', key + (('le', le),), cumulative))
+                samples.append((self.name + '_sum', key, total))
+                samples.append((self.name + '_count', key, cumulative))
+        return samples
+
+
+class Collector:
+    # values read at scrape time from state kept elsewhere (cache counters,
+    # memory), `collect` returns [(labels dict, value), ...]
+    def __init__(self, name, help, collect, type='gauge'):
+        self.name, self.help = name, help
+        self.collect = collect
+        self.type = type
+
+    def samples(self):
+        return [(self.name, tuple(sorted(labels.items())), value) for labels, value in self.collect()]
+
+
+_metrics = []
+
+
+def register(metric):
+    _metrics.append(metric)
+    return metric
+
+
+def render():
+    lines = []
+    pid = ('pid', os.getpid())
+    for metric in _metrics:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.type))
+        for name, labels, value in metric.samples():
+            lines.append('%s%s %s' % (name, _label_text((pid,) + tuple(labels)), repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+stage_seconds = register(Histogram('exchem_stage_seconds', 'Time spent in a stage of a request'))
+callback_seconds = register(Histogram('exchem_callback_seconds', 'Dash callback time including serialisation'))
+callback_bytes = register(Counter('exchem_callback_response_bytes_total', 'Dash callback response bodies'))
+request_seconds = register(Histogram('exchem_http_request_seconds', 'Flask request time'))
+requests_total = register(Counter('exchem_http_requests_total', 'Flask requests'))
+register(Collector('exchem_process_resident_bytes', 'Resident memory of this process',
+                   lambda: [({}, psutil.Process().memory_info().rss)]))
+
+
+## Instrumentation
+_disabled = contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def _timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage=stage)
+
+
+def timer(stage):
+    return _timer(stage) if ENABLED else _disabled
+
+
+def timed(stage):
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stage_seconds.observe(time.perf_counter() - start, stage=stage)
+        return wrapper
+    return decorator
+
+
+def _timed_callback(func, name):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        response = func(*args, **kwargs)
+        callback_seconds.observe(time.perf_counter() - start, callback=name)
+        return response
+    return wrapper
+
+
+def init_app(app):
+    # /metrics, request timing and callback response sizes on the Flask
+    # server and callback timing on the Dash app; call after all callbacks
+    # are defined
+    if not ENABLED:
+        return
+    server = app.server
+
+    for name, entry in app.callback_map.items():
+        # clientside callbacks have no server function
+        if 'callback' in entry:
+            entry['callback'] = _timed_callback(entry['callback'], name.strip('.'))
+
+    @server.before_request
+    def start_timer():
+        flask.g.metrics_start = time.perf_counter()
+
+    @server.after_request
+    def record_status(response):
+        flask.g.metrics_status = response.status_code
+        return response
+
+    # after_request hooks run in reverse order of registration, this one
+    # before the compression hook, so the uncompressed body is counted
+    @server.after_request
+    def record_callback_bytes(response):
+        if (flask.request.path.endswith('/_dash-update-component') and response.status_code == 200
+                and not response.is_streamed):
+            request = flask.request.get_json(silent=True)
+            output = request.get('output', '') if isinstance(request, dict) else ''
+            callback_bytes.inc(len(response.get_data()), callback=output.strip('.'))
+        return response
+
+    # teardown runs after all after_request hooks, so the request time
+    # includes response compression
+    @server.teardown_request
+    def observe_request(error=None):
+        start = getattr(flask.g, 'metrics_start', None)
+        if start is None:
+            return
+        rule = flask.request.url_rule
+        endpoint = rule.rule if rule is not None else 'unmatched'
+        request_seconds.observe(time.perf_counter() - start, endpoint=endpoint)
+        requests_total.inc(endpoint=endpoint, status=getattr(flask.g, 'metrics_status', 500))
+
+    @server.route('/metrics')
+    def metrics_endpoint():
+        return flask.Response(render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,89 @@
+import argparse
+import os
+
+import numpy as np
+
+import kernel_store
+
+
+# Precomputed top-K commercial neighbours of every reference compound,
+# sorted by decreasing similarity. Stored next to the kernel as
+# <name>.top<K>.npz together with the size and mtime of the kernel file it
+# was built from, so a changed kernel triggers a rebuild on the next load.
+TOP_K = 50
+
+
+class NeighbourIndex:
+    def __init__(self, idx, scores):
+        self.idx = idx
+        self.scores = scores
+
+    @property
+    def k(self):
+        return self.idx.shape[1]
+
+    def top(self, index, no):
+        return self.idx[index, :no], self.scores[index, :no]
+
+
+def index_path(kernel_path, k=TOP_K):
+    root, _ = os.path.splitext(kernel_path)
+    return '%s.top%d.npz' % (root, k)
+
+
+def _signature(kernel_path):
+    stat = os.stat(kernel_path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def build_index(kernel, k=TOP_K, chunk=64):
+    n_ref = kernel.n_reference
+    idx = np.empty((n_ref, k), dtype=np.int32)
+    scores = np.empty((n_ref, k), dtype=np.float32)
+    for start in range(0, n_ref, chunk):
+        rows = np.asarray(kernel.rows(np.arange(start, min(start + chunk, n_ref))))
+        top = np.argpartition(rows, -k, axis=1)[:, -k:]
+        top_scores = np.take_along_axis(rows, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        idx[start:start + len(rows)] = np.take_along_axis(top, order, axis=1)
+        scores[start:start + len(rows)] = np.take_along_axis(top_scores, order, axis=1)
+    return NeighbourIndex(idx, scores)
+
+
+def save_index(neighbours, path, kernel_path):
+    tmp_path = path + '.%d.tmp.npz' % os.getpid()
+    np.savez(tmp_path, idx=neighbours.idx, scores=neighbours.scores,
+             signature=_signature(kernel_path))
+    os.replace(tmp_path, path)
+
+
+def load_index(kernel, k=TOP_K, rebuild=True):
+    # Returns the index for kernel.path, (re)building it when it is missing
+    # or was built from a different version of the kernel file
+    path = index_path(kernel.path, k)
+    with kernel_store.locked(kernel.path):
+        if os.path.exists(path):
+            with np.load(path) as f:
+                if np.array_equal(f['signature'], _signature(kernel.path)):
+                    return NeighbourIndex(f['idx'], f['scores'])
+        if not rebuild:
+            return None
+        # the order of a converted kernel's neighbours is taken from the
+        # full precision kernel, storage ties do not reorder them
+        neighbours = build_index(kernel.source or kernel, k)
+        save_index(neighbours, path, kernel.path)
+    return neighbours
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the top-K neighbour index of a kernel')
+    parser.add_argument('kernel', nargs='?', default='K_c3_g1_commercial.npy')
+    parser.add_argument('--k', type=int, default=TOP_K)
+    parser.add_argument('--block', action='store_true')
+    args = parser.parse_args()
+
+    kernel = kernel_store.load_kernel(args.kernel, block=args.block)
+    neighbours = build_index(kernel, args.k)
+    save_index(neighbours, index_path(kernel.path, args.k), kernel.path)
+    print('wrote %s (%d references x top %d)' % (
+        index_path(kernel.path, args.k), neighbours.idx.shape[0], neighbours.k))
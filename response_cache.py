@@ -0,0 +1,131 @@
+import argparse
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import disk_cache
+
+# Memoised callback responses shared by all workers on a machine through a
+# SQLite file (WAL mode, so readers never block each other). Values are the
+# JSON-serialised callback outputs; the least recently used entries are
+# evicted once more than EXCHEM_RESPONSE_CACHE_ENTRIES are stored (0 turns
+# the cache off). Access times only need to order entries for eviction, so
+# a hit refreshes them at most every ACCESS_RESOLUTION seconds: hits on
+# recently used entries are pure reads and never wait for the write lock.
+CACHE_PATH = os.environ.get('EXCHEM_RESPONSE_CACHE', os.path.join(disk_cache.CACHE_DIR, 'responses.sqlite'))
+MAX_ENTRIES = int(os.environ.get('EXCHEM_RESPONSE_CACHE_ENTRIES', '20000'))
+# bump when the shape of a memoised response changes, stored entries from
+# older versions are then never read again (and evicted over time)
+RESPONSE_VERSION = 3
+ACCESS_RESOLUTION = 60
+# returned by get() for a missing key, a cached None is a hit
+MISSING = object()
+
+
+class ResponseCache:
+    def __init__(self, path=CACHE_PATH, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.enabled = bool(path) and max_entries > 0
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._puts = 0
+
+    def _db(self):
+        # one connection per thread and process, connections must not be
+        # carried over into forked workers
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS responses '
+                       '(key TEXT PRIMARY KEY, value TEXT, accessed REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def get(self, key):
+        db = self._db()
+        row = db.execute('SELECT value, accessed FROM responses WHERE key = ?', (key,)).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return MISSING
+            self.hits += 1
+        now = time.time()
+        if now - row[1] > ACCESS_RESOLUTION:
+            db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        db = self._db()
+        db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)', (key, value, time.time()))
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % 100 == 0
+        if evict:
+            db.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses '
+                       'ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def clear(self):
+        self._db().execute('DELETE FROM responses')
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        stats = {'enabled': self.enabled, 'hits': hits, 'misses': misses,
+                 'hit_rate': hits / (hits + misses) if hits + misses else None}
+        if self.enabled:
+            stats['entries'] = self._db().execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            stats['max_entries'] = self.max_entries
+        return stats
+
+    def memoize(self, name):
+        # caches func(*args) under name, RESPONSE_VERSION and JSON of the
+        # arguments, which must therefore be JSON serialisable and fully
+        # determine the result
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args):
+                if not self.enabled:
+                    return func(*args)
+                key = '%s:%d:' % (name, RESPONSE_VERSION) + hashlib.sha1(json.dumps(args).encode()).hexdigest()
+                value = self.get(key)
+                if value is MISSING:
+                    value = json.loads(json.dumps(func(*args), cls=disk_cache._encoder()))
+                    self.put(key, json.dumps(value))
+                return value
+            return wrapper
+        return decorator
+
+
+cache = ResponseCache()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Callback response cache')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('warm', help='precompute the responses for every reference compound and K')
+    p.add_argument('--dataset', default=None)
+    sub.add_parser('stats', help='show the number of cached responses')
+    sub.add_parser('clear', help='remove all cached responses')
+    args = parser.parse_args()
+
+    if args.command == 'warm':
+        import exchem
+        start = time.perf_counter()
+        count = exchem.warm_response_cache(args.dataset)
+        print('cached %d responses in %.1f s' % (count, time.perf_counter() - start))
+    elif args.command == 'stats':
+        print(json.dumps(cache.stats(), indent=2))
+    elif args.command == 'clear':
+        cache.clear()
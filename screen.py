@@ -0,0 +1,221 @@
+import argparse
+import collections
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import datasets
+import fingerprints
+
+
+# Batch screening of the compound library against the tested references:
+# for every reference with measured IE > X, all library compounds with
+# similarity > S and predicted IE > Y. The library is screened in chunks of
+# kernel columns (references x chunk floats in memory per thread); every
+# chunk is final once reduced over all references, so candidates are
+# written while the next chunks are screened. Every library compound
+# appears once in the output, with the number of matching references and
+# its most similar one. In library order (--rank library) the output is
+# fully streamed; a ranking first collects the numeric aggregates of all
+# candidates (4 numbers each), the rows themselves are still built and
+# written in batches.
+COLUMNS = ['rank', 'CAS', 'SMILES', 'IE_krr', 'similarity', 'references', 'best_reference', 'best_reference_IE']
+CHUNK = 16384
+
+
+def reference_rows(ds, min_ie):
+    tested = ds.tested.index.values
+    return tested[ds.properties[tested] > min_ie]
+
+
+def screen_columns(kernel, rows, start, stop, min_similarity, library_mask):
+    # library rows of the candidates among columns start:stop, their best
+    # similarity, the row of the best reference and the number of references
+    block = np.asarray(kernel.columns(rows, start, stop))
+    hits = (block > min_similarity) & library_mask[start:stop]
+    counts = hits.sum(axis=0)
+    found = np.flatnonzero(counts)
+    masked = np.where(hits[:, found], block[:, found], -np.inf)
+    best = masked.argmax(axis=0)
+    return start + found, masked[best, np.arange(len(found))], rows[best], counts[found]
+
+
+def ordered_map(pool, func, items, window):
+    # pool.map with at most `window` items in flight: Executor.map submits
+    # all of them at once and keeps every result until it is consumed
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def screen_chunks(ds, min_ie, min_similarity, min_predicted, chunk=CHUNK, jobs=None, substructure=''):
+    # (library rows, best similarity, best reference, references) of the
+    # candidates, one chunk of library columns at a time in library order
+    kernel = ds.sim
+    rows = reference_rows(ds, min_ie)
+    ie_krr = ds.struc_columns['IE_krr'][:kernel.n_commercial].astype(np.float64)
+    library_mask = ie_krr > min_predicted
+    if substructure:
+        bits = fingerprints.load_index(ds.spec['library']['file'], ds.struc_columns['Identifier'])
+        library_mask &= fingerprints.screen(bits[:kernel.n_commercial], *fingerprints.parse_query(substructure))
+    if not len(rows):
+        return
+    spans = [(start, min(start + chunk, kernel.n_commercial)) for start in range(0, kernel.n_commercial, chunk)]
+    jobs = jobs or os.cpu_count() or 1
+    # numpy releases the GIL for the reductions, threads share the kernel
+    with ThreadPoolExecutor(jobs) as pool:
+        yield from ordered_map(
+            pool, lambda span: screen_columns(kernel, rows, *span, min_similarity, library_mask), spans, 2 * jobs)
+
+
+def screen(ds, min_ie, min_similarity, min_predicted, chunk=CHUNK, jobs=None, substructure=''):
+    # all candidates at once
+    parts = list(zip(*screen_chunks(ds, min_ie, min_similarity, min_predicted, chunk, jobs, substructure)))
+    if not parts:
+        return (np.array([], dtype=np.int64), np.array([]), np.array([], dtype=np.int64),
+                np.array([], dtype=np.int64))
+    return tuple(np.concatenate(part) for part in parts)
+
+
+def result_frame(ds, found, best, best_ref, counts, first_rank=1):
+    columns = ds.struc_columns
+    result = pd.DataFrame({
+        'CAS': columns['Filename'][found],
+        'SMILES': columns['Identifier'][found],
+        'IE_krr': columns['IE_krr'][found],
+        'similarity': (100 * best).round(decimals=1),
+        'references': counts,
+        'best_reference': ds.compound_names[best_ref],
+        'best_reference_IE': ds.properties[best_ref],
+    })
+    result.insert(0, 'rank', np.arange(first_rank, first_rank + len(result)))
+    return result
+
+
+def ranked(ds, found, best, best_ref, counts, order='similarity', batch=10000):
+    # DataFrames of `batch` candidates ranked by similarity to the closest
+    # reference (ties: predicted IE), by predicted IE (ties: similarity) or
+    # by number of references
+    ie_krr = ds.struc_columns['IE_krr'][found].astype(np.float64)
+    keys = {
+        'similarity': (-ie_krr, -best),
+        'ie': (-best, -ie_krr),
+        'references': (-ie_krr, -best, -counts),
+    }[order]
+    order = np.lexsort(keys)
+    # the library lists some compounds more than once, keep the best rank
+    canonical = np.array([ds.cas_rows[name] for name in ds.struc_columns['Filename'][found[order]]], dtype=np.int64)
+    _, first = np.unique(canonical, return_index=True)
+    order = order[np.sort(first)]
+    for start in range(0, len(order), batch):
+        part = order[start:start + batch]
+        yield result_frame(ds, found[part], best[part], best_ref[part], counts[part], start + 1)
+
+
+def in_library_order(ds, chunks):
+    # DataFrames of the candidates of every chunk as they are screened
+    seen = set()
+    written = 0
+    for found, best, best_ref, counts in chunks:
+        keep = []
+        for i, name in enumerate(ds.struc_columns['Filename'][found]):
+            if ds.cas_rows[name] not in seen:
+                seen.add(ds.cas_rows[name])
+                keep.append(i)
+        if keep:
+            yield result_frame(ds, found[keep], best[keep], best_ref[keep], counts[keep], written + 1)
+            written += len(keep)
+
+
+def rank(ds, found, best, best_ref, counts, order='similarity'):
+    # the whole ranking as one DataFrame
+    frames = list(ranked(ds, found, best, best_ref, counts, order))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=COLUMNS)
+
+
+def write_result(frames, path):
+    # DataFrames written as they arrive to a temporary file, replaced
+    # atomically; '-' is CSV on stdout. Returns the number of rows.
+    count = 0
+    if path == '-':
+        for frame in frames:
+            frame.to_csv(sys.stdout, index=False, header=count == 0)
+            count += len(frame)
+        if not count:
+            pd.DataFrame(columns=COLUMNS).to_csv(sys.stdout, index=False)
+        return count
+    parquet = path.endswith('.parquet')
+    if parquet:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError('Parquet output requires pyarrow')
+    tmp_path = path + '.%d.tmp' % os.getpid()
+    try:
+        if parquet:
+            writer = None
+            for frame in frames:
+                table = pyarrow.Table.from_pandas(frame, preserve_index=False)
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(tmp_path, table.schema)
+                writer.write_table(table)
+                count += len(frame)
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(
+                    tmp_path, pyarrow.Table.from_pandas(pd.DataFrame(columns=COLUMNS), preserve_index=False).schema)
+            writer.close()
+        else:
+            with open(tmp_path, 'w', newline='') as f:
+                for frame in frames:
+                    frame.to_csv(f, index=False, header=count == 0)
+                    count += len(frame)
+                if not count:
+                    pd.DataFrame(columns=COLUMNS).to_csv(f, index=False)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Screen the compound library against the tested references')
+    parser.add_argument('--dataset', default=None)
+    parser.add_argument('--min-ie', type=float, default=0,
+                        help='measured IE of the references in %% (default: 0)')
+    parser.add_argument('--min-similarity', type=float, default=60,
+                        help='similarity to a reference in %% (default: 60)')
+    parser.add_argument('--min-predicted', type=float, default=0,
+                        help='predicted IE_krr of the candidates in %% (default: 0)')
+    parser.add_argument('--substructure', default='',
+                        help='fingerprint filter of the candidates, e.g. "carboxylic_acid !S"')
+    parser.add_argument('--rank', choices=['similarity', 'ie', 'references', 'library'], default='similarity',
+                        help='library: unranked, in library order, written while screening')
+    parser.add_argument('--chunk', type=int, default=CHUNK, help='library columns per chunk')
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--out', default='-', help='.csv or .parquet file, - for CSV on stdout')
+    args = parser.parse_args()
+
+    ds = datasets.DatasetRegistry().get(args.dataset)
+    options = (ds, args.min_ie, args.min_similarity / 100, args.min_predicted, args.chunk, args.jobs,
+               args.substructure)
+    try:
+        if args.rank == 'library':
+            frames = in_library_order(ds, screen_chunks(*options))
+        else:
+            frames = ranked(ds, *screen(*options), args.rank)
+        count = write_result(frames, args.out)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.out != '-':
+        print('wrote %s (%d candidates from %d references)' % (
+            args.out, count, len(reference_rows(ds, args.min_ie))), file=sys.stderr)
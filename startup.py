@@ -0,0 +1,46 @@
+import contextlib
+import os
+import sys
+import time
+
+import psutil
+
+
+# Startup phase timing, enabled with EXCHEM_PROFILE_STARTUP=1: wall time and
+# RSS delta of every phase are printed to stderr when it ends, so the report
+# shows up in the gunicorn log for import-time and lazily run phases alike.
+ENABLED = os.environ.get('EXCHEM_PROFILE_STARTUP', '0') == '1'
+
+_process = psutil.Process() if ENABLED else None
+started = time.perf_counter()
+phases = []
+
+
+def _rss():
+    return _process.memory_info().rss
+
+
+@contextlib.contextmanager
+def phase(name):
+    if not ENABLED:
+        yield
+        return
+    rss = _rss()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        delta = (_rss() - rss) / 2**20
+        phases.append((name, elapsed, delta))
+        print('[startup %d] %-48s %8.3f s %+9.1f MB  (at %.3f s)' % (
+            os.getpid(), name, elapsed, delta, time.perf_counter() - started), file=sys.stderr)
+
+
+def mark(name, since):
+    # phase that started before this module could be used, e.g. the imports
+    if ENABLED:
+        elapsed = time.perf_counter() - since
+        phases.append((name, elapsed, None))
+        print('[startup %d] %-48s %8.3f s  RSS %9.1f MB' % (
+            os.getpid(), name, elapsed, _rss() / 2**20), file=sys.stderr)
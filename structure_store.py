@@ -0,0 +1,268 @@
+import argparse
+import functools
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import metrics
+
+
+# Parsed structures in the Speck format of dash_bio.utils.xyz_reader
+# ([{'symbol': 'C', 'x': 0.0, 'y': 0.0, 'z': 0.0}, ...]) served from a
+# bounded LRU cache. Misses are read from the packed store if one was built
+# with `python structure_store.py pack`, otherwise from structures/<name>.xyz.
+STRUCTURE_DIR = os.environ.get('EXCHEM_STRUCTURE_DIR', 'structures')
+PACK_PATH = os.environ.get('EXCHEM_STRUCTURE_PACK', 'structures.pack')
+CACHE_SIZE = int(os.environ.get('EXCHEM_STRUCTURE_CACHE', '1024'))
+# structures of the top table rows read ahead after a neighbour search
+# (0 disables), by PREFETCH_THREADS threads with at most PREFETCH_QUEUE reads
+# pending; further names are dropped rather than queued
+PREFETCH_ROWS = int(os.environ.get('EXCHEM_PREFETCH_ROWS', '10'))
+PREFETCH_THREADS = int(os.environ.get('EXCHEM_PREFETCH_THREADS', '2'))
+PREFETCH_QUEUE = int(os.environ.get('EXCHEM_PREFETCH_QUEUE', '64'))
+
+MAGIC = b'EXCHEMXYZ1'
+# coordinates are served with 0.001 A resolution, the precision of the
+# structure files, whatever the source precision
+DECIMALS = 3
+
+# same pattern as xyz_reader.read_xyz, which also writes a temporary file
+# per call
+_atom_line = re.compile(r'^\s*([\w]+)\s+([\w\.\+\-]+)\s+([\w\.\+\-]+)\s+([\w\.\+\-]+)\s*')
+
+
+def parse_xyz(text):
+    atoms = []
+    for line in text.split('\n'):
+        r = _atom_line.search(line)
+        if r is None:
+            continue
+        atoms.append({
+            'symbol': r.group(1),
+            'x': float(r.group(2)),
+            'y': float(r.group(3)),
+            'z': float(r.group(4))
+        })
+    return atoms
+
+
+@metrics.timed('structure_read')
+def read_xyz_file(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return parse_xyz(f.read())
+
+
+## Packed store: one file with element codes, float32 coordinates and an
+## offset table, memory-mapped at startup
+class StructurePack:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a structure pack' % path)
+            header_len = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(header_len))
+        self.path = path
+        self.names = {name: i for i, name in enumerate(header['names'])}
+        self.elements = header['elements']
+        self.decimals = header['decimals']
+        # {name: [size, mtime_ns]} of the structure files packed, if known
+        self.sources = header.get('sources')
+        arrays = header['arrays']
+        self.offsets = self._map(path, arrays['offsets'])
+        self.codes = self._map(path, arrays['codes'])
+        self.coords = self._map(path, arrays['coords'])
+
+    @staticmethod
+    def _map(path, spec):
+        shape = tuple(spec['shape'])
+        if 0 in shape:
+            return np.zeros(shape, dtype=spec['dtype'])
+        return np.memmap(path, dtype=spec['dtype'], mode='r', offset=spec['offset'], shape=shape)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    @metrics.timed('structure_read')
+    def read(self, name):
+        i = self.names[name]
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        coords = self.coords[start:stop].astype(np.float64).round(min(self.decimals, DECIMALS)).tolist()
+        elements = self.elements
+        return [
+            {'symbol': elements[code], 'x': xyz[0], 'y': xyz[1], 'z': xyz[2]}
+            for code, xyz in zip(self.codes[start:stop].tolist(), coords)
+        ]
+
+
+def source_signatures(directory):
+    # {name: [size, mtime_ns]} of the structure files in directory
+    signatures = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith('.xyz'):
+                stat = entry.stat()
+                signatures[entry.name[:-len('.xyz')]] = [stat.st_size, stat.st_mtime_ns]
+    return signatures
+
+
+def write_pack(structures, out_path, decimals=DECIMALS, directory=None):
+    # structures: iterable of (name, atoms) pairs, read from the files in
+    # directory if given; their signatures are taken first, so a file
+    # changed while packing makes the pack stale
+    sources = source_signatures(directory) if directory is not None else None
+    names, elements, element_codes = [], [], {}
+    offsets, codes, coords = [0], [], []
+    for name, atoms in structures:
+        names.append(name)
+        for atom in atoms:
+            if atom['symbol'] not in element_codes:
+                element_codes[atom['symbol']] = len(elements)
+                elements.append(atom['symbol'])
+            codes.append(element_codes[atom['symbol']])
+            coords.append((atom['x'], atom['y'], atom['z']))
+        offsets.append(len(codes))
+    arrays = {
+        'offsets': np.asarray(offsets, dtype='<i8'),
+        'codes': np.asarray(codes, dtype='u1'),
+        'coords': np.asarray(coords, dtype='<f4').reshape(-1, 3),
+    }
+
+    # array offsets are stored in the header itself, reserve some room for
+    # their digits before laying out the arrays behind it
+    spec = {key: {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': 0} for key, a in arrays.items()}
+    header = {'names': names, 'elements': elements, 'decimals': decimals, 'arrays': spec}
+    if sources is not None:
+        header['sources'] = sources
+    header_len = len(json.dumps(header).encode()) + 64 * len(arrays)
+    position = len(MAGIC) + 8 + header_len
+    for key, a in arrays.items():
+        position += -position % 8
+        spec[key]['offset'] = position
+        position += a.nbytes
+    encoded = json.dumps(header).encode().ljust(header_len)
+
+    tmp_path = out_path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(header_len).astype('<u8').tobytes())
+        f.write(encoded)
+        for key, a in arrays.items():
+            f.write(b'\0' * (spec[key]['offset'] - f.tell()))
+            f.write(a.tobytes())
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def iter_structure_dir(directory):
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.xyz'):
+            yield filename[:-len('.xyz')], read_xyz_file(os.path.join(directory, filename))
+
+
+def load_pack(path=PACK_PATH, directory=STRUCTURE_DIR):
+    # the pack is ignored once a structure file was added, removed or
+    # changed after it was built; packs without file signatures only notice
+    # additions and removals, by the directory mtime
+    if not os.path.exists(path):
+        return None
+    pack = StructurePack(path)
+    if not os.path.isdir(directory):
+        return pack
+    if pack.sources is None:
+        return pack if os.path.getmtime(path) >= os.path.getmtime(directory) else None
+    return pack if pack.sources == source_signatures(directory) else None
+
+
+pack = load_pack()
+
+
+# structures read by the calling thread on a cache miss
+_reads = threading.local()
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def read_structure(name, directory=STRUCTURE_DIR):
+    # The returned list is shared between callers and must not be modified
+    _reads.count = getattr(_reads, 'count', 0) + 1
+    if directory == STRUCTURE_DIR and pack is not None and name in pack:
+        return pack.read(name)
+    atoms = read_xyz_file(os.path.join(directory, str(name) + '.xyz'))
+    for atom in atoms:
+        for axis in 'xyz':
+            atom[axis] = round(atom[axis], DECIMALS)
+    return atoms
+
+
+## Prefetch: the pool is created on first use, so that gunicorn workers
+## forked from a preloading master start their own threads
+class Prefetcher:
+    def __init__(self, threads=PREFETCH_THREADS, queue=PREFETCH_QUEUE):
+        self.threads = threads
+        self.queue = queue
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pid = None
+        self.prefetched = 0
+        self.dropped = 0
+
+    def submit(self, names, directory=STRUCTURE_DIR):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pool = ThreadPoolExecutor(self.threads, thread_name_prefix='prefetch')
+                self.pid = os.getpid()
+                self.pending = set()
+            for name in names:
+                key = (name, directory)
+                if key in self.pending:
+                    continue
+                if len(self.pending) >= self.queue:
+                    self.dropped += 1
+                    continue
+                self.pending.add(key)
+                self.pool.submit(self._read, key)
+
+    def _read(self, key):
+        # counts the structures actually read, not those already cached
+        before = getattr(_reads, 'count', 0)
+        try:
+            read_structure(*key)
+            read = getattr(_reads, 'count', 0) - before
+        except (OSError, ValueError):
+            # a missing structure fails again, visibly, when it is requested
+            read = 0
+        with self.lock:
+            self.pending.discard(key)
+            self.prefetched += read
+
+
+prefetcher = Prefetcher()
+
+
+def prefetch(names, directory=STRUCTURE_DIR):
+    # reads the structures into the LRU cache in the background
+    if PREFETCH_ROWS and CACHE_SIZE:
+        prefetcher.submit(list(names)[:PREFETCH_ROWS], directory)
+
+
+def cache_stats():
+    info = read_structure.cache_info()
+    return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize,
+            'maxsize': info.maxsize, 'pack': pack.path if pack is not None else None,
+            'prefetched': prefetcher.prefetched, 'prefetch_dropped': prefetcher.dropped}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Structure store tools')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('pack', help='pack all structures/*.xyz into one memory-mappable file')
+    p.add_argument('--dir', default=STRUCTURE_DIR)
+    p.add_argument('--out', default=PACK_PATH)
+    args = parser.parse_args()
+
+    write_pack(iter_structure_dir(args.dir), args.out, directory=args.dir)
+    print('wrote %s (%d structures)' % (args.out, len(StructurePack(args.out).names)))
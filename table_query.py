@@ -0,0 +1,114 @@
+import re
+
+import numpy as np
+
+
+# Server-side filter, sort and pagination for DataTables with
+# filter_action / sort_action / page_action='custom'. The table is given as
+# a dict of equally long column arrays; only the row numbers of the
+# requested page are returned, so just that page has to be serialised.
+# A view (filter and sort order) can be kept to page through it in
+# O(page size).
+
+# {column} [s|i]operator value, the case prefix is added by the table's
+# case sensitivity toggle
+_term = re.compile(r'^\s*\{(?P<column>[^{}]+)\}\s+(?P<case>[si]?)'
+                   r'(?P<op>contains|datestartswith|>=|<=|!=|=|<|>|eq|ne|ge|le|gt|lt)\s+(?P<value>.+?)\s*$')
+_aliases = {'eq': '=', 'ne': '!=', 'ge': '>=', 'le': '<=', 'gt': '>', 'lt': '<'}
+
+
+def parse_filter(filter_query):
+    # [(column, operator, value, case_insensitive), ...]; terms the table
+    # could not have produced are skipped, like the native filter does
+    terms = []
+    for part in (filter_query or '').split(' && '):
+        match = _term.match(part)
+        if match is None:
+            continue
+        value = match.group('value')
+        if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'`':
+            value = value[1:-1].replace('\\' + value[0], value[0])
+        op = _aliases.get(match.group('op'), match.group('op'))
+        terms.append((match.group('column'), op, value, match.group('case') == 'i'))
+    return terms
+
+
+def _compare(values, op, value):
+    with np.errstate(invalid='ignore'):
+        return {
+            '=': values == value, '!=': values != value,
+            '>=': values >= value, '<=': values <= value,
+            '>': values > value, '<': values < value,
+        }[op]
+
+
+def _number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def invalid_terms(filter_query, numeric):
+    # comparisons of the `numeric` columns with a value that is no number;
+    # filter_mask skips them, the caller reports them
+    return ['%s %s %s' % (column, op, value) for column, op, value, _ in parse_filter(filter_query)
+            if column in numeric and op not in ('contains', 'datestartswith') and _number(value) is None]
+
+
+def filter_mask(columns, filter_query):
+    n = len(next(iter(columns.values())))
+    mask = np.ones(n, dtype=bool)
+    for column, op, value, insensitive in parse_filter(filter_query):
+        if column not in columns:
+            continue
+        values = columns[column]
+        if values.dtype.kind in 'iuf' and op not in ('contains', 'datestartswith'):
+            number = _number(value)
+            if number is not None:
+                mask &= _compare(values, op, number)
+            continue
+        text = np.asarray(values, dtype=str)
+        if insensitive:
+            text, value = np.char.lower(text), value.lower()
+        if op == 'contains':
+            mask &= np.char.find(text, value) >= 0
+        elif op == 'datestartswith':
+            mask &= np.char.startswith(text, value)
+        else:
+            mask &= _compare(text, op, value)
+    return mask
+
+
+def sort_order(columns, sort_by, rows):
+    # stable, so rows keep their given order (e.g. by similarity) on ties
+    keys = []
+    for spec in reversed(sort_by or []):
+        if spec.get('column_id') not in columns:
+            continue
+        values = columns[spec['column_id']][rows]
+        if values.dtype.kind not in 'iuf':
+            values = np.unique(values.astype(str), return_inverse=True)[1]
+        keys.append(-values if spec.get('direction') == 'desc' else values)
+    if not keys:
+        return rows
+    return rows[np.lexsort(keys)]
+
+
+def view(columns, filter_query='', sort_by=None):
+    # all matching row numbers in display order
+    rows = np.flatnonzero(filter_mask(columns, filter_query))
+    return sort_order(columns, sort_by, rows)
+
+
+def page(rows, page, page_size=50):
+    # row numbers of the requested page, the number of pages and the page
+    # returned, the last one if the filter left fewer pages than requested
+    page_count = max(1, -(-len(rows) // page_size))
+    page = min(max(page, 0), page_count - 1)
+    start = page * page_size
+    return rows[start:start + page_size], page_count, page
+
+
+def query(columns, filter_query='', sort_by=None, page_number=0, page_size=50):
+    return page(view(columns, filter_query, sort_by), page_number, page_size)
@@ -0,0 +1,81 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+
+# The tests run against small synthetic datasets (bench.synthetic_dataset:
+# the reference compounds against a random library and kernel, the last one
+# with the full square kernel a low-rank factor is built from), so they need
+# neither the LFS kernel nor the real library. Modules read their settings at
+# import, so the environment is set up here, before any test imports them.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = tempfile.mkdtemp(prefix='exchem-tests-')
+SIZES = [(300, 0, False), (400, 1, False), (200, 2, True)]
+
+
+def _synthetic(n, seed, square):
+    # in a subprocess: datasets binds the manifest path at import
+    code = ('import sys, bench; print(bench.synthetic_dataset(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), '
+            'square=sys.argv[4] == "1"))')
+    result = subprocess.run([sys.executable, '-c', code, DATA, str(n), str(seed), '1' if square else '0'],
+                            cwd=ROOT, check=True, capture_output=True, text=True)
+    with open(result.stdout.strip()) as f:
+        return json.load(f)['datasets'][0]
+
+
+def _manifest():
+    specs = [_synthetic(*size) for size in SIZES]
+    path = os.path.join(DATA, 'datasets.json')
+    with open(path, 'w') as f:
+        json.dump({'default': specs[0]['id'], 'datasets': specs}, f, indent=2)
+    return path
+
+
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+os.environ.update({
+    'EXCHEM_DATASETS': _manifest(),
+    'EXCHEM_CACHE_DIR': os.path.join(DATA, 'cache'),
+    'EXCHEM_RESPONSE_CACHE': os.path.join(DATA, 'cache', 'responses.sqlite'),
+    'EXCHEM_COMPRESS': '0',
+    'EXCHEM_PRELOAD_DATASETS': '',
+})
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(DATA, ignore_errors=True)
+
+
+@pytest.fixture
+def client():
+    import exchem
+    return exchem.server.test_client()
+
+
+@pytest.fixture(scope='session')
+def descriptor_path(tmp_path_factory):
+    # descriptors of the default dataset's library and reference compounds
+    import descriptors
+    import exchem
+    ds = exchem.registry.get()
+    names = sorted(set(ds.struc_columns['Filename'][:ds.sim.n_commercial]) | set(ds.compound_names))
+    path = str(tmp_path_factory.mktemp('descriptors') / 'descriptors.npy')
+    descriptors.build_descriptors(names, path)
+    return path
+
+
+@pytest.fixture
+def with_descriptors(monkeypatch, descriptor_path):
+    # the default dataset with descriptors, the models built from them
+    # are dropped afterwards
+    import exchem
+    ds = exchem.registry.get()
+    monkeypatch.setitem(ds.spec, 'descriptors', descriptor_path)
+    yield ds
+    for key in ('oos', 'ann'):
+        ds.cache.pop(key, None)
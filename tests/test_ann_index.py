@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+import ann_index
+import exchem
+
+
+@pytest.fixture(scope='module')
+def vectors():
+    # clustered unit vectors, like descriptors of related compounds
+    rng = np.random.default_rng(0)
+    centres = rng.standard_normal((32, 24))
+    x = centres[rng.integers(len(centres), size=4000)] + 0.3 * rng.standard_normal((4000, 24))
+    return (x / np.linalg.norm(x, axis=1, keepdims=True)).astype(np.float32)
+
+
+@pytest.fixture(scope='module')
+def index(vectors):
+    return ann_index.IVFIndex.build(vectors)
+
+
+def exact_top(vectors, query, k):
+    scores = vectors @ query
+    top = np.argsort(-scores, kind='stable')[:k]
+    return top, np.clip(scores[top], 0, None) ** 2
+
+
+def test_build_stores_every_vector_once_in_its_nearest_cluster(vectors, index):
+    assert index.n_lists == int(np.sqrt(len(vectors)))
+    assert index.offsets[-1] == len(vectors)
+    assert np.array_equal(np.sort(index.ids), np.arange(len(vectors)))
+    assert np.allclose(index.vectors, vectors[index.ids])
+    for c in range(index.n_lists):
+        cluster = index.vectors[index.offsets[c]:index.offsets[c + 1]]
+        assert np.all(np.argmax(cluster @ index.centroids.T, axis=1) == c)
+
+
+def test_probing_every_cluster_is_exact(vectors, index):
+    for query in vectors[::97]:
+        ids, scores = index.search(query, 20, nprobe=index.n_lists)
+        expected_ids, expected_scores = exact_top(vectors, query, 20)
+        assert np.allclose(scores, expected_scores, atol=1e-6)
+        assert set(ids[scores > expected_scores[-1] + 1e-6]) <= set(expected_ids)
+
+
+def test_search_only_ranks_the_probed_clusters(vectors, index):
+    query = vectors[0]
+    nearest = np.argmax(index.centroids @ query)
+    candidates = index.candidates(query, nprobe=1)
+    assert np.array_equal(candidates, np.arange(index.offsets[nearest], index.offsets[nearest + 1]))
+    # K beyond the probed clusters is truncated to them
+    ids, scores = index.search(query, len(vectors), nprobe=1)
+    assert len(ids) == len(candidates)
+    assert set(ids) == set(index.ids[candidates])
+    assert np.all(np.diff(scores) <= 0)
+
+
+def test_recall_against_exact_search(vectors, index):
+    recall = []
+    for query in vectors[::41]:
+        ids, _ = index.search(query, 10)
+        expected, _ = exact_top(vectors, query, 10)
+        recall.append(len(np.intersect1d(ids, expected)) / 10)
+    assert np.mean(recall) >= 0.95
+
+
+def test_saved_index_searches_alike(vectors, index, tmp_path):
+    path = str(tmp_path / 'ann_index.npz')
+    index.save(path)
+    loaded = ann_index.load_index(path)
+    for query in vectors[:5]:
+        for found, expected in zip(loaded.search(query, 10), index.search(query, 10)):
+            assert np.array_equal(found, expected)
+    assert ann_index.load_index(str(tmp_path / 'missing.npz')) is None
+
+
+## The ann backend of the neighbour search
+@pytest.fixture
+def with_ann_index(monkeypatch, with_descriptors, tmp_path):
+    ds = with_descriptors
+    model = exchem.oos_model(ds)
+    path = str(tmp_path / 'ann_index.npz')
+    ann_index.IVFIndex.build(model['descriptors'].rows(ds.struc_columns['Filename'][:ds.sim.n_commercial]),
+                             n_lists=32).save(path)
+    monkeypatch.setitem(ds.spec, 'ann_index', path)
+    return ds
+
+
+def search(ds, no_rows, **options):
+    return exchem.update_neighbours(None, no_rows, dataset_id=ds.id, **options)
+
+
+def test_ann_search_is_labelled_and_reports_truncation(with_ann_index):
+    ds = with_ann_index
+    query = search(ds, '10', backend='ann')
+    assert query['backend'] == 'ann' and query['similarity'] == 'descriptor'
+    assert query['status'] == 'approximate search, descriptor similarities'
+    idx, scores = exchem.search_neighbours(ds, query['row'], 10, 'ann')
+    assert len(idx) == 10 and np.all(np.diff(scores) <= 0)
+
+    query = search(ds, 'all', backend='ann')
+    scanned = len(exchem.ann_model(ds)['index'].candidates(exchem.ann_model(ds)['references'][query['row']]))
+    assert scanned < ds.sim.n_commercial
+    assert 'only the %d compounds' % scanned in query['status']
+    idx, _ = exchem.search_neighbours(ds, query['row'], query['k'], 'ann')
+    assert len(idx) == scanned
+
+
+def test_ann_search_without_index_falls_back_to_the_kernel(with_descriptors):
+    query = search(with_descriptors, '10', backend='ann')
+    assert query['backend'] == 'kernel' and 'similarity' not in query
+    assert query['status'] == 'no approximate index built (python ann_index.py), exact kernel search'
+
+
+def test_filtered_ann_search_is_exact(with_ann_index):
+    query = search(with_ann_index, '10', backend='ann', substructure='carboxylic_acid')
+    assert query['backend'] == 'kernel'
+    assert 'consensus and filtered searches are exact' in query['status']
@@ -0,0 +1,96 @@
+import os
+
+import pytest
+
+import descriptors
+import exchem
+
+
+@pytest.mark.parametrize('body', [[], ['tris'], 'tris', 12])
+def test_similar_rejects_a_body_that_is_no_object(client, body):
+    response = client.post('/api/similar', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+@pytest.mark.parametrize('compounds', ['tris', {'tris': 1}, 12])
+def test_similar_rejects_compounds_that_are_no_list(client, compounds):
+    response = client.post('/api/similar', json={'compounds': compounds})
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_similar_answers_a_valid_request(client):
+    ds = exchem.registry.get()
+    response = client.post('/api/similar', json={'compounds': [ds.compound_names[0], 1], 'k': 5})
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert len(results) == 2
+
+
+@pytest.mark.parametrize('k', [2.7, 5.0, True, '5', None, [5], 0, 10**6, 'All'])
+def test_similar_rejects_a_k_that_is_no_whole_number(client, k):
+    ds = exchem.registry.get()
+    response = client.post('/api/similar', json={'compounds': [0], 'k': k})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'k must be a whole number between 1 and %d, or "all"' % ds.sim.n_commercial
+
+
+def test_similar_accepts_all(client):
+    ds = exchem.registry.get()
+    response = client.post('/api/similar', json={'compounds': [0], 'k': 'all'})
+    assert response.status_code == 200
+    assert response.get_json()['k'] == ds.sim.n_commercial
+
+
+@pytest.mark.parametrize('dataset, error', [
+    (['synthetic-300'], 'dataset must be a string'),
+    ({'id': 1}, 'dataset must be a string'),
+    (3, 'dataset must be a string'),
+    ('missing', 'Unknown dataset: missing'),
+])
+def test_similar_rejects_an_unknown_dataset_plainly(client, dataset, error):
+    response = client.post('/api/similar', json={'compounds': [0], 'dataset': dataset})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == error
+
+
+## Out-of-sample scoring
+def structure_text(ds, row=0):
+    with open(os.path.join(ds.structures, ds.compound_names[row] + '.xyz')) as f:
+        return f.read()
+
+
+def test_score_finds_the_scored_compound_in_the_library(client, with_descriptors):
+    ds = with_descriptors
+    name = ds.struc_columns['Filename'][3]
+    with open(os.path.join(ds.structures, name + '.xyz')) as f:
+        response = client.post('/api/score', json={'xyz': f.read(), 'k': 5})
+    assert response.status_code == 200
+    result = response.get_json()
+    assert len(result['neighbours']) == 5
+    assert result['neighbours'][0]['CAS'] == name
+    assert result['neighbours'][0]['similarity'] == pytest.approx(1.0, abs=1e-5)
+    assert isinstance(result['IE_krr'], float)
+
+
+@pytest.mark.parametrize('body', [[1], 'tris', {}, {'xyz': 12}, {'smiles': ['C']}, {'xyz': 'no atoms'}, {'k': 2.7},
+                                  {'dataset': ['x']}])
+def test_score_rejects_bad_bodies(client, body):
+    response = client.post('/api/score', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_score_without_descriptors_is_unavailable(client):
+    ds = exchem.registry.get()
+    response = client.post('/api/score', json={'xyz': structure_text(ds)})
+    assert response.status_code == 503
+    assert 'descriptors not built' in response.get_json()['error']
+
+
+def test_score_with_outdated_descriptors_is_unavailable(client, monkeypatch, with_descriptors):
+    monkeypatch.setattr(descriptors, 'PARAMS', dict(descriptors.PARAMS, cutoff=4.0))
+    response = client.post('/api/score', json={'xyz': structure_text(with_descriptors)})
+    assert response.status_code == 503
+    assert 'different parameters' in response.get_json()['error']
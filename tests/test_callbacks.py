@@ -0,0 +1,61 @@
+import json
+
+import bench
+import exchem
+
+
+def neighbours(client, dataset_id, click=None, selection=None, previous=None, aggregate='max'):
+    # the 'neighbours' store written by update_neighbours
+    search = bench.dash_request(client, 'neighbours.data', {
+        ('basic-interactions', 'clickData'): click, ('dropdown', 'value'): '10',
+        ('similarity-backend', 'value'): 'kernel', ('dataset', 'data'): dataset_id, ('substructure', 'value'): '',
+        ('basic-interactions', 'selectedData'): selection, ('aggregate', 'value'): aggregate},
+        state={('neighbours', 'data'): previous})
+    return json.loads(search[3].data)['response']['neighbours']['data']
+
+
+def select_dataset(client, dataset_id):
+    # click on the dataset menu entry, the pattern-matching input the
+    # browser sends
+    items = [{'id': {'type': 'dataset-item', 'index': other}, 'property': 'n_clicks',
+              'value': 1 if other == dataset_id else None} for other in exchem.registry.specs]
+    body = {
+        'output': '..dataset.data...basic-interactions.clickData...basic-interactions.selectedData..',
+        'outputs': [{'id': 'dataset', 'property': 'data'}, {'id': 'basic-interactions', 'property': 'clickData'},
+                    {'id': 'basic-interactions', 'property': 'selectedData'}],
+        'inputs': [items],
+        'changedPropIds': [json.dumps({'index': dataset_id, 'type': 'dataset-item'}, separators=(',', ':'))
+                           + '.n_clicks'],
+        'state': [],
+    }
+    response = client.post('/_dash-update-component', data=json.dumps(body), content_type='application/json')
+    assert response.status_code == 200
+    return json.loads(response.data)['response']
+
+
+def lasso(rows):
+    return {'points': [{'curveNumber': 1, 'pointNumber': n, 'customdata': row} for n, row in enumerate(rows)]}
+
+
+def test_lasso_selection_searches_the_selected_references(client):
+    first = exchem.registry.default
+    query = neighbours(client, first, selection=lasso([3, 5, 8]), aggregate='mean')
+    assert query['rows'] == [3, 5, 8]
+    assert query['aggregate'] == 'mean'
+
+
+def test_dataset_switch_clears_lasso_selection(client):
+    first, second = list(exchem.registry.specs)[:2]
+    query = neighbours(client, first, selection=lasso([3, 5, 8]))
+    assert query['rows'] == [3, 5, 8]
+
+    response = select_dataset(client, second)
+    assert response['dataset']['data'] == second
+    assert response['basic-interactions'] == {'clickData': None, 'selectedData': None}
+
+    # the browser then fires the search with the cleared selection
+    query = neighbours(client, second, click=response['basic-interactions']['clickData'],
+                       selection=response['basic-interactions']['selectedData'], previous=query)
+    assert query['dataset'] == second
+    assert 'rows' not in query
+    assert query['row'] == exchem.registry.get(second).default_row
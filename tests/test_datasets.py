@@ -0,0 +1,58 @@
+import json
+import os
+
+import pytest
+
+import datasets
+
+
+@pytest.fixture(scope='module')
+def specs():
+    registry = datasets.DatasetRegistry(os.environ['EXCHEM_DATASETS'])
+    return [spec for spec in registry.specs.values() if not spec['id'].endswith('-square')]
+
+
+@pytest.fixture(scope='module')
+def sizes(specs):
+    return {spec['id']: datasets.Dataset(spec).nbytes for spec in specs}
+
+
+def manifest(tmp_path, specs):
+    path = str(tmp_path / 'datasets.json')
+    with open(path, 'w') as f:
+        json.dump({'datasets': specs}, f)
+    return path
+
+
+def test_the_least_recently_used_dataset_is_evicted_and_reloaded(tmp_path, specs, sizes):
+    first, second = [spec['id'] for spec in specs]
+    # room for either dataset, not for both
+    registry = datasets.DatasetRegistry(manifest(tmp_path, specs), budget_mb=max(sizes.values()) / 2**20)
+    loaded = registry.get(first)
+    assert registry.get(first) is loaded
+    registry.get(second)
+    assert list(registry.memory()) == [second]
+    reloaded = registry.get(first)
+    assert reloaded is not loaded and reloaded.nbytes == sizes[first]
+    assert list(registry.memory()) == [first]
+
+
+def test_eviction_follows_access_not_load_order(tmp_path, specs, sizes):
+    copies = [dict(specs[0], id=dataset_id) for dataset_id in ('a', 'b', 'c')]
+    # room for two copies
+    registry = datasets.DatasetRegistry(manifest(tmp_path, copies), budget_mb=2.5 * sizes[specs[0]['id']] / 2**20)
+    a = registry.get('a')
+    registry.get('b')
+    assert registry.get('a') is a
+    registry.get('c')
+    assert list(registry.memory()) == ['a', 'c']
+    registry.get('b')
+    assert list(registry.memory()) == ['c', 'b']
+    assert registry.get('c') is not None and list(registry.memory()) == ['b', 'c']
+
+
+def test_no_budget_keeps_every_dataset(tmp_path, specs):
+    registry = datasets.DatasetRegistry(manifest(tmp_path, specs), budget_mb=0)
+    for spec in specs:
+        registry.get(spec['id'])
+    assert list(registry.memory()) == [spec['id'] for spec in specs]
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import datasets
+import exchem
+import fingerprints
+
+
+def bonds(atoms):
+    return sorted((a, b, order) for a, atom in enumerate(atoms) for b, order in atom.bonds if a < b)
+
+
+## Parser
+def test_chain_and_branches():
+    atoms, closures = fingerprints.parse_smiles('CC(C)(O)C=O')
+    assert [atom.symbol for atom in atoms] == ['C', 'C', 'C', 'O', 'C', 'O']
+    assert bonds(atoms) == [(0, 1, 1), (1, 2, 1), (1, 3, 1), (1, 4, 1), (4, 5, 2)]
+    assert closures == []
+    assert [atom.hydrogens for atom in atoms] == [3, 0, 3, 1, 1, 0]
+
+
+def test_rings_and_ring_bond_numbers():
+    atoms, closures = fingerprints.parse_smiles('C1CC2CCCCC2CC1')
+    assert len(closures) == 2
+    assert sorted(len(ring) for ring in fingerprints.rings(atoms, closures)) == [6, 6]
+    # two digit ring numbers and a ring bond with an explicit order
+    atoms, closures = fingerprints.parse_smiles('C%12CCC=%12')
+    assert closures == [(0, 3)]
+    assert (0, 3, 2) in bonds(atoms)
+
+
+def test_aromatic_atoms():
+    atoms, closures = fingerprints.parse_smiles('c1ccncc1')
+    assert all(atom.aromatic for atom in atoms)
+    assert {order for _, _, order in bonds(atoms)} == {1.5}
+    assert [atom.hydrogens for atom in atoms] == [1, 1, 1, 0, 1, 1]
+    assert [len(ring) for ring in fingerprints.rings(atoms, closures)] == [6]
+
+
+@pytest.mark.parametrize('smiles, symbol, charge, hydrogens', [
+    ('[NH4+]', 'N', 1, 4), ('[O-]', 'O', -1, 0), ('[Cu+2]', 'Cu', 2, 0), ('[Fe++]', 'Fe', 2, 0),
+    ('[13CH3]', 'C', 0, 3), ('[C@@H](F)(Cl)Br', 'C', 0, 1), ('[nH]1cccc1', 'N', 0, 1), ('[se]1cccc1', 'Se', 0, 0)])
+def test_bracket_atoms(smiles, symbol, charge, hydrogens):
+    atom = fingerprints.parse_smiles(smiles)[0][0]
+    assert (atom.symbol, atom.charge, atom.hydrogens) == (symbol, charge, hydrogens)
+
+
+def test_disconnected_components():
+    atoms, _ = fingerprints.parse_smiles('[Na+].[Cl-]')
+    assert len(atoms) == 2 and bonds(atoms) == []
+
+
+@pytest.mark.parametrize('text', ['', 'bismuthiol', 'C1CC', 'CC(C', 'CC)C', '1CC', 'C[+]C', 'C[C', 'C&C'])
+def test_invalid_input(text):
+    with pytest.raises(ValueError):
+        fingerprints.parse_smiles(text)
+    assert fingerprints.features(text) == set()
+
+
+## Features
+@pytest.mark.parametrize('smiles, expected', [
+    ('OC(=O)c1ccccc1O', {'carboxylic_acid', 'phenol', 'benzene', 'aromatic', 'ring'}),
+    ('CCOC(=O)C', {'ester', 'carbonyl'}),
+    ('CC(N)=O', {'amide', 'carbonyl'}),
+    ('c1ccncc1', {'pyridine', 'heterocycle'}),
+    ('c1cc[nH]c1', {'azole', 'heterocycle'}),
+    ('C[N+](C)(C)C', {'ammonium', 'charged'}),
+    ('[O-][N+](=O)c1ccccc1', {'nitro'}),
+    ('CC(C)(C)S', {'thiol'}),
+    ('CCSCC', {'thioether'}),
+    ('NS(=O)(=O)c1ccccc1', {'sulfonamide'}),
+    ('OS(=O)(=O)c1ccccc1', {'sulfonic_acid'}),
+    ('OP(=O)(O)C', {'phosphonic_acid'}),
+    ('CC#N', {'nitrile'}),
+    ('FC(F)F', {'halide', 'F'}),
+    ('[Na+].[Cl-]', {'mixture', 'metal', 'Na', 'Cl'}),
+])
+def test_functional_groups(smiles, expected):
+    found = fingerprints.features(smiles)
+    assert 'parsed' in found
+    assert expected <= found
+
+
+def test_negative_features():
+    assert not {'carboxylic_acid', 'ester'} & fingerprints.features('CC(=O)C')
+    assert 'hydroxyl' not in fingerprints.features('CC(=O)O')
+    assert 'ring' not in fingerprints.features('CCCCCC')
+
+
+## Substructure filter
+LIBRARY = ['OC(=O)c1ccccc1', 'OC(=O)CCS', 'c1ccncc1', 'CCO', 'not a smiles']
+
+
+def test_filter_requires_and_excludes_features():
+    bits = fingerprints.build_index(LIBRARY)
+    assert bits.shape == (len(LIBRARY), fingerprints.WORDS)
+    assert list(fingerprints.candidates(bits, 'carboxylic_acid')) == [0, 1]
+    assert list(fingerprints.candidates(bits, 'cooh !S')) == [0]
+    assert list(fingerprints.candidates(bits, 'COOH, no s')) == [0]
+    # an exclusion alone matches only parsed compounds
+    assert list(fingerprints.candidates(bits, '!aromatic')) == [1, 3]
+    assert list(fingerprints.candidates(bits, 'carboxylic_acid', n=1)) == [0]
+    assert fingerprints.candidates(bits, '  ') is None
+    assert fingerprints.unparsed(bits) == 1
+    with pytest.raises(ValueError, match='Unknown feature: bogus'):
+        fingerprints.candidates(bits, 'bogus')
+
+
+def test_only_reference_names_of_the_library_are_unparsed():
+    # structures_commercial.csv lists the reference compounds by name after
+    # the library columns of the kernel, they are never searched
+    registry = datasets.DatasetRegistry('datasets.json')
+    spec = registry.specs[registry.default]
+    library = pd.read_csv(spec['library']['file'])
+    bits = fingerprints.build_index(library[spec['library']['smiles']].values)
+    n = spec['kernel']['library_columns']
+    assert fingerprints.unparsed(bits, n) == 0
+    unparsed = np.flatnonzero([not fingerprints.features(str(smiles)) for smiles in library['Identifier']])
+    assert set(library['Filename'].values[unparsed]) <= set(pd.read_csv(spec['reference']['file'])['compound'])
+
+
+def test_filter_status_reports_unparsed_compounds(monkeypatch):
+    ds = exchem.registry.get()
+    bits = fingerprints.build_index(ds.struc_columns['Identifier'])
+    query = exchem.update_neighbours(None, '10', dataset_id=ds.id, substructure='carboxylic_acid')
+    assert query['status'] == '%d of %d compounds match' % (
+        len(fingerprints.candidates(bits, 'carboxylic_acid')), ds.sim.n_commercial)
+    bits[:3] = 0
+    monkeypatch.setitem(ds.cache, 'fingerprints', bits)
+    query = exchem.update_neighbours(None, '10', dataset_id=ds.id, substructure='carboxylic_acid')
+    assert query['status'].endswith('; 3 without parseable SMILES never match')
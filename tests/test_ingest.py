@@ -0,0 +1,49 @@
+import pandas as pd
+import pytest
+
+import ingest
+
+
+@pytest.fixture
+def spec(tmp_path):
+    # three library rows followed by the reference rows, like
+    # structures_commercial.csv
+    reference = tmp_path / 'reference.csv'
+    reference.write_text('compound,IE,label\nbipyridine,31,train\npiperazine,-34,test\n')
+    library = tmp_path / 'library.csv'
+    library.write_text('Filename,Identifier,IE_krr,IE_exp\n'
+                       '50-00-0,C=O,1.5,\n64-17-5,CCO,-2.25,\n"a,b",CC,3.0,\n'
+                       'bipyridine,bipyridine,29.7,31.0\npiperazine,piperazine,-31.6,-34.0\n')
+    return {
+        'reference': {'file': str(reference), 'name': 'compound'},
+        'library': {'file': str(library), 'id': 'Filename', 'smiles': 'Identifier', 'property': 'IE_krr'},
+    }
+
+
+def entries(*names):
+    return {name: ('CC' + 'C' * i, 'structures/%s.xyz' % name) for i, name in enumerate(names)}
+
+
+def test_new_compounds_go_before_the_reference_rows(spec):
+    before = open(spec['library']['file']).read().splitlines()
+    new = entries('new-1', 'new-2', 'piperazine', '64-17-5')
+    assert ingest.append_library(spec, new, sorted(new)) == (2, 2)
+    after = open(spec['library']['file']).read().splitlines()
+    # the existing lines are kept verbatim
+    assert after[:4] == before[:4] and after[6:] == before[4:]
+    library = pd.read_csv(spec['library']['file'])
+    assert library['Filename'].tolist() == ['50-00-0', '64-17-5', 'a,b', 'new-1', 'new-2', 'bipyridine', 'piperazine']
+    assert library['Identifier'].tolist()[3:5] == ['CC', 'CCC']
+    assert library['IE_krr'].isna().tolist() == [False] * 3 + [True] * 2 + [False] * 2
+    # a second run adds nothing, further compounds follow the first ones
+    assert ingest.append_library(spec, new, sorted(new)) == (0, 2)
+    assert ingest.append_library(spec, entries('new-3'), ['new-3']) == (1, 2)
+    assert pd.read_csv(spec['library']['file'])['Filename'].tolist()[3:6] == ['new-1', 'new-2', 'new-3']
+
+
+def test_reference_compounds_are_never_added(spec):
+    with open(spec['library']['file'], 'w') as f:
+        f.write('Filename,Identifier,IE_krr,IE_exp\n50-00-0,C=O,1.5,')
+    new = entries('bipyridine', 'new-1')
+    assert ingest.append_library(spec, new, sorted(new)) == (1, 0)
+    assert pd.read_csv(spec['library']['file'])['Filename'].tolist() == ['50-00-0', 'new-1']
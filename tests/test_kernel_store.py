@@ -0,0 +1,116 @@
+import subprocess
+import sys
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pytest
+
+import datasets
+import kernel_store
+
+
+@pytest.fixture
+def kernel_spec():
+    registry = datasets.DatasetRegistry()
+    return registry.specs[registry.default]['kernel']
+
+
+def load_in_subprocess(spec):
+    # loads the kernel in shm mode in a process that exits right after
+    code = ('import sys, kernel_store; '
+            'kernel_store.load_kernel(sys.argv[1], mode="shm", ref_offset=0, n_commercial=int(sys.argv[2]))')
+    subprocess.run([sys.executable, '-c', code, spec['file'], str(spec['library_columns'])], check=True)
+
+
+def test_shared_kernel_outlives_its_creator(kernel_spec):
+    path = kernel_spec['file']
+    kernel_store.unlink_shared(path)
+    try:
+        load_in_subprocess(kernel_spec)
+        # the creator has exited, a second process attaches the same copy
+        shm = shared_memory.SharedMemory(name=kernel_store.shared_name(path))
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        expected = np.load(path, mmap_mode='r')
+        attached = np.ndarray(expected.shape, dtype=expected.dtype, buffer=shm.buf)
+        assert np.array_equal(attached, expected)
+        del attached
+        shm.close()
+        # and so does one more after an attaching process exited
+        load_in_subprocess(kernel_spec)
+        shared_memory.SharedMemory(name=kernel_store.shared_name(path)).close()
+    finally:
+        assert kernel_store.unlink_shared(path)
+    assert not kernel_store.unlink_shared(path)
+
+
+## float32 / uint16 blocks: top-K order and displayed values for every reference
+# storage resolution: neighbours closer than this may swap beyond the
+# precomputed top-50, which is ordered by the float64 kernel
+RESOLUTION = {'float32': 1e-7, 'uint16': kernel_store.U16_SCALE}
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'uint16'])
+@pytest.mark.parametrize('k', [10, 50, 200])
+def test_converted_kernel_keeps_top_k_and_displayed_values(kernel_spec, dtype, k):
+    import exchem
+    import neighbour_index
+
+    layout = {'ref_offset': kernel_spec['reference_offset'], 'n_commercial': kernel_spec['library_columns']}
+    exact = kernel_store.load_kernel(kernel_spec['file'], **layout)
+    exact.neighbours = neighbour_index.load_index(exact)
+    kernel = kernel_store.load_kernel(kernel_spec['file'], dtype=dtype, **layout)
+    kernel.neighbours = neighbour_index.load_index(kernel)
+    assert kernel.n_reference == exact.n_reference == len(datasets.DatasetRegistry().get().compound_names)
+    for row in range(exact.n_reference):
+        expected = exchem.simbapre(exact, None, row, k)
+        found = exchem.simbapre(kernel, None, row, k)
+        exact_row = np.asarray(exact.row(row), dtype=np.float64)
+        if k <= neighbour_index.TOP_K:
+            assert np.array_equal(found, expected)
+        else:
+            assert np.abs(exact_row[found] - exact_row[expected]).max() <= RESOLUTION[dtype]
+        assert np.array_equal(exchem.sim_percent(kernel.row(row)[found]), exchem.sim_percent(exact_row[expected]))
+
+
+def test_float32_kernel_is_not_copied_to_a_float32_block(kernel_spec, tmp_path):
+    path = str(tmp_path / 'kernel.npy')
+    np.save(path, np.load(kernel_spec['file']).astype(np.float32))
+    layout = {'ref_offset': 0, 'n_commercial': kernel_spec['library_columns']}
+    kernel = kernel_store.load_kernel(path, dtype='float32', **layout)
+    assert kernel.path == kernel_store.block_path(path)
+    assert kernel.array.dtype == np.float32
+    assert not (tmp_path / 'kernel.block.f32.npy').exists()
+    # uint16 still halves it
+    kernel = kernel_store.load_kernel(path, dtype='uint16', **layout)
+    assert kernel.path == kernel_store.block_path(path, 'uint16')
+    assert kernel.nbytes * 2 == np.load(path, mmap_mode='r').nbytes
+
+
+## Low-rank factor of the square synthetic kernel
+@pytest.fixture
+def square_spec():
+    registry = datasets.DatasetRegistry()
+    return next(spec for spec in registry.specs.values() if spec['id'].endswith('-square'))['kernel']
+
+
+def top_overlap(exact, kernel, k=10):
+    # fraction of the exact top-k found by `kernel`, per reference
+    return np.array([len(np.intersect1d(np.argsort(-exact.row(row))[:k], np.argsort(-kernel.row(row))[:k])) / k
+                     for row in range(exact.n_reference)])
+
+
+# with rank >= the number of references (152) the Nystroem landmarks are
+# the reference rows, which are then reproduced up to float32 precision
+@pytest.mark.parametrize('rank, mean_overlap, min_overlap', [(16, 0.8, 0.4), (64, 0.95, 0.7), (152, 1.0, 1.0)])
+def test_factor_keeps_the_top_k(square_spec, rank, mean_overlap, min_overlap):
+    layout = {'ref_offset': square_spec['reference_offset'], 'n_commercial': square_spec['library_columns']}
+    exact = kernel_store.load_kernel(square_spec['file'], **layout)
+    factor = kernel_store.load_kernel(square_spec['file'], rank=rank, **layout)
+    assert isinstance(factor, kernel_store.FactorStore)
+    assert factor.path == kernel_store.factor_path(square_spec['file'], rank)
+    assert factor.rows([0, 1]).shape == (2, square_spec['library_columns'])
+    overlap = top_overlap(exact, factor)
+    assert overlap.mean() >= mean_overlap
+    assert overlap.min() >= min_overlap
+    if rank >= exact.n_reference:
+        assert np.allclose(factor.rows(range(exact.n_reference)), exact.rows(range(exact.n_reference)), atol=1e-5)
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+import datasets
+import exchem
+import krr
+import response_cache
+
+
+@pytest.fixture
+def square():
+    # the synthetic dataset with a reference x reference block
+    dataset_id = next(dataset_id for dataset_id in exchem.registry.specs if dataset_id.endswith('-square'))
+    return exchem.registry.get(dataset_id)
+
+
+def refitted_loo_rmse(ds, regularisation):
+    # leave each training compound out in turn and refit on the others,
+    # with the offset (mean of all targets) of the closed form
+    array, row_offset, column_offset = krr.full_kernel(ds.spec)
+    rows, targets = krr.training_rows(ds)
+    kernel = np.asarray(array[row_offset + rows][:, column_offset + rows], dtype=np.float64)
+    mean = targets.mean()
+    residuals = []
+    for i in range(len(rows)):
+        others = np.arange(len(rows)) != i
+        weights = np.linalg.solve(kernel[np.ix_(others, others)] + regularisation * np.eye(others.sum()),
+                                  targets[others] - mean)
+        residuals.append(targets[i] - mean - kernel[i, others] @ weights)
+    return np.sqrt(np.mean(np.square(residuals)))
+
+
+@pytest.mark.parametrize('regularisation', [1e-2, 1.0])
+def test_fit_reproduces_the_refitted_loo_error(square, regularisation):
+    model = krr.fit(square, regularisation=regularisation)
+    assert model['loo_rmse'] == pytest.approx(refitted_loo_rmse(square, regularisation), rel=1e-6)
+    # and predicts the library as the weighted kernel rows
+    array, row_offset, _ = krr.full_kernel(square.spec)
+    predictions = krr.predict(square, model, chunk=16, jobs=2)
+    expected = model['mean'] + model['weights'] @ array[row_offset + model['rows'], :square.sim.n_commercial]
+    assert np.allclose(predictions, expected)
+
+
+def test_fit_needs_the_reference_block():
+    with pytest.raises(ValueError, match='needs the full kernel'):
+        krr.fit(exchem.registry.get())
+
+
+def test_activated_version_is_served_without_reloading_the_kernel(square, monkeypatch):
+    monkeypatch.setattr(datasets, 'PREDICTIONS_INTERVAL', 0)
+    directory = krr.prediction_dir(square.spec)
+    sim, version = square.sim, exchem.dataset_version(square)
+    page = exchem.table_page_response(square.id, version, square.default_row, 10, 'kernel', '', 'max', 0, 10, [], '')
+    model = krr.fit(square)
+    predictions = np.full(square.sim.n_commercial, 42.0)
+    name, _ = krr.write_version(square, model, predictions)
+    krr.activate(directory, name)
+    try:
+        ds = exchem.registry.get(square.id)
+        assert ds is square and ds.sim is sim
+        assert ds.predictions == name
+        assert np.all(ds.struc_columns['IE_krr'][:ds.sim.n_commercial] == 42)
+        new_version = exchem.dataset_version(ds)
+        assert new_version != version
+        # the cached page of the old predictions is not served
+        misses = response_cache.cache.misses
+        records, _, _ = exchem.table_page_response(ds.id, new_version, ds.default_row, 10, 'kernel', '', 'max', 0,
+                                                   10, [], '')
+        assert response_cache.cache.misses == misses + 1
+        assert [record['IE_krr'] for record in records] == [42] * len(records)
+        assert [record['Filename'] for record in records] == [record['Filename'] for record in page[0]]
+    finally:
+        krr.activate(directory, None)
+        exchem.registry.get(square.id)
+    assert square.predictions is None and exchem.dataset_version(square) == version
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+import exchem
+import library_map
+
+
+@pytest.fixture
+def xy():
+    rng = np.random.default_rng(0)
+    # two clusters with a gap between them
+    return np.concatenate([rng.uniform(0, 1, (500, 2)), rng.uniform(3, 4, (500, 2))])
+
+
+def inside(xy, x0, x1, y0, y1):
+    return np.flatnonzero((xy[:, 0] >= x0) & (xy[:, 0] <= x1) & (xy[:, 1] >= y0) & (xy[:, 1] <= y1))
+
+
+@pytest.mark.parametrize('viewport', [
+    (-1, 5, -1, 5), (0.2, 0.7, 0.1, 0.9), (0.5, 3.5, 0.5, 3.5), (3.9, 10, 3.9, 10), (0.3, 0.3, 0, 1),
+])
+def test_grid_query_finds_the_viewport(xy, viewport):
+    grid = library_map.GridIndex(xy, size=16)
+    assert grid.query(*viewport).tolist() == inside(xy, *viewport).tolist()
+
+
+@pytest.mark.parametrize('viewport', [(1.5, 2.5, 1.5, 2.5), (10, 11, 10, 11), (-3, -2, 0, 1)])
+def test_grid_query_of_an_empty_viewport(xy, viewport):
+    # the gap between the clusters and beyond the bounds, clipped to edge cells
+    assert library_map.GridIndex(xy, size=16).query(*viewport).tolist() == []
+
+
+def test_hexbin_counts_and_means():
+    rng = np.random.default_rng(1)
+    x, y = rng.uniform(0, 10, 2000), rng.uniform(0, 5, 2000)
+    values = rng.uniform(-100, 100, 2000)
+    hx, hy, counts, means = library_map.hexbin(x, y, values, 0, 10, 0, 5, 400, 200)
+    assert counts.sum() == 2000 and len(hx) == len(hy) == len(means)
+    assert np.isclose((counts * means).sum(), values.sum())
+    # every point is in the hexagon of the nearest centre, in pixels
+    px, py = x * 40, y * 40
+    nearest = np.argmin((px[:, None] - hx * 40) ** 2 + (py[:, None] - hy * 40) ** 2, axis=1)
+    assert np.array_equal(np.bincount(nearest, minlength=len(counts)), counts)
+
+
+def test_library_trace_bins_beyond_max_points(monkeypatch):
+    ds = exchem.registry.get()
+    figure = exchem.dataset_figure(ds.id)
+    grid = exchem.library_positions(ds)
+    x0, x1 = grid.xy[:, 0].min() - 1, grid.xy[:, 0].max() + 1
+    y0, y1 = grid.xy[:, 1].min() - 1, grid.xy[:, 1].max() + 1
+
+    points = exchem.library_trace(ds, figure, x0, x1, y0, y1)
+    assert len(points['x']) == ds.sim.n_commercial and points['marker']['symbol'] == 'circle'
+
+    monkeypatch.setattr(library_map, 'MAX_POINTS', 50)
+    hexagons = exchem.library_trace(ds, figure, x1, x0, y1, y0)
+    assert hexagons['marker']['symbol'] == 'hexagon' and hexagons['customdata'] is None
+    assert hexagons['text'].sum() == ds.sim.n_commercial
+    assert len(hexagons['x']) == len(hexagons['marker']['color']) < ds.sim.n_commercial
+
+    empty = exchem.library_trace(ds, figure, x1 + 1, x1 + 2, y1 + 1, y1 + 2)
+    assert empty['marker']['symbol'] == 'circle' and len(empty['x']) == 0 and empty['customdata'] == []
@@ -0,0 +1,24 @@
+import dash
+from dash import Input, Output, html
+
+import metrics
+
+
+def test_callback_bytes_count_the_response_body(monkeypatch):
+    monkeypatch.setattr(metrics, 'ENABLED', True)
+    app = dash.Dash(__name__)
+    app.layout = html.Div([html.Button(id='button'), html.Div(id='out')])
+
+    @app.callback(Output('out', 'children'), Input('button', 'n_clicks'))
+    def update(n_clicks):
+        return 'x' * 1000
+
+    metrics.init_app(app)
+    response = app.server.test_client().post('/_dash-update-component', json={
+        'output': 'out.children', 'outputs': {'id': 'out', 'property': 'children'},
+        'inputs': [{'id': 'button', 'property': 'n_clicks', 'value': 1}],
+        'changedPropIds': ['button.n_clicks'], 'state': []})
+    assert response.status_code == 200
+    samples = {labels: value for name, labels, value in metrics.callback_bytes.samples()}
+    assert samples[(('callback', 'out.children'),)] == len(response.get_data())
+    assert 'exchem_callback_response_bytes_total{' in metrics.render()
@@ -0,0 +1,42 @@
+import response_cache
+
+
+def make_cache(tmp_path):
+    return response_cache.ResponseCache(str(tmp_path / 'responses.sqlite'), max_entries=100)
+
+
+def accessed(cache, key):
+    return cache._db().execute('SELECT accessed FROM responses WHERE key = ?', (key,)).fetchone()[0]
+
+
+def test_memoised_none_is_a_hit(tmp_path):
+    cache = make_cache(tmp_path)
+    calls = []
+
+    @cache.memoize('none')
+    def nothing(x):
+        calls.append(x)
+        return None
+
+    assert nothing(1) is None
+    assert nothing(1) is None
+    assert calls == [1]
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.get('missing') is response_cache.MISSING
+
+
+def test_hits_only_refresh_old_access_times(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path)
+    cache.put('key', '[1, 2]')
+    stored = accessed(cache, 'key')
+    db = cache._db()
+    writes = db.total_changes
+    # a hit on a recently used entry does not write
+    assert cache.get('key') == [1, 2]
+    assert db.total_changes == writes
+    assert accessed(cache, 'key') == stored
+    # one used longer ago than the resolution is marked as used again
+    now = stored + response_cache.ACCESS_RESOLUTION + 1
+    monkeypatch.setattr(response_cache.time, 'time', lambda: now)
+    assert cache.get('key') == [1, 2]
+    assert accessed(cache, 'key') == now
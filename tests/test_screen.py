@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import exchem
+import screen
+
+
+OPTIONS = {'min_ie': 20, 'min_similarity': 0.5, 'min_predicted': 0}
+
+
+@pytest.fixture
+def ds():
+    return exchem.registry.get()
+
+
+def brute_force(ds, min_ie, min_similarity, min_predicted):
+    # best similarity and number of matching references of every library
+    # compound from the whole reference block at once
+    rows = screen.reference_rows(ds, min_ie)
+    block = np.asarray(ds.sim.rows(rows), dtype=np.float64)
+    hits = (block > min_similarity) & (ds.struc_columns['IE_krr'][:ds.sim.n_commercial] > min_predicted)
+    best = np.where(hits, block, -np.inf).max(axis=0)
+    return rows, best, hits.sum(axis=0)
+
+
+@pytest.mark.parametrize('chunk, jobs', [(screen.CHUNK, None), (7, 1), (50, 4)])
+def test_screen_matches_a_brute_force_reduction(ds, chunk, jobs):
+    rows, best, counts = brute_force(ds, **OPTIONS)
+    found, found_best, found_ref, found_counts = screen.screen(ds, chunk=chunk, jobs=jobs, **OPTIONS)
+    assert len(found) and np.array_equal(found, np.flatnonzero(counts))
+    assert np.allclose(found_best, best[found])
+    assert np.array_equal(found_counts, counts[found])
+    assert set(found_ref) <= set(rows)
+    assert np.allclose(ds.sim.rows(found_ref)[np.arange(len(found)), found], found_best)
+
+
+def test_ranking_and_csv_output(ds, tmp_path):
+    result = screen.rank(ds, *screen.screen(ds, **OPTIONS))
+    assert list(result.columns) == screen.COLUMNS
+    assert list(result['rank']) == list(range(1, len(result) + 1))
+    assert result['CAS'].is_unique
+    assert np.all(np.diff(result['similarity']) <= 0)
+
+    path = str(tmp_path / 'candidates.csv')
+    frames = screen.ranked(ds, *screen.screen(ds, **OPTIONS), batch=25)
+    assert screen.write_result(frames, path) == len(result)
+    written = pd.read_csv(path)
+    assert list(written.columns) == screen.COLUMNS
+    assert written['CAS'].astype(str).tolist() == result['CAS'].astype(str).tolist()
+    assert np.allclose(written['similarity'], result['similarity'])
+
+
+def test_library_order_streams_the_same_candidates(ds, tmp_path):
+    ranked = screen.rank(ds, *screen.screen(ds, **OPTIONS))
+    path = str(tmp_path / 'candidates.csv')
+    count = screen.write_result(screen.in_library_order(ds, screen.screen_chunks(ds, chunk=40, **OPTIONS)), path)
+    streamed = pd.read_csv(path)
+    assert count == len(streamed) == len(ranked)
+    assert list(streamed['rank']) == list(range(1, count + 1))
+    assert set(streamed['CAS'].astype(str)) == set(ranked['CAS'].astype(str))
+
+
+def test_no_candidates_still_writes_the_header(ds, tmp_path):
+    path = str(tmp_path / 'candidates.csv')
+    options = dict(OPTIONS, min_similarity=2)
+    assert screen.write_result(screen.ranked(ds, *screen.screen(ds, **options)), path) == 0
+    assert list(pd.read_csv(path).columns) == screen.COLUMNS
+
+
+def test_ordered_map_keeps_a_bounded_window():
+    pulled = []
+
+    def items():
+        for item in range(100):
+            pulled.append(item)
+            yield item
+
+    with ThreadPoolExecutor(2) as pool:
+        results = screen.ordered_map(pool, lambda x: x * x, items(), window=4)
+        assert next(results) == 0
+        assert len(pulled) == 4
+        assert list(results) == [x * x for x in range(1, 100)]
@@ -0,0 +1,118 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import bench
+import datasets
+import exchem
+import response_cache
+
+
+@pytest.fixture
+def ds():
+    return exchem.registry.get()
+
+
+@pytest.fixture
+def uncached():
+    # the response cache off for the test, on again afterwards
+    enabled = response_cache.cache.enabled
+    response_cache.cache.enabled = False
+    yield
+    response_cache.cache.enabled = enabled
+
+
+def first_page(ds, click, no_rows):
+    query = exchem.update_neighbours(click, no_rows, dataset_id=ds.id)
+    return exchem.table_page_response(ds.id, exchem.dataset_version(ds), query['row'], query['k'],
+                                      query['backend'], query['substructure'], 'max', 0, exchem.page_size, [], '')
+
+
+def test_neighbour_index_matches_a_fresh_search(ds):
+    for no in (1, 10, ds.sim.neighbours.k):
+        for row in range(ds.sim.n_reference):
+            idx, scores = ds.sim.neighbours.top(row, no)
+            expected_idx, expected_scores = exchem.simbapre_batch(ds.sim, [row], no)
+            assert np.array_equal(idx, expected_idx[0])
+            assert np.allclose(scores, expected_scores[0])
+            assert np.array_equal(exchem.simbapre(ds.sim, ds.data, row, no), expected_idx[0])
+
+
+def test_cached_responses_equal_uncached(ds, uncached):
+    rows = range(0, len(ds.compound_names), 7)
+    expected = [(exchem.molecule_response(ds.id, exchem.dataset_version(ds), row),
+                 exchem.table_page_response(ds.id, exchem.dataset_version(ds), row, 20, 'kernel', '', 'max', 0,
+                                            exchem.page_size, [], ''))
+                for row in rows]
+    response_cache.cache.enabled = True
+    response_cache.cache.clear()
+    # the first round stores the responses, the second reads them back
+    for _ in range(2):
+        for row, (molecule, page) in zip(rows, expected):
+            assert exchem.molecule_response(ds.id, exchem.dataset_version(ds), row) == list(molecule)
+            assert exchem.table_page_response(ds.id, exchem.dataset_version(ds), row, 20, 'kernel', '', 'max', 0,
+                                              exchem.page_size, [], '') == list(page)
+
+
+def test_parallel_searches_are_isolated(ds, uncached):
+    # every page computed serially without the response cache, then again
+    # from many threads at once through the cache
+    clicks = bench.all_clicks(exchem, ds)
+    jobs = [(click, no_rows) for click in clicks for no_rows in ('5', '50')]
+    expected = [first_page(ds, click, no_rows) for click, no_rows in jobs]
+    response_cache.cache.enabled = True
+    response_cache.cache.clear()
+    exchem.neighbour_table.cache_clear()
+    exchem.neighbour_view.cache_clear()
+    with ThreadPoolExecutor(16) as pool:
+        found = list(pool.map(lambda job: first_page(ds, *job), jobs * 4))
+    for n, page in enumerate(found):
+        assert page == list(expected[n % len(jobs)])
+
+
+def test_lookups_resolve_to_their_rows(ds):
+    # names may repeat, a lookup only has to land on a row of that name
+    names = ds.compound_names
+    for name in names:
+        assert names[exchem.find_idx(name, ds.compound_rows)] == name
+    for click in bench.all_clicks(exchem, ds):
+        point = click['points'][0]
+        trace = exchem.dataset_figure(ds.id)['data'][point['curveNumber']]
+        assert names[exchem.point_row(point)] == trace['text'][point['pointNumber']]
+    filenames = ds.struc_columns['Filename']
+    for name in filenames:
+        assert filenames[ds.cas_rows[name]] == name
+
+
+def load_with(monkeypatch, dataset_id, **env):
+    # the dataset as loaded by a worker started with these settings
+    for key, value in env.items():
+        monkeypatch.setenv(key, value)
+    registry = datasets.DatasetRegistry()
+    monkeypatch.setattr(exchem, 'registry', registry)
+    return registry.get(dataset_id)
+
+
+def cached_page(ds):
+    # (page, whether it missed the response cache)
+    misses = response_cache.cache.misses
+    page = exchem.table_page_response(ds.id, exchem.dataset_version(ds), ds.default_row, 20, 'kernel', '', 'max', 0,
+                                      exchem.page_size, [], '')
+    return page, response_cache.cache.misses > misses
+
+
+@pytest.mark.parametrize('setting, default, value', [('EXCHEM_KERNEL_RANK', '0', '16'),
+                                                     ('EXCHEM_KERNEL_DTYPE', 'float64', 'uint16')])
+def test_kernel_store_change_misses_the_response_cache(monkeypatch, setting, default, value):
+    square = next(dataset_id for dataset_id in exchem.registry.specs if dataset_id.endswith('-square'))
+    response_cache.cache.clear()
+    versions = []
+    for setting_value in (default, value, default):
+        ds = load_with(monkeypatch, square, **{setting: setting_value})
+        page, missed = cached_page(ds)
+        # a worker with another kernel store never reads the other's pages
+        assert missed == (exchem.dataset_version(ds) not in versions)
+        assert cached_page(ds) == (page, False)
+        versions.append(exchem.dataset_version(ds))
+    assert versions[0] != versions[1] and versions[0] == versions[2]
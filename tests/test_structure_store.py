@@ -0,0 +1,85 @@
+import os
+import time
+
+import pytest
+
+import structure_store
+
+
+WATER = '3\n   \nO    0.00000    0.00000    0.11730\nH    0.00000    0.75720   -0.46920\nH    0.00000   -0.75720   -0.46920\n'
+
+
+@pytest.fixture
+def directory(tmp_path):
+    path = tmp_path / 'structures'
+    path.mkdir()
+    for name in ('a', 'b', 'c'):
+        (path / (name + '.xyz')).write_text(WATER)
+    return str(path)
+
+
+def pack(directory, signatures=True):
+    path = directory + '.pack'
+    structure_store.write_pack(structure_store.iter_structure_dir(directory), path,
+                               directory=directory if signatures else None)
+    return path
+
+
+def test_pack_reads_the_structures(directory):
+    store = structure_store.StructurePack(pack(directory))
+    assert sorted(store.names) == ['a', 'b', 'c'] and set(store.sources) == {'a', 'b', 'c'}
+    assert store.read('b') == structure_store.read_structure('b', directory)
+
+
+def test_pack_is_stale_once_a_file_changes(directory):
+    path = pack(directory)
+    assert structure_store.load_pack(path, directory) is not None
+    # rewritten in place: same size, the directory mtime does not change
+    target = os.path.join(directory, 'b.xyz')
+    mtime = os.stat(directory).st_mtime_ns
+    with open(target, 'w') as f:
+        f.write(WATER.replace('0.75720', '0.75730'))
+    os.utime(target, ns=(time.time_ns(), os.stat(target).st_mtime_ns + 10**9))
+    os.utime(directory, ns=(mtime, mtime))
+    assert structure_store.load_pack(path, directory) is None
+    path = pack(directory)
+    assert structure_store.load_pack(path, directory) is not None
+
+
+@pytest.mark.parametrize('change', ['add', 'remove'])
+def test_pack_is_stale_once_a_file_is_added_or_removed(directory, change):
+    path = pack(directory)
+    if change == 'add':
+        with open(os.path.join(directory, 'd.xyz'), 'w') as f:
+            f.write(WATER)
+    else:
+        os.remove(os.path.join(directory, 'c.xyz'))
+    # even if the pack is newer than the directory
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 10**10))
+    assert structure_store.load_pack(path, directory) is None
+
+
+def test_pack_without_signatures_compares_the_directory_mtime(directory):
+    path = pack(directory, signatures=False)
+    os.utime(path, ns=(time.time_ns(), os.stat(directory).st_mtime_ns + 10**9))
+    assert structure_store.load_pack(path, directory).sources is None
+    os.utime(path, ns=(time.time_ns(), os.stat(directory).st_mtime_ns - 10**9))
+    assert structure_store.load_pack(path, directory) is None
+
+
+def test_prefetch_counts_only_structures_read(directory):
+    structure_store.read_structure.cache_clear()
+    prefetcher = structure_store.Prefetcher(threads=2)
+
+    def run(names):
+        prefetcher.submit(names, directory)
+        deadline = time.monotonic() + 10
+        while prefetcher.pending and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return prefetcher.prefetched
+
+    structure_store.read_structure('a', directory)
+    assert run(['a', 'b']) == 1
+    assert run(['a', 'b', 'c', 'missing']) == 2
+    assert run(['c', 'b']) == 2
+    structure_store.read_structure.cache_clear()
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+import exchem
+import table_query
+
+
+@pytest.fixture
+def columns():
+    return {
+        'Filename': np.array(['50-00-0', '64-17-5', "O'Brien", 'tris', 'Tris-HCl', '64-19-7'], dtype=object),
+        'Identifier': np.array(['C=O', 'CCO', 'CC', 'OCC(N)(CO)CO', 'Cl', 'CC(=O)O'], dtype=object),
+        'IE_krr': np.array([10.0, -5.0, 10.0, 80.0, 80.0, 35.0]),
+        'sim_val': np.array([99.0, 90.5, 90.5, 80.0, 70.0, 60.0]),
+    }
+
+
+def rows(columns, filter_query='', sort_by=None):
+    return table_query.view(columns, filter_query, sort_by).tolist()
+
+
+def test_contains_is_case_sensitive_unless_icontains(columns):
+    assert rows(columns, '{Filename} scontains Tris') == [4]
+    assert rows(columns, '{Filename} contains Tris') == [4]
+    assert rows(columns, '{Filename} icontains TRIS') == [3, 4]
+    assert rows(columns, '{Identifier} contains (CO)') == [3]
+
+
+def test_quoted_values(columns):
+    assert rows(columns, '{Filename} = "O\'Brien"') == [2]
+    assert rows(columns, r"{Filename} = 'O\'Brien'") == [2]
+    assert rows(columns, '{Identifier} contains "C(=O)"') == [5]
+    assert rows(columns, '{Filename} icontains "tris-hcl"') == [4]
+    assert rows(columns, '{Filename} = "64-17-5"') == [1]
+
+
+@pytest.mark.parametrize('filter_query, expected', [
+    ('{IE_krr} > 10', [3, 4, 5]),
+    ('{IE_krr} >= 10', [0, 2, 3, 4, 5]),
+    ('{IE_krr} < 0', [1]),
+    ('{IE_krr} = 80', [3, 4]),
+    ('{IE_krr} eq 80', [3, 4]),
+    ('{IE_krr} != 10', [1, 3, 4, 5]),
+    ('{IE_krr} le -5', [1]),
+    ('{IE_krr} > 1e1', [3, 4, 5]),
+    ('{sim_val} > 80 && {IE_krr} ge 10', [0, 2]),
+])
+def test_numeric_comparisons(columns, filter_query, expected):
+    assert rows(columns, filter_query) == expected
+
+
+def test_invalid_numeric_filter_is_ignored_and_reported(columns):
+    assert rows(columns, '{IE_krr} > abc') == list(range(6))
+    assert rows(columns, '{IE_krr} > abc && {sim_val} < 80') == [4, 5]
+    assert table_query.invalid_terms('{IE_krr} > abc && {sim_val} < 80', exchem.NUMERIC_COLUMNS) == [
+        'IE_krr > abc']
+    # text columns compare as text
+    assert table_query.invalid_terms('{Filename} > abc', exchem.NUMERIC_COLUMNS) == []
+    assert exchem.update_table_status('{IE_krr} gt ten') == 'Not a number, filter ignored: IE_krr > ten'
+    assert exchem.update_table_status('{IE_krr} gt 10') == ''
+
+
+def test_unknown_columns_and_malformed_terms_are_skipped(columns):
+    assert rows(columns, '{missing} > 3') == list(range(6))
+    assert rows(columns, 'IE_krr > 3') == list(range(6))
+
+
+def test_multi_column_sort(columns):
+    by_ie_then_name = [{'column_id': 'IE_krr', 'direction': 'desc'}, {'column_id': 'Filename', 'direction': 'asc'}]
+    assert rows(columns, sort_by=by_ie_then_name) == [4, 3, 5, 0, 2, 1]
+    by_ie_then_similarity = [{'column_id': 'IE_krr', 'direction': 'asc'}, {'column_id': 'sim_val', 'direction': 'asc'}]
+    assert rows(columns, sort_by=by_ie_then_similarity) == [1, 2, 0, 5, 4, 3]
+    # ties keep the given order (by similarity)
+    assert rows(columns, sort_by=[{'column_id': 'IE_krr', 'direction': 'desc'}]) == [3, 4, 5, 0, 2, 1]
+    assert rows(columns, '{IE_krr} >= 10', by_ie_then_name) == [4, 3, 5, 0, 2]
+
+
+def test_pages_are_clamped(columns):
+    view = table_query.view(columns)
+    assert table_query.page(view, 1, 4)[0].tolist() == [4, 5]
+    assert table_query.page(view, 1, 4)[1:] == (2, 1)
+    assert table_query.page(view, 7, 4)[1:] == (2, 1)
+    empty = table_query.view(columns, '{IE_krr} > 100')
+    assert table_query.page(empty, 3, 4)[0].tolist() == []
+    assert table_query.page(empty, 3, 4)[1:] == (1, 0)